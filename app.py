@@ -3,15 +3,34 @@ from flask_sqlalchemy import SQLAlchemy
 from langchain_openai import ChatOpenAI
 from langchain_core.prompts import ChatPromptTemplate
 from langchain_core.output_parsers import StrOutputParser
+from pydantic import BaseModel, Field
 import os
 import json
 import re
 from datetime import datetime
 from dotenv import load_dotenv
+from state_store import StateNamespace, create_state_store
+from broadcast_bus import create_broadcast_bus
+from llm_client import LLMClientPool, ManagedChatOpenAI
+from budget_estimator import RunningCostTally, detect_budget_currency, estimate_plan_cost, format_money
+from route_sections import (
+    RouteSectionSplitter,
+    resolve_route_sections,
+    route_day_number,
+    route_day_sections,
+    split_route_sections,
+    with_day_heading,
+)
+import heapq
 import uuid
 import random
 import threading
 import queue
+import time
+from collections import Counter, OrderedDict, deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from itertools import count, islice
+from typing import Literal, Optional
 
 # 加载环境变量
 load_dotenv()
@@ -22,29 +41,288 @@ app.config['SECRET_KEY'] = os.getenv('SECRET_KEY', 'your-secret-key-here')
 app.config['SQLALCHEMY_DATABASE_URI'] = os.getenv('DATABASE_URL', 'sqlite:///bills.db')
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
 
-# 用于存储用户旅行规划状态（内存存储，实际应用中应使用数据库或Redis）
+# 共享状态存储：STATE_BACKEND=memory（默认，单进程）或 sqlite（多个 worker 共享同一个 WAL 文件）
+state_store = create_state_store(
+    os.getenv('STATE_BACKEND', 'memory'),
+    os.getenv('STATE_DB_PATH', os.path.join(app.instance_path, 'chat_state.db'))
+)
+
+# 用于存储用户旅行规划状态
 # 格式: {session_id: {"route_plan": "...", "restaurant_plan": "...", "budget": ..., "awaiting_mediation": False, "awaiting_confirmation": False, "pending_modification_request": "...", "mediation_requesting_user_id": "...", "mediation_modification_type": "route|restaurant"}}
-travel_plan_storage = {}
+travel_plan_storage = StateNamespace(state_store, 'travel_plans')
 
 # 投票机制存储
 # 格式: {session_id: {"mediation_votes": {user_id: "agree|disagree|pending"}, "confirmation_votes": {user_id: "agree|disagree|pending"}}}
-vote_storage = {}
+vote_storage = StateNamespace(state_store, 'votes')
 
 # 多人聊天室系统
 # 用户管理：{user_id: {"name": "随机名字", "session_id": "..."}}
-user_storage = {}
+user_storage = StateNamespace(state_store, 'users')
+
+# 在线状态（所有 worker 可见）：{user_id: {"connection_id": "...", "last_seen": 时间戳}}
+sse_presence = StateNamespace(state_store, 'presence')
+# 超过该时间（秒）未刷新的在线记录视为离线（例如 worker 异常退出）
+SSE_PRESENCE_TTL = 30
 
 # 多人聊天室共享session_id（所有用户共享同一个行程计划）
 SHARED_CHATROOM_SESSION_ID = "shared_chatroom_session"
 
-# 消息队列：存储所有消息，格式: {"id": "...", "user_id": "...", "username": "...", "type": "user|ai|planner", "content": "...", "timestamp": "..."}
-message_queue = []
-message_queue_lock = threading.Lock()
 
-# SSE连接管理：{user_id: queue.Queue()}
+def encode_sse_frame(message, event_id=None):
+    """把消息编码为SSE帧（bytes）；每条广播只编码一次，所有订阅者共享同一个帧
+
+    event_id 写入帧的 id: 字段，客户端重连时通过 Last-Event-ID 告诉服务器已经收到的位置。
+    """
+    if event_id is None:
+        return f"data: {json.dumps(message)}\n\n".encode('utf-8')
+    return f"id: {event_id}\ndata: {json.dumps(message)}\n\n".encode('utf-8')
+
+
+SSE_HEARTBEAT_FRAME = b": heartbeat\n\n"
+
+# 慢速客户端被断开前收到的最后一帧，客户端收到后应重新连接
+SSE_RESYNC_FRAME = encode_sse_frame({'type': 'resync', 'reason': 'slow_consumer'})
+
+
+class MessageHistory:
+    """按消息id索引的有界消息历史：O(1) 插入/更新，O(1) 淘汰最旧的消息
+
+    每条消息同时缓存其SSE帧，补发历史时直接复用广播时编码好的帧。
+    另外按最后一次更新的事件id维护消息顺序，重连时只补发 Last-Event-ID 之后更新过的消息。
+    """
+
+    def __init__(self, maxlen=1000):
+        self.maxlen = maxlen
+        self._messages = OrderedDict()  # {message_id: (消息, SSE帧或None, 最后更新的事件id)}
+        self._updates = OrderedDict()  # {message_id: 最后更新的事件id}，按事件id递增排列
+        self._evicted_event_id = 0  # 已淘汰消息中最大的事件id
+        self._last_event_id = 0
+        self._lock = threading.Lock()
+
+    def upsert(self, message, event_id, frame=None):
+        """插入新消息；相同id的消息原位更新（保持在历史中的位置）
+
+        append 增量会合并到已保存的完整消息中，历史里始终保存完整快照；
+        合并后的快照在第一次补发时才重新编码。frame 为该消息广播时的SSE帧。
+        """
+        message_id = message.get('id')
+        with self._lock:
+            self._last_event_id = max(self._last_event_id, event_id)
+            self._updates[message_id] = event_id
+            self._updates.move_to_end(message_id)
+            if message.get('op') == 'append':
+                existing = self._messages.get(message_id)
+                if existing is not None:
+                    merged = dict(existing[0])
+                    merged.update((key, value) for key, value in message.items() if key not in ('op', 'delta'))
+                    merged['content'] = existing[0].get('content', '') + message.get('delta', '')
+                    self._messages[message_id] = (merged, None, event_id)
+                    return
+                # 没有收到过该消息的开始（例如 worker 刚启动），只能以增量作为内容
+                message = dict(message, content=message.get('delta', ''))
+                message.pop('delta', None)
+                frame = None
+            message = {key: value for key, value in message.items() if key != 'op'}
+            if message_id in self._messages:
+                self._messages[message_id] = (message, frame, event_id)
+                return
+            self._messages[message_id] = (message, frame, event_id)
+            if len(self._messages) > self.maxlen:
+                evicted_id, _ = self._messages.popitem(last=False)
+                self._evicted_event_id = max(self._evicted_event_id, self._updates.pop(evicted_id))
+
+    def last(self, n):
+        """最近 n 条消息（按时间顺序）"""
+        with self._lock:
+            recent = [message for message, _, _ in islice(reversed(self._messages.values()), n)]
+        recent.reverse()
+        return recent
+
+    def last_frames(self, n):
+        """最近 n 条消息的SSE帧（按时间顺序），没有缓存帧的消息编码一次后缓存"""
+        with self._lock:
+            recent = [self._frame_locked(message_id) for message_id in islice(reversed(self._messages), n)]
+        recent.reverse()
+        return recent
+
+    def frames_since(self, event_id):
+        """事件 event_id 之后更新过的消息的SSE帧（按事件id顺序，每条消息只发送当前完整快照）
+
+        历史无法完整覆盖（所需的消息已被淘汰，或 event_id 来自重启前的服务器）时返回 None。
+        """
+        with self._lock:
+            if event_id < self._evicted_event_id or event_id > self._last_event_id:
+                return None
+            missed = []
+            for message_id in reversed(self._updates):
+                if self._updates[message_id] <= event_id:
+                    break
+                missed.append(self._frame_locked(message_id))
+        missed.reverse()
+        return missed
+
+    def frame(self, message_id):
+        """某条消息当前完整快照的SSE帧，不在历史中时返回 None"""
+        with self._lock:
+            if message_id not in self._messages:
+                return None
+            return self._frame_locked(message_id)
+
+    def _frame_locked(self, message_id):
+        message, frame, event_id = self._messages[message_id]
+        if frame is None:
+            frame = encode_sse_frame(message, event_id)
+            self._messages[message_id] = (message, frame, event_id)
+        return frame
+
+    def __len__(self):
+        return len(self._messages)
+
+
+# 消息历史：存储最近1000条消息，格式: {"id": "...", "user_id": "...", "username": "...", "type": "user|ai|planner", "content": "...", "timestamp": "..."}
+message_history = MessageHistory(maxlen=1000)
+
+# SSE订阅队列长度，以及队列满时对慢速客户端的处理策略（见 SubscriberQueue）
+SSE_QUEUE_SIZE = int(os.getenv('SSE_QUEUE_SIZE', '100'))
+SSE_SLOW_CONSUMER_POLICY = os.getenv('SSE_SLOW_CONSUMER_POLICY', 'coalesce')
+
+# 慢速客户端统计（本 worker）
+sse_metrics = {"dropped_frames": 0, "coalesced_frames": 0, "slow_consumer_disconnects": 0}
+sse_metrics_lock = threading.Lock()
+
+
+def record_sse_metric(name, count=1):
+    with sse_metrics_lock:
+        sse_metrics[name] += count
+
+
+class SubscriberQueue:
+    """单个SSE连接的有界帧队列，队列满时按策略处理慢速客户端，不会阻塞广播方
+
+    - drop_oldest：丢弃最旧的帧（被丢弃的增量会让客户端暂时停在旧内容，直到下一次快照）
+    - coalesce：同一消息排队中的多个帧合并为该消息当前的完整快照；仍然放不下时丢弃最旧的帧
+    - disconnect：清空队列，只留下 resync 标记，事件流发送标记后结束，由客户端重新连接
+    """
+
+    POLICIES = ('drop_oldest', 'coalesce', 'disconnect')
+
+    def __init__(self, maxsize=100, policy='coalesce'):
+        if policy not in self.POLICIES:
+            print(f"警告: 未知的SSE慢速客户端策略 {policy}，使用 coalesce")
+            policy = 'coalesce'
+        self.maxsize = maxsize
+        self.policy = policy
+        self.closed = False
+        self.dropped = 0
+        self.coalesced = 0
+        self.max_depth = 0
+        self._items = deque()  # [(message_id, 帧)]
+        self._lock = threading.Lock()
+        self._ready = threading.Condition(self._lock)
+
+    def put(self, message_id, frame):
+        """放入一个帧（任意线程调用，从不阻塞）"""
+        with self._lock:
+            if self.closed:
+                return
+            if len(self._items) >= self.maxsize and self._make_room_locked(message_id):
+                return
+            self._items.append((message_id, frame))
+            self.max_depth = max(self.max_depth, len(self._items))
+            self._notify_locked()
+
+    def _make_room_locked(self, message_id):
+        """队列已满时腾出空间，返回 True 表示新帧已被合并或连接已关闭，无需再放入"""
+        if self.policy == 'disconnect':
+            self._items.clear()
+            self._items.append((None, SSE_RESYNC_FRAME))
+            self.closed = True
+            record_sse_metric('slow_consumer_disconnects')
+            self._notify_locked()
+            return True
+        if self.policy == 'coalesce':
+            merged_incoming = self._coalesce_locked(message_id)
+            if merged_incoming or len(self._items) < self.maxsize:
+                return merged_incoming
+        self._items.popleft()
+        self.dropped += 1
+        record_sse_metric('dropped_frames')
+        return False
+
+    def _coalesce_locked(self, message_id):
+        """把同一消息的多个排队帧替换为一个完整快照帧（放在最早的位置）"""
+        counts = Counter(queued_id for queued_id, _ in self._items)
+        counts[message_id] += 1
+        snapshots = {}
+        for queued_id, count in counts.items():
+            if count > 1 and queued_id is not None:
+                # 消息历史已包含刚刚投递的新消息，快照即为当前的完整内容
+                snapshot = message_history.frame(queued_id)
+                if snapshot is not None:
+                    snapshots[queued_id] = snapshot
+        if not snapshots:
+            return False
+
+        compacted = deque()
+        for queued_id, frame in self._items:
+            if queued_id not in snapshots:
+                compacted.append((queued_id, frame))
+            elif snapshots[queued_id] is not None:
+                compacted.append((queued_id, snapshots[queued_id]))
+                snapshots[queued_id] = None
+        merged = len(self._items) - len(compacted)
+        merged_incoming = message_id in snapshots
+        if merged_incoming:
+            merged += 1
+        self._items = compacted
+        self.coalesced += merged
+        record_sse_metric('coalesced_frames', merged)
+        return merged_incoming
+
+    def _notify_locked(self):
+        self._ready.notify()
+
+    def _pop_locked(self):
+        return self._items.popleft()[1] if self._items else None
+
+    def get(self, timeout):
+        """取出下一个帧，超时抛出 queue.Empty"""
+        with self._lock:
+            if not self._items:
+                self._ready.wait(timeout)
+            frame = self._pop_locked()
+        if frame is None:
+            raise queue.Empty
+        return frame
+
+    def drained(self):
+        """连接已因慢速被关闭且 resync 标记已发送"""
+        with self._lock:
+            return self.closed and not self._items
+
+    def depth(self):
+        return len(self._items)
+
+
+# 本 worker 的SSE连接：{user_id: SubscriberQueue}，队列中是编码好的SSE帧（ASGI 模式下为 asgi.AsyncSubscriberQueue）
 sse_connections = {}
 sse_connections_lock = threading.Lock()
 
+# 广播总线：BROADCAST_BUS=local（单进程）或 sqlite（跨 worker 的追加日志）
+# 默认与状态存储保持一致：使用 sqlite 共享状态时也使用 sqlite 广播
+BROADCAST_BUS_BACKEND = os.getenv('BROADCAST_BUS', 'sqlite' if os.getenv('STATE_BACKEND') == 'sqlite' else 'local')
+BROADCAST_BUS_PATH = os.getenv('BROADCAST_BUS_PATH', os.path.join(app.instance_path, 'chat_bus.db'))
+
+# 流式消息每隔多少次增量广播发送一次完整快照
+BROADCAST_SNAPSHOT_INTERVAL = max(int(os.getenv('BROADCAST_SNAPSHOT_INTERVAL', '50')), 1)
+
+# 流式增量合并：同一条消息在窗口（毫秒）内或累计到字节阈值前的增量合并为一次广播，窗口为 0 时不合并
+BROADCAST_COALESCE_MS = float(os.getenv('BROADCAST_COALESCE_MS', '75'))
+BROADCAST_COALESCE_BYTES = int(os.getenv('BROADCAST_COALESCE_BYTES', '2048'))
+
+# SSE心跳间隔（秒）
+SSE_HEARTBEAT_INTERVAL = float(os.getenv('SSE_HEARTBEAT_INTERVAL', '1'))
+
 # 随机名字列表
 RANDOM_NAMES = [
     "Alex", "Blake", "Casey", "Drew", "Ellis", "Finley", "Gray", "Harper",
@@ -279,11 +557,98 @@ CRITICAL - Partial Modification:
 {revision_request}
 
 Please provide a detailed, practical, and well-organized travel route plan. Format your response clearly with day-by-day breakdowns when applicable. **Remember to always include hotel recommendations with explicit cost breakdowns.**
+End the plan with one line giving the cost of the whole route plan (accommodation, transport and activities) for the whole group: "Total Estimated Trip Cost: <amount>"
 
 User question: {user_input}
 
 Please provide the travel route plan:"""
 
+# 路线分段修改提示词：只重写路线计划中的一天（或费用汇总）
+ROUTE_SECTION_PROMPT = """You are a professional Travel Route Planner. You are editing ONE section of an existing travel itinerary. The rest of the itinerary stays unchanged.
+
+Trip overview:
+{overview}
+
+Itinerary outline (all sections, for context only):
+{outline}
+
+{budget_constraint}
+
+Section to rewrite:
+=== SECTION ===
+{section}
+=== END OF SECTION ===
+
+{context}
+
+User's modification request: {user_input}
+
+Rules:
+- Output ONLY the rewritten section, starting with its heading line (keep "{title}" unless the request changes what this day is about) and using the same Markdown format
+- Change only what the user asked for; keep everything else in this section exactly as it is
+- Include explicit prices for anything you add or change (hotels with cost per night)
+- Do not output other days, an overall summary, or any explanation outside the section
+
+Rewritten section:"""
+
+# 逐天饭店规划提示词：路线规划每完成一天就为这一天推荐餐厅
+RESTAURANT_DAY_PROMPT = """You are a professional Restaurant Planner. Recommend restaurants for ONE day of a travel itinerary; other days are handled separately.
+
+This day's route plan:
+{day_plan}
+
+User's original question: {user_input}
+
+Rules:
+- Start with the heading "## {day_heading} - Restaurants"
+- Recommend breakfast, lunch and dinner near the places visited on this day (name, location, cuisine, one-line description)
+- MANDATORY: give an estimated price per person for every recommendation with the currency (e.g. "$15-25 per person")
+- End with one line: "Estimated food cost for this day: <amount> for the whole group"
+- Base prices on realistic market rates; do not describe other days
+
+Restaurant recommendations:"""
+
+# 并行路线规划：先生成逐天骨架，再并发生成每一天的详细安排
+ROUTE_SKELETON_PROMPT = """You are a professional Travel Route Planner. Create ONLY the day-by-day outline of a {days}-day trip. The detailed plan for each day will be written separately from your outline, so every day must be self-contained.
+
+{previous_route_plan}
+
+{budget_constraint}
+
+{revision_request}
+
+User question: {user_input}
+
+Output format (plain text, no extra commentary):
+- First line: a short title for the trip
+- Then 1-3 sentences of overview (destination, pace, where to stay)
+- Then exactly one line per day, in order, formatted as:
+Day N: <theme> | <areas and main attractions> | <overnight city/area>
+
+Outline:"""
+
+ROUTE_DAY_PROMPT = """You are a professional Travel Route Planner writing ONE day of a multi-day itinerary. Other days are written separately from the same outline.
+
+Trip outline:
+{skeleton}
+
+{budget_constraint}
+
+User question: {user_input}
+
+Write the detailed plan for this day only:
+{day_outline}
+
+Rules:
+- Start with the heading "## {day_heading}"
+- Follow the outline for this day; do not describe other days
+- Give a practical schedule (morning / afternoon / evening) with transport between places
+- Include explicit prices: hotel cost per night, attraction tickets, local transport
+- Do not add an overall summary or total for the trip
+- End the day with one line giving the cost of this day (accommodation, transport and activities) for the whole group: "Estimated cost for this day: <amount> for the whole group"
+
+Day plan:"""
+
 # 饭店规划师提示词
 RESTAURANT_PLANNER_PROMPT = """You are a professional Restaurant Planner. Your task is to recommend restaurants based on the travel route plan provided.
 
@@ -300,7 +665,7 @@ You MUST include estimated prices for each restaurant recommendation. For each r
 2. Include price ranges if applicable (e.g., "$15-25 per person" or "$30-50 for dinner")
 3. Specify the currency (USD, EUR, GBP, etc.)
 4. If prices vary by meal type, specify prices for breakfast, lunch, and dinner separately
-5. Calculate total estimated food costs for the entire trip
+5. Calculate total estimated food costs for the entire trip and the whole group, and end with one line: "Total Estimated Food Cost: <amount> for the whole group"
 
 Price Format Examples:
 - "Restaurant Name - $25-35 per person for dinner"
@@ -492,6 +857,33 @@ Output: {{"budget": 3000, "currency": "USD", "found": true}}
 
 Return ONLY the JSON object, no additional text."""
 
+# 融合 intake 提示词：一次调用同时完成路由、意图判断和旅行信息提取（INTAKE_MODE=fused 时使用）
+INTAKE_PROMPT = """You are the intake stage of a multi-user travel planning and AA bill chatroom. In ONE pass, classify the user's message and extract travel details.
+
+Context:
+- Previous route plan (if exists): {previous_route_plan}
+- Previous restaurant plan (if exists): {previous_restaurant_plan}
+- Previous budget (if exists): {previous_budget}
+- Awaiting replan confirmation (if exists): {awaiting_replan_confirmation}
+
+User's current message: {user_input}
+
+Fields:
+1. "agent":
+   - "bill" ONLY when the message explicitly involves recording bills, querying bills, or AA cost sharing/splitting of expenses that already happened
+   - "travel" for everything else (travel, itinerary, hotels, restaurants, budget, any city or country, any other conversation)
+2. "intent" (only meaningful when agent is "travel"; use "new_plan" otherwise):
+   - "replan_after_budget_fail": awaiting replan confirmation is "true" AND the user responds affirmatively (yes, ok, sure, replan, proceed...)
+   - "new_plan": there is no previous route plan or restaurant plan, the user asks for a completely new plan, or the intent is unclear
+   - "confirm_plan": a plan exists AND the user explicitly asks to confirm/finalize it
+   - "modify_route": the user wants to change the route/itinerary/schedule, or gives feedback or suggestions about the existing route
+   - "modify_restaurant": the user explicitly wants to change restaurants/dining/food
+   - "modify_budget": the user explicitly wants to change the budget/price/cost
+3. "budget": the budget amount the user mentions in this message as a number (ranges: use the upper bound), or null if none
+4. "days": the trip length in days mentioned in this message, or null
+5. "destination": the destination city or country mentioned in this message, or null
+6. "continent": the continent of the destination ("Asia", "Europe", "North America", "South America", "Africa", "Oceania"), or null"""
+
 # 调解者Agent提示词
 MEDIATOR_PROMPT = """You are a Mediator Agent in a multi-user travel planning chatroom. Your role is to coordinate modifications to travel plans when multiple users are involved.
 
@@ -570,6 +962,111 @@ User input: {user_input}
 
 Please respond:"""
 
+# 每个链的模型配置：分类类小任务（路由、意图、预算提取）使用小模型并限制输出长度，规划类使用大模型
+# timeout 为整体超时，connect_timeout 为建立连接的超时，first_token_timeout 为等待首个 token（以及两次数据之间）的超时
+# 另外可选 retries（临时错误重试次数，默认 2）、hedge（是否对冲，默认关闭）、hedge_after（p95 样本不足时的对冲阈值秒数，默认 2）、
+# single_flight（相同提示词的并发调用共享一次生成，默认取 LLM_SINGLE_FLIGHT）
+# 可以用 LLM_CONFIG_FILE（JSON，格式同 CHAIN_MODEL_DEFAULTS）或 LLM_<CHAIN>_<设置名大写> 环境变量覆盖
+LLM_MODEL = os.getenv('LLM_MODEL', 'gpt-4o')
+LLM_SMALL_MODEL = os.getenv('LLM_SMALL_MODEL', 'gpt-4o-mini')
+CHAIN_MODEL_DEFAULTS = {
+    'router': {'model': LLM_SMALL_MODEL, 'max_tokens': 20, 'timeout': 20, 'streaming': True, 'connect_timeout': 5, 'first_token_timeout': 10},
+    'travel_supervisor': {'model': LLM_SMALL_MODEL, 'max_tokens': 150, 'timeout': 20, 'streaming': True, 'connect_timeout': 5, 'first_token_timeout': 10},
+    'budget_extractor': {'model': LLM_SMALL_MODEL, 'max_tokens': 50, 'timeout': 20, 'streaming': True, 'connect_timeout': 5, 'first_token_timeout': 10},
+    'intake': {'model': LLM_SMALL_MODEL, 'max_tokens': 200, 'timeout': 20, 'streaming': False, 'connect_timeout': 5, 'first_token_timeout': 10},
+    'bill': {'model': LLM_MODEL, 'max_tokens': None, 'timeout': 60, 'streaming': False, 'connect_timeout': 5, 'first_token_timeout': 30},
+    'route_planner': {'model': LLM_MODEL, 'max_tokens': None, 'timeout': 120, 'streaming': True, 'connect_timeout': 5, 'first_token_timeout': 30},
+    'route_section_planner': {'model': LLM_MODEL, 'max_tokens': 1500, 'timeout': 60, 'streaming': True, 'connect_timeout': 5, 'first_token_timeout': 30},
+    'route_skeleton_planner': {'model': LLM_MODEL, 'max_tokens': 800, 'timeout': 60, 'streaming': False, 'connect_timeout': 5, 'first_token_timeout': 30},
+    'route_day_planner': {'model': LLM_MODEL, 'max_tokens': 1500, 'timeout': 90, 'streaming': True, 'connect_timeout': 5, 'first_token_timeout': 30},
+    'restaurant_planner': {'model': LLM_MODEL, 'max_tokens': None, 'timeout': 120, 'streaming': True, 'connect_timeout': 5, 'first_token_timeout': 30},
+    'restaurant_day_planner': {'model': LLM_MODEL, 'max_tokens': 1000, 'timeout': 90, 'streaming': True, 'connect_timeout': 5, 'first_token_timeout': 30},
+    'budget_checker': {'model': LLM_MODEL, 'max_tokens': None, 'timeout': 60, 'streaming': True, 'connect_timeout': 5, 'first_token_timeout': 30},
+    'mediator': {'model': LLM_MODEL, 'max_tokens': None, 'timeout': 60, 'streaming': True, 'connect_timeout': 5, 'first_token_timeout': 30},
+    'plan_confirmation': {'model': LLM_MODEL, 'max_tokens': None, 'timeout': 60, 'streaming': True, 'connect_timeout': 5, 'first_token_timeout': 30},
+    'fallback': {'model': LLM_MODEL, 'max_tokens': None, 'timeout': 60, 'streaming': True, 'connect_timeout': 5, 'first_token_timeout': 30},
+}
+
+
+def load_chain_model_config():
+    """合并默认配置、配置文件和环境变量，返回 {chain名: {model, max_tokens, timeout, connect_timeout, first_token_timeout, streaming}}"""
+    config = {name: dict(settings) for name, settings in CHAIN_MODEL_DEFAULTS.items()}
+    
+    config_file = os.getenv('LLM_CONFIG_FILE')
+    if config_file:
+        try:
+            with open(config_file, encoding='utf-8') as f:
+                for name, settings in json.load(f).items():
+                    config.setdefault(name, dict(CHAIN_MODEL_DEFAULTS['fallback'])).update(settings)
+        except (OSError, ValueError) as e:
+            print(f"警告: 读取模型配置文件 {config_file} 失败: {e}")
+    
+    for name, settings in config.items():
+        prefix = f"LLM_{name.upper()}_"
+        if os.getenv(prefix + 'MODEL'):
+            settings['model'] = os.getenv(prefix + 'MODEL')
+        if os.getenv(prefix + 'MAX_TOKENS'):
+            settings['max_tokens'] = int(os.getenv(prefix + 'MAX_TOKENS')) or None
+        for timeout_name in ('timeout', 'connect_timeout', 'first_token_timeout'):
+            if os.getenv(prefix + timeout_name.upper()):
+                settings[timeout_name] = float(os.getenv(prefix + timeout_name.upper()))
+        if os.getenv(prefix + 'STREAMING'):
+            settings['streaming'] = os.getenv(prefix + 'STREAMING').lower() == 'true'
+        if os.getenv(prefix + 'RETRIES'):
+            settings['retries'] = int(os.getenv(prefix + 'RETRIES'))
+        if os.getenv(prefix + 'HEDGE'):
+            settings['hedge'] = os.getenv(prefix + 'HEDGE').lower() == 'true'
+        if os.getenv(prefix + 'HEDGE_AFTER'):
+            settings['hedge_after'] = float(os.getenv(prefix + 'HEDGE_AFTER'))
+        if os.getenv(prefix + 'SINGLE_FLIGHT'):
+            settings['single_flight'] = os.getenv(prefix + 'SINGLE_FLIGHT').lower() == 'true'
+    return config
+
+
+chain_model_config = load_chain_model_config()
+
+# 本 worker 所有 LLM 调用共用的 HTTP 长连接池和全局并发上限
+llm_client_pool = LLMClientPool(
+    max_connections=int(os.getenv('LLM_MAX_CONNECTIONS', '20')),
+    max_concurrency=int(os.getenv('LLM_MAX_CONCURRENCY', '16')),
+    queue_timeout=float(os.getenv('LLM_QUEUE_TIMEOUT', '30')),
+    keepalive_expiry=float(os.getenv('LLM_KEEPALIVE_EXPIRY', '60'))
+)
+LLM_SINGLE_FLIGHT = os.getenv('LLM_SINGLE_FLIGHT', 'true').lower() == 'true'
+LLM_BASE_URL = os.getenv('LLM_BASE_URL') or None  # 指向 OpenAI 兼容的服务（例如本地测试桩）
+_chain_llms = {}  # {chain名: ManagedChatOpenAI}，每个链单独统计重试和对冲，HTTP 连接池共用
+
+
+def get_chain_llm(name):
+    """按链名取得对应配置的 ChatOpenAI（未配置的链使用大模型默认配置）"""
+    settings = chain_model_config.get(name, CHAIN_MODEL_DEFAULTS['fallback'])
+    streaming = settings.get('streaming', True)
+    if name not in _chain_llms:
+        # 非流式调用要等完整响应，读超时取整体超时
+        read_timeout = settings.get('first_token_timeout') if streaming else settings.get('timeout')
+        _chain_llms[name] = ManagedChatOpenAI(
+            client_pool=llm_client_pool,
+            chain_name=name,
+            model=settings['model'],
+            temperature=0,
+            max_tokens=settings.get('max_tokens'),
+            timeout=llm_client_pool.timeout(settings.get('connect_timeout'), read_timeout),
+            total_timeout=settings.get('timeout'),
+            # 重试由 ManagedChatOpenAI 负责（带抖动并计入统计），关闭 SDK 自带的重试
+            max_retries=0,
+            retries=settings.get('retries', 2),
+            hedge=settings.get('hedge', False),
+            hedge_after=settings.get('hedge_after', 2.0),
+            single_flight=settings.get('single_flight', LLM_SINGLE_FLIGHT),
+            streaming=streaming,
+            # 关闭流式时 .stream() 退化为一次完整调用
+            disable_streaming=not streaming,
+            base_url=LLM_BASE_URL,
+            api_key=api_key
+        )
+    return _chain_llms[name]
+
+
 # 初始化 LangChain
 api_key = os.getenv('OPENAI_API_KEY', '')
 if not api_key:
@@ -577,15 +1074,9 @@ if not api_key:
     llm = None
 else:
     try:
-        # 使用 LangChain 初始化 ChatOpenAI
-        # 使用最新的 GPT-4o 模型
-        llm = ChatOpenAI(
-            model="gpt-4o",
-            temperature=0,
-            streaming=True,
-            api_key=api_key
-        )
-        print("LangChain 初始化成功 (使用模型: gpt-4o)")
+        # 使用 LangChain 初始化 ChatOpenAI（默认的大模型客户端，各链按 chain_model_config 选择模型）
+        llm = get_chain_llm('fallback')
+        print(f"LangChain 初始化成功 (使用模型: {LLM_MODEL}，分类模型: {LLM_SMALL_MODEL})")
     except Exception as e:
         print(f"初始化 LangChain 时出错: {e}")
         llm = None
@@ -594,71 +1085,759 @@ else:
 router_template = ChatPromptTemplate.from_template(ROUTER_PROMPT)
 bill_template = ChatPromptTemplate.from_template(BILL_PROMPT)
 route_planner_template = ChatPromptTemplate.from_template(ROUTE_PLANNER_PROMPT)
+route_section_template = ChatPromptTemplate.from_template(ROUTE_SECTION_PROMPT)
+route_skeleton_template = ChatPromptTemplate.from_template(ROUTE_SKELETON_PROMPT)
+route_day_template = ChatPromptTemplate.from_template(ROUTE_DAY_PROMPT)
 restaurant_planner_template = ChatPromptTemplate.from_template(RESTAURANT_PLANNER_PROMPT)
+restaurant_day_template = ChatPromptTemplate.from_template(RESTAURANT_DAY_PROMPT)
 budget_checker_template = ChatPromptTemplate.from_template(BUDGET_CHECKER_PROMPT)
 travel_supervisor_template = ChatPromptTemplate.from_template(TRAVEL_SUPERVISOR_PROMPT)
 mediator_template = ChatPromptTemplate.from_template(MEDIATOR_PROMPT)
 plan_confirmation_template = ChatPromptTemplate.from_template(PLAN_CONFIRMATION_PROMPT)
 fallback_template = ChatPromptTemplate.from_template(FALLBACK_PROMPT)
 budget_extractor_template = ChatPromptTemplate.from_template(BUDGET_EXTRACTOR_PROMPT)
+intake_template = ChatPromptTemplate.from_template(INTAKE_PROMPT)
 
 # 创建输出解析器
 output_parser = StrOutputParser()
 
+
+class IntakeResult(BaseModel):
+    """融合 intake 调用的结构化结果"""
+    agent: Literal["travel", "bill"] = Field(description="Which sub-agent should handle the message")
+    intent: Literal["new_plan", "modify_route", "modify_restaurant", "modify_budget", "replan_after_budget_fail", "confirm_plan"] = Field(description="Travel planning intent")
+    budget: Optional[float] = Field(description="Budget amount mentioned in the message, or null")
+    days: Optional[int] = Field(description="Trip length in days, or null")
+    destination: Optional[str] = Field(description="Destination city or country, or null")
+    continent: Optional[Literal["Asia", "Europe", "North America", "South America", "Africa", "Oceania"]] = Field(description="Continent of the destination, or null")
+
+    def travel_info(self):
+        """与 extract_travel_info 返回值相同格式的旅行信息"""
+        return {
+            "continent": self.continent,
+            "budget": self.budget,
+            "days": self.days,
+            "destination": self.destination
+        }
+
 # 创建链
 if llm:
-    router_chain = router_template | llm | output_parser
-    bill_chain = bill_template | llm | output_parser
-    route_planner_chain = route_planner_template | llm | output_parser
-    restaurant_planner_chain = restaurant_planner_template | llm | output_parser
-    budget_checker_chain = budget_checker_template | llm | output_parser
-    travel_supervisor_chain = travel_supervisor_template | llm | output_parser
-    mediator_chain = mediator_template | llm | output_parser
-    plan_confirmation_chain = plan_confirmation_template | llm | output_parser
-    fallback_chain = fallback_template | llm | output_parser
-    budget_extractor_chain = budget_extractor_template | llm | output_parser
+    router_chain = router_template | get_chain_llm('router') | output_parser
+    bill_chain = bill_template | get_chain_llm('bill') | output_parser
+    route_planner_chain = route_planner_template | get_chain_llm('route_planner') | output_parser
+    route_section_chain = route_section_template | get_chain_llm('route_section_planner') | output_parser
+    route_skeleton_chain = route_skeleton_template | get_chain_llm('route_skeleton_planner') | output_parser
+    route_day_chain = route_day_template | get_chain_llm('route_day_planner') | output_parser
+    restaurant_planner_chain = restaurant_planner_template | get_chain_llm('restaurant_planner') | output_parser
+    restaurant_day_chain = restaurant_day_template | get_chain_llm('restaurant_day_planner') | output_parser
+    budget_checker_chain = budget_checker_template | get_chain_llm('budget_checker') | output_parser
+    travel_supervisor_chain = travel_supervisor_template | get_chain_llm('travel_supervisor') | output_parser
+    mediator_chain = mediator_template | get_chain_llm('mediator') | output_parser
+    plan_confirmation_chain = plan_confirmation_template | get_chain_llm('plan_confirmation') | output_parser
+    fallback_chain = fallback_template | get_chain_llm('fallback') | output_parser
+    budget_extractor_chain = budget_extractor_template | get_chain_llm('budget_extractor') | output_parser
+    # intake 使用 JSON Schema 结构化输出，直接得到 IntakeResult 对象
+    intake_chain = intake_template | get_chain_llm('intake').with_structured_output(IntakeResult, method="json_schema", strict=True)
 else:
     router_chain = None
     bill_chain = None
     route_planner_chain = None
+    route_section_chain = None
+    route_skeleton_chain = None
+    route_day_chain = None
     restaurant_planner_chain = None
+    restaurant_day_chain = None
     budget_checker_chain = None
     travel_supervisor_chain = None
     mediator_chain = None
     plan_confirmation_chain = None
     fallback_chain = None
     budget_extractor_chain = None
+    intake_chain = None
+
+
+# 规划阶段线程池：用于并发执行相互独立的 LLM 调用（预算提取、各个规划师）
+planner_executor = ThreadPoolExecutor(
+    max_workers=int(os.getenv('PLANNER_MAX_WORKERS', '16')),
+    thread_name_prefix='planner'
+)
+
+
+class PlannerStage:
+    """在后台线程中流式运行一个 chain，流式块通过队列交回请求线程
+
+    depends_on 中的依赖（PlannerStage 或 Future）全部完成后才会提交到线程池，
+    因此等待依赖时不会占用工作线程；build_inputs 在依赖完成后调用，用于读取上游结果。
+    """
+
+    _DONE = object()
+
+    def __init__(self, chain, build_inputs, depends_on=()):
+        self.chain = chain
+        self.build_inputs = build_inputs
+        self.depends_on = list(depends_on)
+        self.text = ""
+        self.error = None
+        self._chunks = queue.Queue()
+        self._done = threading.Event()
+        self._cancelled = threading.Event()
+        self._callbacks = []
+        self._callbacks_lock = threading.Lock()
+        self._chunk_listeners = []
+
+    def start(self):
+        """依赖全部完成后提交到线程池"""
+        remaining = [len(self.depends_on)]
+        remaining_lock = threading.Lock()
+
+        def on_dependency_done(_):
+            with remaining_lock:
+                remaining[0] -= 1
+                ready = remaining[0] == 0
+            if ready:
+                self._submit()
+
+        if not self.depends_on:
+            self._submit()
+        for dependency in self.depends_on:
+            dependency.add_done_callback(on_dependency_done)
+        return self
+
+    def _submit(self):
+        if self._cancelled.is_set():
+            self._finish()
+            return
+        try:
+            planner_executor.submit(self._run)
+        except RuntimeError as e:
+            # 线程池已关闭（进程退出中）
+            self.error = e
+            self._finish()
 
-
-def extract_json_from_text(text):
-    """从文本中提取 JSON 内容"""
-    # 尝试找到 JSON 对象
-    json_match = re.search(r'\{.*?\}', text, re.DOTALL)
-    if json_match:
+    def _run(self):
         try:
-            return json.loads(json_match.group())
-        except:
-            pass
+            for dependency in self.depends_on:
+                dependency.result()  # 上游失败时直接传播异常
+            chunks = self._stream_chunks(self.build_inputs())
+            for chunk in chunks:
+                if self._cancelled.is_set():
+                    chunks.close()
+                    break
+                if chunk:
+                    with self._callbacks_lock:
+                        self.text += chunk
+                        listeners = list(self._chunk_listeners)
+                    self._chunks.put(chunk)
+                    for listener in listeners:
+                        listener(chunk)
+        except Exception as e:
+            self.error = e
+        finally:
+            self._finish()
+
+    def _stream_chunks(self, inputs):
+        return self.chain.stream(inputs)
+
+    def _finish(self):
+        self._chunks.put(self._DONE)
+        self._done.set()
+        with self._callbacks_lock:
+            callbacks, self._callbacks = self._callbacks, []
+        for callback in callbacks:
+            callback(self)
+
+    def add_done_callback(self, fn):
+        """与 concurrent.futures.Future 接口一致，完成（或失败、取消）时回调"""
+        with self._callbacks_lock:
+            if not self._done.is_set():
+                self._callbacks.append(fn)
+                return
+        fn(self)
+
+    def add_chunk_listener(self, fn):
+        """每产出一个块时回调 fn(chunk)；注册时先用已产出的全部文本回调一次，之后逐块回调"""
+        with self._callbacks_lock:
+            self._chunk_listeners.append(fn)
+            if self.text:
+                fn(self.text)
+
+    def cancel(self):
+        """取消阶段：尚未开始的不再提交，正在运行的在下一个块处停止"""
+        self._cancelled.set()
+
+    def result(self):
+        """阻塞直到阶段完成，返回完整输出文本"""
+        self._done.wait()
+        if self.error:
+            raise self.error
+        if self._cancelled.is_set():
+            raise RuntimeError("planner stage cancelled")
+        return self.text
+
+    def iter_chunks(self):
+        """按到达顺序逐块产出输出（只能消费一次）"""
+        while True:
+            chunk = self._chunks.get()
+            if chunk is self._DONE:
+                break
+            yield chunk
+        if self.error:
+            raise self.error
+
+
+# 并行路线规划：天数超过阈值时先生成骨架，再在有界线程池中并发生成每一天，按天顺序输出
+ROUTE_PARALLEL = os.getenv('ROUTE_PARALLEL', 'true').lower() == 'true'
+ROUTE_PARALLEL_MIN_DAYS = int(os.getenv('ROUTE_PARALLEL_MIN_DAYS', '4'))
+route_day_executor = ThreadPoolExecutor(
+    max_workers=int(os.getenv('ROUTE_PARALLEL_WORKERS', '4')),
+    thread_name_prefix='route-day'
+)
+
+
+def stream_route_plan(inputs, days):
+    """流式生成路线计划：days 达到 ROUTE_PARALLEL_MIN_DAYS 时使用并行模式，否则一次生成"""
+    if ROUTE_PARALLEL and days and days >= ROUTE_PARALLEL_MIN_DAYS and route_skeleton_chain and route_day_chain:
+        return stream_parallel_route_plan(inputs, days)
+    return route_planner_chain.stream(inputs)
+
+
+def stream_parallel_route_plan(inputs, days):
+    """先生成逐天骨架，再并发生成每一天；输出按第 1 天、第 2 天……的顺序转发
+
+    骨架中解析不出至少两天时退回一次生成整个计划。
+    """
+    skeleton = route_skeleton_chain.invoke(dict(inputs, days=days))
+    lines = skeleton.strip().splitlines()
+    day_lines = [line.strip() for line in lines if route_day_number(line) is not None]
+    if len(day_lines) < 2:
+        print("路线骨架解析失败，退回一次生成整个计划")
+        yield from route_planner_chain.stream(inputs)
+        return
+    print(f"并行生成路线计划: {len(day_lines)} 天")
     
-    # 如果没找到对象，尝试找数组
-    json_match = re.search(r'\[.*?\]', text, re.DOTALL)
-    if json_match:
+    first_day_index = next(i for i, line in enumerate(lines) if route_day_number(line) is not None)
+    title, *overview = [line.strip() for line in lines[:first_day_index] if line.strip()] or ["Travel Plan"]
+    intro = f"# {title.lstrip('# ')}\n\n" + ("\n".join(overview) + "\n\n" if overview else "")
+    yield intro
+    
+    cancelled = threading.Event()
+    outputs = []
+    
+    def plan_day(day_line, output):
+        heading = day_line.split('|')[0].strip()
         try:
-            return json.loads(json_match.group())
-        except:
-            pass
+            if cancelled.is_set():
+                return
+            chunks = route_day_chain.stream({
+                "skeleton": skeleton,
+                "budget_constraint": inputs.get("budget_constraint", ""),
+                "user_input": inputs.get("user_input", ""),
+                "day_outline": day_line,
+                "day_heading": heading
+            })
+            for chunk in with_day_heading(chunks, f"## {heading}"):
+                output.put(chunk)
+                if cancelled.is_set():
+                    chunks.close()
+                    return
+        except Exception as e:
+            output.put(e)
+        finally:
+            output.put(PlannerStage._DONE)
+    
+    try:
+        for day_line in day_lines:
+            output = queue.Queue()
+            outputs.append(output)
+            route_day_executor.submit(plan_day, day_line, output)
+        
+        for output in outputs:
+            day_text = ""
+            while True:
+                chunk = output.get()
+                if chunk is PlannerStage._DONE:
+                    break
+                if isinstance(chunk, Exception):
+                    raise chunk
+                day_text += chunk
+                yield chunk
+            if not day_text.endswith("\n\n"):
+                yield "\n" if day_text.endswith("\n") else "\n\n"
+    finally:
+        # 调用方停止或出错时，尚未开始的天不再生成，正在生成的在下一个块处停止
+        cancelled.set()
+
+
+class RoutePlanStage(PlannerStage):
+    """路线规划阶段：依赖完成后按 get_days() 的天数决定是否使用并行模式"""
+
+    def __init__(self, build_inputs, get_days, depends_on=()):
+        super().__init__(route_planner_chain, build_inputs, depends_on)
+        self.get_days = get_days
+
+    def _stream_chunks(self, inputs):
+        return stream_route_plan(inputs, self.get_days())
+
+
+# 饭店规划流水线：路线规划每完成一天就开始为这一天推荐餐厅，而不是等整个路线计划完成
+RESTAURANT_PIPELINE = os.getenv('RESTAURANT_PIPELINE', 'true').lower() == 'true'
+restaurant_day_executor = ThreadPoolExecutor(
+    max_workers=int(os.getenv('RESTAURANT_PIPELINE_WORKERS', '4')),
+    thread_name_prefix='restaurant-day'
+)
+
+
+class DayRestaurantStage(PlannerStage):
+    """逐天饭店规划阶段
+
+    监听路线阶段的流式输出，每检测到完整的一天就提交这一天的餐厅推荐任务；
+    输出按天的顺序转发，合并后即为 restaurant_plan。路线计划没有按天分段时，
+    退回在路线完成后对整个计划调用一次 restaurant_planner_chain。
+    """
+
+    _ROUTE_DONE = object()
+
+    def __init__(self, route_stage, user_input):
+        super().__init__(restaurant_planner_chain, lambda: {"user_input": user_input})
+        self.route_stage = route_stage
+        self.user_input = user_input
+        self._splitter = RouteSectionSplitter()
+        self._days = queue.Queue()  # 每一天的输出队列，路线结束时放入 _ROUTE_DONE
+        self._day_count = 0
+        self._submitted = False
+
+    def start(self):
+        # 路线产出第一天（或结束）之前不提交到线程池，避免等待路线时占用工作线程
+        self.route_stage.add_chunk_listener(self._on_route_chunk)
+        self.route_stage.add_done_callback(self._on_route_done)
+        return self
+
+    def _submit_once(self):
+        if not self._submitted:
+            self._submitted = True
+            self._submit()
+
+    def _on_route_chunk(self, chunk):
+        for section in self._splitter.feed(chunk):
+            self._start_day(section)
+
+    def _on_route_done(self, route_stage):
+        if not route_stage.error and not route_stage._cancelled.is_set():
+            for section in self._splitter.finish():
+                self._start_day(section)
+        self._days.put(self._ROUTE_DONE)
+        self._submit_once()
+
+    def _start_day(self, section):
+        if section['day'] is None:
+            return
+        self._submit_once()
+        output = queue.Queue()
+        self._day_count += 1
+        self._days.put(output)
+        try:
+            restaurant_day_executor.submit(self._plan_day, section, output)
+        except RuntimeError as e:
+            output.put(e)
+            output.put(self._DONE)
+
+    def _plan_day(self, section, output):
+        try:
+            if self._cancelled.is_set():
+                return
+            chunks = restaurant_day_chain.stream({
+                "day_plan": section['text'],
+                "day_heading": re.sub(r'^[#*_\s]+|[*_\s]+$', '', section['title']),
+                "user_input": self.user_input
+            })
+            for chunk in chunks:
+                output.put(chunk)
+                if self._cancelled.is_set():
+                    chunks.close()
+                    return
+        except Exception as e:
+            output.put(e)
+        finally:
+            output.put(self._DONE)
+
+    def _stream_chunks(self, inputs):
+        while True:
+            output = self._days.get()
+            if output is self._ROUTE_DONE:
+                break
+            day_text = ""
+            while True:
+                chunk = output.get()
+                if chunk is self._DONE:
+                    break
+                if isinstance(chunk, Exception):
+                    raise chunk
+                day_text += chunk
+                yield chunk
+            if not day_text.endswith("\n\n"):
+                yield "\n" if day_text.endswith("\n") else "\n\n"
+        
+        route_plan = self.route_stage.result()  # 路线失败或取消时传播异常
+        if self._day_count == 0:
+            yield from self.chain.stream(dict(inputs, route_plan=route_plan))
+
+
+class BudgetCheckStage(PlannerStage):
+    """预算检查阶段：输出 check_budget 的结果（JSON 文本，可用 parse_budget_check_result 解析）"""
+
+    def _stream_chunks(self, inputs):
+        yield json.dumps(check_budget(**inputs))
+
+
+def start_restaurant_stage(route_stage, user_input):
+    """启动饭店规划阶段：默认逐天流水线，RESTAURANT_PIPELINE=false 时等整个路线计划完成后一次生成"""
+    if RESTAURANT_PIPELINE and restaurant_day_chain:
+        return DayRestaurantStage(route_stage, user_input).start()
+    return PlannerStage(restaurant_planner_chain, lambda: {
+        "user_input": user_input,
+        "route_plan": route_stage.result()
+    }, depends_on=[route_stage]).start()
+
+
+def stream_planner_stage(planner_name, stage, cost_tally=None):
+    """把一个 PlannerStage 的输出包装成 planner_start/planner_chunk/planner_complete 事件
+
+    给出 cost_tally 时逐块累计已生成的费用，超出预算时取消阶段并返回 False，否则返回 True。
+    """
+    yield f"data: {json.dumps({'type': 'planner_start', 'planner': planner_name})}\n\n"
+    within_budget = yield from forward_planner_chunks(planner_name, stage, cost_tally)
+    yield f"data: {json.dumps({'type': 'planner_complete', 'planner': planner_name})}\n\n"
+    return within_budget
+
+
+# 费用累计时各规划师输出的计划类型（决定哪些汇总行算作分类小计），未列出的按路线计划处理
+PLANNER_COST_KINDS = {"🍽️ Restaurant Planner": "restaurant"}
+
+
+def forward_planner_chunks(planner_name, stage, cost_tally=None):
+    """逐块转发阶段输出；累计费用超出预算时取消阶段并返回 False"""
+    kind = PLANNER_COST_KINDS.get(planner_name, "route")
+    for chunk in stage.iter_chunks():
+        yield f"data: {json.dumps({'type': 'planner_chunk', 'planner': planner_name, 'content': chunk})}\n\n"
+        if cost_tally and cost_tally.feed(planner_name, chunk, kind).over_budget():
+            stage.cancel()
+            return False
+    return True
+
+
+_json_decoder = json.JSONDecoder()
+JSON_START_PATTERN = re.compile(r'[\[{]')
+
+
+def extract_json_from_text(text):
+    """从文本中提取第一个完整的 JSON 对象或数组（支持嵌套结构，忽略前后的说明文字）"""
+    if not text:
+        return None
+    start = JSON_START_PATTERN.search(text)
+    while start:
+        try:
+            return _json_decoder.raw_decode(text, start.start())[0]
+        except ValueError:
+            start = JSON_START_PATTERN.search(text, start.start() + 1)
     
     # 如果都没找到，尝试解析整个文本
     try:
         return json.loads(text)
-    except:
+    except ValueError:
         return None
 
 
-def parse_router_response(text):
-    """解析路由响应，提取agent类型"""
+class IncrementalJSONParser:
+    """增量解析流式输出中的第一个 JSON 对象
+
+    每次 feed 只扫描新到的字符（跟踪字符串、转义和嵌套深度），
+    顶层出现逗号或对象结束时解析已完整的前缀，fields 中即为已经完整的顶层字段，
+    调用方拿到决定性字段（如 agent / intent）后就可以停止生成。
+    """
+
+    def __init__(self):
+        self.text = ""
+        self.fields = {}
+        self.done = False
+        self._pos = 0
+        self._start = None  # 当前 JSON 对象 '{' 的位置
+        self._depth = 0
+        self._in_string = False
+        self._escape = False
+
+    def feed(self, chunk):
+        self.text += chunk
+        text = self.text
+        for i in range(self._pos, len(text)):
+            if self.done:
+                break
+            c = text[i]
+            if self._in_string:
+                if self._escape:
+                    self._escape = False
+                elif c == '\\':
+                    self._escape = True
+                elif c == '"':
+                    self._in_string = False
+            elif self._start is None:
+                if c == '{':
+                    self._start = i
+                    self._depth = 1
+            elif c == '"':
+                self._in_string = True
+            elif c in '{[':
+                self._depth += 1
+            elif c in '}]':
+                self._depth -= 1
+                if self._depth == 0:
+                    self._close(i + 1)
+            elif c == ',' and self._depth == 1:
+                self._parse_prefix(text[self._start:i] + '}')
+        self._pos = len(text)
+        return self.fields
+
+    def _parse_prefix(self, candidate):
+        try:
+            result = json.loads(candidate)
+        except ValueError:
+            return
+        if isinstance(result, dict):
+            self.fields = result
+
+    def _close(self, end):
+        try:
+            result = json.loads(self.text[self._start:end])
+        except ValueError:
+            result = None
+        if isinstance(result, dict):
+            self.fields = result
+            self.done = True
+        else:
+            # 不是合法 JSON（例如说明文字中的花括号），继续寻找下一个对象
+            self.fields = {}
+            self._start = None
+
+
+# 结构化输出统计：提前停止生成的次数和解析失败次数
+json_stream_stats = {'calls': 0, 'early_stops': 0, 'parse_failures': 0}
+json_stream_stats_lock = threading.Lock()
+
+
+def stream_json_field(chain, inputs, key):
+    """流式调用输出 JSON 的链，key 字段完整后立即停止生成（关闭流会取消上游请求）
+
+    返回 (解析出的 dict 或 None, 已收到的原始文本)
+    """
+    parser = IncrementalJSONParser()
+    stream = chain.stream(inputs)
+    early_stop = False
+    try:
+        for chunk in stream:
+            if chunk:
+                parser.feed(chunk)
+                if key in parser.fields:
+                    early_stop = not parser.done
+                    break
+    finally:
+        stream.close()
+    
+    result = parser.fields if key in parser.fields else extract_json_from_text(parser.text)
+    if not isinstance(result, dict) or key not in result:
+        print(f"警告: 无法从输出中解析 {key} 字段: {parser.text[:200]!r}")
+        result = result if isinstance(result, dict) else None
+    with json_stream_stats_lock:
+        json_stream_stats['calls'] += 1
+        json_stream_stats['early_stops'] += early_stop
+        json_stream_stats['parse_failures'] += result is None or key not in result
+    return result, parser.text
+
+
+def normalize_classifier_input(text):
+    """分类缓存的键：忽略大小写、多余空白和首尾标点（"Yes!" 与 "yes" 命中同一条缓存）"""
+    return re.sub(r'\s+', ' ', text.strip().lower()).strip(' .,!?;:。，！？；：~')
+
+
+class ClassificationCache:
+    """分类结果缓存（LRU + TTL）
+
+    用于 router_chain / travel_supervisor_chain 这类输出只取决于短输入（和少量状态）的分类调用，
+    "yes"、"ok"、"show my bills" 之类重复出现的输入不再重复请求 LLM。
+    """
+
+    def __init__(self, name, maxsize=1024, ttl=3600, enabled=True, max_input_length=256):
+        self.name = name
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.enabled = enabled
+        self.max_input_length = max_input_length
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()  # {key: (值, 过期时间)}
+        self._lock = threading.Lock()
+
+    def key(self, user_input, *state):
+        """生成缓存键；输入过长（几乎不会重复）时返回 None，表示不使用缓存"""
+        if not self.enabled or len(user_input) > self.max_input_length:
+            return None
+        return (normalize_classifier_input(user_input),) + state
+
+    def get(self, key):
+        if key is None:
+            return None
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[1] < time.time():
+                if entry is not None:
+                    del self._entries[key]
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key, value):
+        if key is None:
+            return
+        with self._lock:
+            self._entries[key] = (value, time.time() + self.ttl)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def stats(self):
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                'enabled': self.enabled,
+                'size': len(self._entries),
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': round(self.hits / total, 4) if total else 0.0,
+            }
+
+
+# 分类结果缓存：CLASSIFIER_CACHE=false 关闭
+CLASSIFIER_CACHE_ENABLED = os.getenv('CLASSIFIER_CACHE', 'true').lower() == 'true'
+CLASSIFIER_CACHE_SIZE = int(os.getenv('CLASSIFIER_CACHE_SIZE', '1024'))
+CLASSIFIER_CACHE_TTL = float(os.getenv('CLASSIFIER_CACHE_TTL', '3600'))
+router_cache = ClassificationCache('router', CLASSIFIER_CACHE_SIZE, CLASSIFIER_CACHE_TTL, CLASSIFIER_CACHE_ENABLED)
+supervisor_cache = ClassificationCache('travel_supervisor', CLASSIFIER_CACHE_SIZE, CLASSIFIER_CACHE_TTL, CLASSIFIER_CACHE_ENABLED)
+
+
+class LocalIntentRouter:
+    """本地关键词/正则路由：对把握较大的输入直接给出 agent，不再调用 router_chain
+
+    规则与 ROUTER_PROMPT 一致：只有明确涉及账单记录/查询/分摊时才是 bill，其余默认 travel。
+    同时出现账单和旅行线索（例如 "split the hotel cost"）或只有弱账单线索时置信度低，交给 LLM 判断。
+    随机抽取 audit_rate 比例的本地判断在后台用 LLM 复核，用于统计准确率。
+    """
+
+    BILL_PATTERNS = [
+        r'\bbills?\b', r'\bAA\b', r'\bsplit(s|ting)?\b', r'\bexpense records?\b', r'\bbookkeeping\b',
+        r'\bcost[- ]shar(e|ing)\b', r'\bshare (the )?costs?\b', r'账单', r'记账', r'AA制', r'分摊', r'平摊', r'均摊',
+    ]
+    WEAK_BILL_PATTERNS = [
+        r'\bpaid\b', r'\bpay(s|ing)?\b', r'\bowes?\b', r'\breimburse', r'\bexpenses?\b', r'付款', r'付了', r'报销',
+    ]
+    TRAVEL_PATTERNS = [
+        r'\btrips?\b', r'\btravel', r'\bitinerar', r'\bhotels?\b', r'\brestaurants?\b', r'\broutes?\b',
+        r'\bplans?\b', r'\bdays?\b', r'\bvisit', r'\bflights?\b', r'\btours?\b', r'\bbudget', r'\bdestination',
+        r'\battraction', r'\bvacation', r'\bholiday', r'旅行', r'旅游', r'行程', r'酒店', r'餐厅', r'路线', r'计划',
+        r'预算', r'景点', r'机票', r'出发',
+    ]
+
+    def __init__(self, threshold=0.8, audit_rate=0.02, enabled=True):
+        self.threshold = threshold
+        self.audit_rate = audit_rate
+        self.enabled = enabled
+        self.total = 0
+        self.fast_path_hits = 0
+        self.audited = 0
+        self.audit_agreements = 0
+        self.fallback_compared = 0
+        self.fallback_agreements = 0
+        self._bill = re.compile('|'.join(self.BILL_PATTERNS), re.IGNORECASE)
+        self._weak_bill = re.compile('|'.join(self.WEAK_BILL_PATTERNS), re.IGNORECASE)
+        self._travel = re.compile('|'.join(self.TRAVEL_PATTERNS), re.IGNORECASE)
+        self._lock = threading.Lock()
+
+    def classify(self, user_input):
+        """返回 (agent, 置信度)"""
+        has_bill = bool(self._bill.search(user_input))
+        has_weak_bill = bool(self._weak_bill.search(user_input))
+        has_travel = bool(self._travel.search(user_input))
+        if has_bill:
+            return ('bill', 0.5) if has_travel else ('bill', 0.95)
+        if has_weak_bill:
+            return ('travel', 0.5) if has_travel else ('bill', 0.4)
+        # 没有任何账单线索：ROUTER_PROMPT 的默认规则是 travel
+        return ('travel', 0.95) if has_travel else ('travel', 0.85)
+
+    def route(self, user_input):
+        """本地判断足够确定时返回 agent，否则返回 None（调用方应使用 LLM 路由）"""
+        if not self.enabled:
+            return None
+        agent, confidence = self.classify(user_input)
+        with self._lock:
+            self.total += 1
+            if confidence < self.threshold:
+                return None
+            self.fast_path_hits += 1
+        if self.audit_rate > 0 and random.random() < self.audit_rate:
+            planner_executor.submit(self._audit, user_input, agent)
+        return agent
+
+    def record_fallback(self, user_input, llm_agent):
+        """记录交给 LLM 的输入：本地的低置信度判断与 LLM 结果是否一致（用于调整阈值）"""
+        if not self.enabled:
+            return
+        agent, _ = self.classify(user_input)
+        with self._lock:
+            self.fallback_compared += 1
+            if agent == llm_agent:
+                self.fallback_agreements += 1
+
+    def _audit(self, user_input, agent):
+        """后台用 LLM 复核一次本地判断"""
+        try:
+            llm_agent = parse_router_response(stream_json_field(router_chain, {"user_input": user_input}, 'agent')[0])
+        except Exception as e:
+            print(f"本地路由复核失败: {e}")
+            return
+        with self._lock:
+            self.audited += 1
+            if llm_agent == agent:
+                self.audit_agreements += 1
+            else:
+                print(f"本地路由与 LLM 不一致: {user_input[:80]!r} 本地={agent} LLM={llm_agent}")
+
+    def stats(self):
+        with self._lock:
+            return {
+                'enabled': self.enabled,
+                'threshold': self.threshold,
+                'total': self.total,
+                'fast_path_hits': self.fast_path_hits,
+                'hit_rate': round(self.fast_path_hits / self.total, 4) if self.total else 0.0,
+                'audited': self.audited,
+                'accuracy': round(self.audit_agreements / self.audited, 4) if self.audited else None,
+                'fallback_agreement': round(self.fallback_agreements / self.fallback_compared, 4) if self.fallback_compared else None,
+            }
+
+
+# 本地快速路由：ROUTER_FAST_PATH=false 关闭；置信度低于阈值时仍调用 LLM
+local_intent_router = LocalIntentRouter(
+    threshold=float(os.getenv('ROUTER_FAST_PATH_THRESHOLD', '0.8')),
+    audit_rate=float(os.getenv('ROUTER_FAST_PATH_AUDIT_RATE', '0.02')),
+    enabled=os.getenv('ROUTER_FAST_PATH', 'true').lower() == 'true'
+)
+
+
+def parse_router_response(result):
+    """解析路由响应（已解析的 dict 或原始文本），提取agent类型"""
     try:
-        result = extract_json_from_text(text)
+        if isinstance(result, str):
+            result = extract_json_from_text(result)
         if result and isinstance(result, dict):
             agent = result.get('agent', 'unknown')
             if agent in ['travel', 'bill', 'unknown']:
@@ -746,20 +1925,91 @@ def format_bills_for_display(bills):
     return "\n\n".join(result)
 
 
+_BUDGET_NUMBER = r'(\d{1,3}(?:,\d{3})+(?:\.\d+)?|\d+(?:\.\d+)?)\s*(k|千|万)?'
+_BUDGET_RANGE = _BUDGET_NUMBER + r'(?:\s*(?:-|–|~|to)\s*[$€£¥￥]?\s*' + _BUDGET_NUMBER + r')?'
+_BUDGET_CURRENCY_WORDS = r'(?:usd|us dollars?|dollars?|bucks|eur|euros?|gbp|pounds?|quid|cny|rmb|yuan|jpy|yen|hkd|twd|krw|won|aud|cad|sgd|thb|baht|元|块|美元|欧元|英镑|日元)'
+BUDGET_AMOUNT_PATTERNS = [
+    # 货币符号在前："$2000"、"€1.5k"、"$1500-2000"
+    re.compile(r'[$€£¥￥]\s*' + _BUDGET_RANGE, re.IGNORECASE),
+    # 货币代码/单位在后："1500 USD"、"3k euros"、"5000元"
+    re.compile(_BUDGET_RANGE + r'\s*' + _BUDGET_CURRENCY_WORDS + r'(?![a-z])', re.IGNORECASE),
+    # 预算关键词后的数字："budget of 1500"、"change budget to 2k"、"预算5000"
+    re.compile(r'(?:budget|预算)\s*(?:is|of|to|at|about|around|:|：|=|为|是|大概|约)?\s*(?:[a-z]{3}\s*)?[$€£¥￥]?\s*' + _BUDGET_RANGE, re.IGNORECASE),
+]
+# 与预算无关的数字：天数、人数、星级等
+BUDGET_NON_MONEY_PATTERN = re.compile(
+    r'\d+(?:\.\d+)?\s*(?:-|to)?\s*\d*\s*(?:-?\s*(?:days?|nights?|people|persons?|pax|adults?|kids?|children|travell?ers|guests?|stars?|weeks?|hours?|years?|of us)\b|天|晚|夜|人|周|星)'
+    r'|\b(?:day|night|week)\s*\d+',
+    re.IGNORECASE
+)
+BUDGET_PER_PERSON_PATTERN = re.compile(r'^\s*(?:per (?:person|head|pax)|each|pp\b|/\s*person|a head)|人均|每人', re.IGNORECASE)
+BUDGET_GROUP_SIZE_PATTERN = re.compile(r'(\d+)\s*(?:people|persons|adults|travell?ers|of us|人)', re.IGNORECASE)
+
+# 预算提取各路径的计数：no_numbers（没有数字）、parsed（本地解析出金额）、no_budget（只有天数等无关数字）、llm（交给 LLM）
+budget_extraction_stats = {"no_numbers": 0, "parsed": 0, "no_budget": 0, "llm": 0}
+budget_extraction_stats_lock = threading.Lock()
+
+
+def _parse_budget_number(number, suffix):
+    value = float(number.replace(',', ''))
+    multiplier = {'k': 1000, '千': 1000, '万': 10000}.get((suffix or '').lower(), 1)
+    return value * multiplier
+
+
+def parse_budget_locally(user_input):
+    """不调用 LLM 解析预算，返回 (路径, 预算)
+
+    路径为 no_numbers / parsed / no_budget 时结果已确定；为 ambiguous 时应交给 LLM。
+    区间取上限（"$1500-2000" -> 2000）；人均金额在给出人数时乘以人数。
+    """
+    if not re.search(r'\d', user_input):
+        return 'no_numbers', None
+    
+    amounts = []
+    remaining = user_input
+    for pattern in BUDGET_AMOUNT_PATTERNS:
+        for match in pattern.finditer(user_input):
+            low_number, low_suffix, high_number, high_suffix = match.groups()
+            if high_number:
+                # "1.5-2k" 这类区间的单位写在上限后面
+                amount = _parse_budget_number(high_number, high_suffix)
+            else:
+                amount = _parse_budget_number(low_number, low_suffix)
+            if BUDGET_PER_PERSON_PATTERN.search(user_input[match.end():match.end() + 12]) or re.search(r'(?:人均|每人)\s*$', user_input[:match.start()]):
+                group_size = BUDGET_GROUP_SIZE_PATTERN.search(user_input)
+                if group_size:
+                    amount *= int(group_size.group(1))
+            amounts.append(amount)
+        remaining = pattern.sub(' ', remaining)
+    
+    distinct_amounts = set(amounts)
+    if len(distinct_amounts) > 1:
+        return 'ambiguous', None
+    
+    remaining = BUDGET_NON_MONEY_PATTERN.sub(' ', remaining)
+    if re.search(r'\d', remaining):
+        # 还有无法解释的数字（例如 "I have 2000 for Paris"）
+        return 'ambiguous', None
+    if distinct_amounts:
+        return 'parsed', amounts[0]
+    return 'no_budget', None
+
+
 def extract_budget_with_agent(user_input):
-    """使用 AI agent 从用户输入中提取预算"""
+    """从用户输入中提取预算：先用本地规则解析，只有无法确定时才调用 AI agent"""
+    path, budget = parse_budget_locally(user_input)
+    with budget_extraction_stats_lock:
+        budget_extraction_stats[path if path != 'ambiguous' else 'llm'] += 1
+    if path != 'ambiguous':
+        return budget
+    
     if not llm or not budget_extractor_chain:
         return None
     
     try:
         # 调用预算提取 agent
-        response = ""
-        for chunk in budget_extractor_chain.stream({"user_input": user_input}):
-            if chunk:
-                response += chunk
-        
-        # 解析 JSON 响应
-        budget_result = extract_json_from_text(response)
+        # budget 之后的 found 字段才能确认结果，因此以 found 为决定性字段
+        budget_result, _ = stream_json_field(budget_extractor_chain, {"user_input": user_input}, 'found')
         if budget_result and isinstance(budget_result, dict):
             if budget_result.get("found", False):
                 budget_value = budget_result.get("budget")
@@ -819,6 +2069,32 @@ def extract_travel_info(user_input):
     }
 
 
+def supervisor_context(state):
+    """传给 Supervisor / intake 提示词的会话状态：过短的计划视为不存在，计划只截取前500字符（避免token过多）"""
+    route_plan = state.get("route_plan", "")
+    restaurant_plan = state.get("restaurant_plan", "")
+    budget = state.get("budget")
+    return {
+        "previous_route_plan": route_plan[:500] if route_plan and len(route_plan.strip()) >= 10 else "None",
+        "previous_restaurant_plan": restaurant_plan[:500] if restaurant_plan and len(restaurant_plan.strip()) >= 10 else "None",
+        "previous_budget": str(budget) if budget else "None",
+        "awaiting_replan_confirmation": "true" if state.get("awaiting_replan_confirmation", False) else "false"
+    }
+
+
+# 融合 intake：INTAKE_MODE=fused 时用一次结构化输出调用代替 路由 + Supervisor + 预算提取 三次调用
+INTAKE_MODE = os.getenv('INTAKE_MODE', 'separate')
+
+
+def run_intake(user_message, state):
+    """调用融合 intake，返回 IntakeResult；失败时返回 None（调用方退回到分步调用）"""
+    try:
+        return intake_chain.invoke(dict(supervisor_context(state), user_input=user_message))
+    except Exception as e:
+        print(f"intake 调用失败，改用分步路由: {e}")
+        return None
+
+
 def parse_budget_check_result(budget_check_response):
     """解析预算检查结果"""
     # 从JSON响应中提取预算检查结果
@@ -829,6 +2105,11 @@ def parse_budget_check_result(budget_check_response):
         "success": True,
         "budget_ok": None,
         "is_feasible": True,
+        "currency": None,
+        "max_budget": None,
+        "total_estimated_cost": None,
+        "remaining_budget": None,
+        "error_type": "NONE",
         "reason": "",
         "suggestion": ""
     }
@@ -837,10 +2118,11 @@ def parse_budget_check_result(budget_check_response):
         # 成功解析JSON（使用新的格式）
         result["budget_ok"] = budget_check_result.get('budget_ok', None)
         result["is_feasible"] = budget_check_result.get('is_feasible', True)
-        total_estimated_cost = budget_check_result.get('total_estimated_cost', 0)
-        max_budget = budget_check_result.get('max_budget', None)
-        remaining_budget = budget_check_result.get('remaining_budget', 0)
-        error_type = budget_check_result.get('error_type', 'NONE')
+        result["currency"] = budget_check_result.get('currency', None)
+        result["total_estimated_cost"] = budget_check_result.get('total_estimated_cost', 0)
+        result["max_budget"] = budget_check_result.get('max_budget', None)
+        result["remaining_budget"] = budget_check_result.get('remaining_budget', 0)
+        result["error_type"] = budget_check_result.get('error_type', 'NONE')
         result["reason"] = budget_check_result.get('reason', '')
         result["suggestion"] = budget_check_result.get('suggestion', '')
     else:
@@ -852,9 +2134,95 @@ def parse_budget_check_result(budget_check_response):
     return result
 
 
+# 预算检查：local 先从计划中的价格本地估算，置信度低时才调用预算检查 LLM；llm 总是调用 LLM
+BUDGET_CHECK_MODE = os.getenv('BUDGET_CHECK_MODE', 'local').lower()
+BUDGET_CHECK_MIN_CONFIDENCE = float(os.getenv('BUDGET_CHECK_MIN_CONFIDENCE', '0.6'))
+budget_check_stats = {"local": 0, "llm": 0, "stopped_early": 0}
+budget_check_stats_lock = threading.Lock()
+
+
+# 流式费用累计：生成过程中已写出的费用超出预算的比例大于 BUDGET_GUARD_MARGIN 时停止生成，直接询问是否重新规划
+BUDGET_GUARD = os.getenv('BUDGET_GUARD', 'true').lower() == 'true'
+BUDGET_GUARD_MARGIN = float(os.getenv('BUDGET_GUARD_MARGIN', '0.2'))
+
+
+def start_cost_tally(budget, budget_currency):
+    """为一次流式规划创建费用累计；未启用、没有预算或预算货币未知时返回 None"""
+    if not BUDGET_GUARD or not budget or not budget_currency:
+        return None
+    try:
+        return RunningCostTally(budget, BUDGET_GUARD_MARGIN, budget_currency)
+    except (TypeError, ValueError):
+        return None
+
+
+def stream_over_budget_alert(session_id, cost_tally, route_plan, restaurant_plan):
+    """规划中途已超出预算：跳过剩余生成和预算检查，直接询问用户是否重新规划"""
+    with budget_check_stats_lock:
+        budget_check_stats["stopped_early"] += 1
+    estimate = format_money(cost_tally.estimate(), cost_tally.budget_currency)
+    budget = format_money(cost_tally.max_budget, cost_tally.budget_currency)
+    print(f"规划中途超出预算，停止生成: 已生成部分约 {estimate}，预算 {budget}")
+    
+    yield f"data: {json.dumps({'type': 'planner_start', 'planner': '⚠️ Budget Alert'})}\n\n"
+    budget_alert = f"\n⚠️ **Budget Check Failed**\n\n"
+    budget_alert += f"Planning was stopped early: the part of the plan generated so far already costs about {estimate}, which is well over your {budget} budget.\n\n"
+    budget_alert += f"**Suggestion:**\nIncrease your budget, or let me create a cheaper plan that fits within {budget}.\n\n"
+    budget_alert += f"\n**Would you like me to replan the route and restaurants to fit your budget?**\n"
+    budget_alert += f"Please reply with 'yes', 'ok', 'replan', or 'replan' if you want me to create a new plan within your budget.\n"
+    yield f"data: {json.dumps({'type': 'planner_chunk', 'planner': '⚠️ Budget Alert', 'content': budget_alert})}\n\n"
+    yield f"data: {json.dumps({'type': 'planner_complete', 'planner': '⚠️ Budget Alert'})}\n\n"
+    
+    # 保存状态，标记正在等待用户确认重新规划（预算一并保存，重新规划时使用）
+    travel_plan_storage[session_id]["awaiting_replan_confirmation"] = True
+    travel_plan_storage[session_id]["route_plan"] = route_plan
+    travel_plan_storage[session_id]["restaurant_plan"] = restaurant_plan
+    travel_plan_storage[session_id]["budget"] = cost_tally.max_budget
+
+
+def session_budget_currency(session_id, user_input, budget):
+    """预算的货币：消息中写明了预算金额的货币时以此为准并记入会话，否则使用会话中记录的货币（都没有时为 None）"""
+    currency = detect_budget_currency(user_input, budget)
+    if session_id is None or session_id not in travel_plan_storage:
+        return currency
+    if currency:
+        travel_plan_storage[session_id]["budget_currency"] = currency
+        return currency
+    return travel_plan_storage[session_id].get("budget_currency")
+
+
+def check_budget(user_budget, user_input, route_plan, restaurant_plan, session_id=None):
+    """预算检查，返回 parse_budget_check_result 格式的结果
+
+    计划里有全程费用汇总、预算货币已知时直接本地计算总费用和剩余预算，否则调用 budget_checker_chain。
+    """
+    if BUDGET_CHECK_MODE == 'local':
+        budget_currency = session_budget_currency(session_id, user_input, user_budget) if user_budget else None
+        result, confidence = estimate_plan_cost(route_plan, restaurant_plan, user_budget, budget_currency)
+        if result is not None and confidence >= BUDGET_CHECK_MIN_CONFIDENCE:
+            with budget_check_stats_lock:
+                budget_check_stats["local"] += 1
+            print(f"本地预算估算: {result['total_estimated_cost']} {result['currency']} (置信度 {confidence})")
+            return result
+    
+    with budget_check_stats_lock:
+        budget_check_stats["llm"] += 1
+    budget_check_response = ""
+    for chunk in budget_checker_chain.stream({
+        "user_budget": str(user_budget) if user_budget else "",
+        "user_input": user_input,
+        "route_plan": route_plan,
+        "restaurant_plan": restaurant_plan
+    }):
+        if chunk:
+            budget_check_response += chunk
+    return parse_budget_check_result(budget_check_response)
+
+
 def get_or_create_user(user_id, session_id=None):
     """获取或创建用户，分配随机名字"""
-    if user_id not in user_storage:
+    user_info = user_storage.get(user_id)
+    if user_info is None:
         # 生成随机名字
         available_names = [name for name in RANDOM_NAMES if name not in [u.get("name") for u in user_storage.values()]]
         if not available_names:
@@ -867,29 +2235,112 @@ def get_or_create_user(user_id, session_id=None):
             "name": name,
             "session_id": session_id
         }
+        user_info = user_storage[user_id]
     
-    return user_storage[user_id]
+    return user_info
 
 
 def get_active_users_count():
     """获取当前活跃用户数量（通过SSE连接判断）"""
-    with sse_connections_lock:
-        return len(sse_connections)
+    return len(get_active_users_list())
 
 
 def get_active_users_list():
-    """获取当前活跃用户列表"""
+    """获取当前活跃用户列表（包括连接在其他 worker 上的用户）"""
     active_users = []
-    with sse_connections_lock:
-        for user_id in sse_connections.keys():
-            if user_id in user_storage:
-                active_users.append({
-                    "user_id": user_id,
-                    "username": user_storage[user_id]["name"]
-                })
+    now = time.time()
+    for user_id, presence in sse_presence.items():
+        if now - presence.get("last_seen", 0) > SSE_PRESENCE_TTL:
+            continue
+        user_info = user_storage.get(user_id)
+        if user_info:
+            active_users.append({
+                "user_id": user_id,
+                "username": user_info["name"]
+            })
     return active_users
 
 
+# 投票关键词：英文按单词匹配（"no" 不会匹配 "know"/"not"，"ok" 不会匹配 "book"），中文按短语匹配
+VOTE_AGREE_WORDS = {"agree", "agreed", "yes", "yeah", "yep", "ok", "okay", "sure", "confirm", "confirmed", "proceed", "approve", "approved"}
+VOTE_DISAGREE_WORDS = {"disagree", "disagreed", "no", "nope", "cancel", "reject", "object"}
+# 单独的 "no" 是反对，但与明确的同意词同时出现时只是附带的（"agreed, no changes please"）
+VOTE_WEAK_DISAGREE_WORDS = {"no"}
+VOTE_NEGATIONS = {"not", "don't", "dont", "doesn't", "won't", "never"}
+VOTE_AGREE_PHRASES = ("no problem", "no worries", "go ahead", "同意", "好的", "确定", "可以")
+# 中文同意短语的否定形式要先于同意短语判断（"不确定" 包含 "确定"，"不可以" 包含 "可以"）
+VOTE_DISAGREE_PHRASES = ("不同意", "反对", "不行", "不可以", "不好", "取消")
+VOTE_UNSURE_PHRASES = ("不确定", "不一定", "不知道", "not sure", "maybe", "unsure")
+
+# 计划确认额外接受的关键词
+CONFIRMATION_AGREE_WORDS = VOTE_AGREE_WORDS | {"finalize", "finalized"}
+CONFIRMATION_DISAGREE_WORDS = VOTE_DISAGREE_WORDS | {"replan", "modify"}
+CONFIRMATION_AGREE_PHRASES = VOTE_AGREE_PHRASES + ("确认计划", "确定方案")
+
+
+def match_vote(text, agree_words=VOTE_AGREE_WORDS, disagree_words=VOTE_DISAGREE_WORDS, agree_phrases=VOTE_AGREE_PHRASES):
+    """判断投票意向：返回 "agree"、"disagree" 或 None（不是明确的投票，交给 LLM 判断）
+
+    否定词后的同意（"don't agree"、"not ok"、"不可以"）视为反对；不确定的表达（"不确定"、"not sure"）
+    以及同意和反对同时出现的消息返回 None。
+    """
+    text_lower = text.lower()
+    if any(phrase in text_lower for phrase in VOTE_UNSURE_PHRASES):
+        return None
+    
+    disagreed = False
+    for phrase in VOTE_DISAGREE_PHRASES:
+        if phrase in text_lower:
+            disagreed = True
+            text_lower = text_lower.replace(phrase, " ")
+    
+    # 先去掉 "no problem" 这类表示同意的短语，避免其中的 "no" 被当作反对
+    agreed = False
+    for phrase in agree_phrases:
+        if phrase in text_lower:
+            agreed = True
+            text_lower = text_lower.replace(phrase, " ")
+    
+    weak_disagreed = False
+    tokens = re.findall(r"[a-z]+(?:'[a-z]+)?", text_lower)
+    for i, token in enumerate(tokens):
+        if token in agree_words:
+            if any(previous in VOTE_NEGATIONS for previous in tokens[max(i - 2, 0):i]):
+                disagreed = True
+            else:
+                agreed = True
+        elif token in VOTE_WEAK_DISAGREE_WORDS:
+            weak_disagreed = True
+        elif token in disagree_words:
+            disagreed = True
+    
+    if agreed and disagreed:
+        return None
+    if agreed:
+        return "agree"
+    if disagreed or weak_disagreed:
+        return "disagree"
+    return None
+
+
+def match_pending_vote(state, user_message):
+    """会话正在等待调解/计划确认投票时，判断消息是否为投票；返回 (投票类型, 投票意向)"""
+    if state.get("awaiting_mediation", False):
+        return "mediation", match_vote(user_message)
+    if state.get("awaiting_confirmation", False):
+        return "confirmation", match_vote(user_message, CONFIRMATION_AGREE_WORDS, CONFIRMATION_DISAGREE_WORDS, CONFIRMATION_AGREE_PHRASES)
+    return None, None
+
+
+def record_vote(session_id, vote_type, user_id, vote):
+    """记录用户投票（原子操作，多个用户同时投票不会互相覆盖）"""
+    def apply(votes):
+        votes = votes or {}
+        votes.setdefault(vote_type + "_votes", {})[user_id] = vote
+        return votes
+    state_store.update('votes', session_id, apply)
+
+
 def check_all_users_agreed(session_id, vote_type="mediation", exclude_user_id=None):
     """检查所有活跃用户是否都同意了（排除指定用户）"""
     if session_id not in vote_storage:
@@ -944,6 +2395,77 @@ def reset_votes(session_id, vote_type="mediation", exclude_user_id=None):
     vote_storage[session_id][vote_type + "_votes"] = votes
 
 
+# 路线分段修改：修改请求只涉及个别几天时只重新生成这几天，再拼接回原计划
+ROUTE_SECTION_REPLAN = os.getenv('ROUTE_SECTION_REPLAN', 'true').lower() == 'true'
+ROUTE_SECTION_REPLAN_MAX_RATIO = float(os.getenv('ROUTE_SECTION_REPLAN_MAX_RATIO', '0.5'))
+
+
+def plan_route_section_update(modification_request, route_plan):
+    """修改请求能对应到个别几天时返回 (分段列表, 受影响的分段 key)，否则返回 None（整体重新规划）"""
+    if not ROUTE_SECTION_REPLAN or not route_section_chain or not route_plan:
+        return None
+    sections = split_route_sections(route_plan)
+    keys = resolve_route_sections(modification_request, sections, ROUTE_SECTION_REPLAN_MAX_RATIO)
+    if not keys:
+        return None
+    print(f"分段修改路线: {keys}")
+    return sections, keys
+
+
+def _stream_route_section(planner_name, section, inputs):
+    """流式重写一个分段，产出 planner_chunk 事件，返回重写后的分段文本
+
+    模型没有输出天标题时补上原标题，保证拼接后仍能按天分段。
+    """
+    text = ""
+    chunks = route_section_chain.stream(inputs)
+    if section['day'] is not None:
+        chunks = with_day_heading(chunks, section['text'].splitlines()[0])
+    for chunk in chunks:
+        if chunk:
+            text += chunk
+            yield f"data: {json.dumps({'type': 'planner_chunk', 'planner': planner_name, 'content': chunk})}\n\n"
+    
+    # 保持原分段结尾的空行，拼接后格式不变
+    trailing = section['text'][len(section['text'].rstrip()):] or "\n"
+    final_text = text.rstrip() + trailing
+    if final_text.startswith(text) and len(final_text) > len(text):
+        yield f"data: {json.dumps({'type': 'planner_chunk', 'planner': planner_name, 'content': final_text[len(text):]})}\n\n"
+    return final_text
+
+
+def stream_route_section_update(planner_name, sections, keys, modification_request, budget_constraint_text):
+    """只重新生成受影响的天（以及费用汇总）并拼接回原计划，未改动的分段原样输出，返回新的完整路线计划"""
+    overview = next((section['text'] for section in sections if section['key'] == 'overview'), '')
+    outline = "\n".join(section['title'] for section in sections if section['title'])
+    changes = []
+    new_texts = []
+    for section in sections:
+        regenerate = section['key'] in keys or (section['key'] == 'summary' and changes)
+        if not regenerate:
+            new_texts.append(section['text'])
+            yield f"data: {json.dumps({'type': 'planner_chunk', 'planner': planner_name, 'content': section['text']})}\n\n"
+            continue
+        
+        context = ""
+        if section['key'] == 'summary':
+            context = "These days were just changed; update the totals and any affected lines in this section accordingly:\n"
+            context += "\n".join(f"--- Before ---\n{old}\n--- After ---\n{new}" for old, new in changes)
+        text = yield from _stream_route_section(planner_name, section, {
+            "overview": overview[:1500] or "(none)",
+            "outline": outline,
+            "budget_constraint": budget_constraint_text,
+            "section": section['text'],
+            "title": section['title'],
+            "context": context,
+            "user_input": modification_request
+        })
+        if section['key'] != 'summary':
+            changes.append((section['text'].strip(), text.strip()))
+        new_texts.append(text)
+    return "".join(new_texts)
+
+
 def execute_route_modification(session_id, modification_request, route_plan, restaurant_plan, previous_budget, travel_info, user_id, username):
     """执行路线修改"""
     # 提取预算约束（优先从存储中获取最新预算，因为用户可能已经修改过预算）
@@ -970,18 +2492,22 @@ def execute_route_modification(session_id, modification_request, route_plan, res
     planner_name = "🗺️ Travel Route Planner"
     yield f"data: {json.dumps({'type': 'planner_start', 'planner': planner_name})}\n\n"
     
-    route_plan = ""
-    route_plan_input = {
-        "user_input": modification_request,
-        "previous_route_plan": previous_route_plan_context,
-        "budget_constraint": budget_constraint_text,
-        "revision_request": f"IMPORTANT: The user is providing feedback or requesting modifications to the existing route plan. Your task is to MODIFY ONLY the specific parts they mentioned:\n- If they mention a NEW destination (different city/country), create a completely NEW plan for that destination.\n- If they are providing feedback, suggestions, or complaints about specific parts (e.g., 'I don't like this hotel', 'change this attraction', 'modify day 2', 'this is not good'), ONLY modify those specific parts. Keep ALL other parts of the route plan EXACTLY as they were.\n- DO NOT recreate the entire route plan unless the user explicitly asks for a complete replan.\n- When you modify a part, clearly indicate which parts were changed and why.\n- Preserve the structure, format, and all unchanged content from the previous plan.\n\nUser's feedback/request: {modification_request}"
-    }
-    
-    for chunk in route_planner_chain.stream(route_plan_input):
-        if chunk:
-            route_plan += chunk
-            yield f"data: {json.dumps({'type': 'planner_chunk', 'planner': planner_name, 'content': chunk})}\n\n"
+    section_update = plan_route_section_update(modification_request, route_plan)
+    if section_update:
+        route_plan = yield from stream_route_section_update(planner_name, *section_update, modification_request, budget_constraint_text)
+    else:
+        route_plan = ""
+        route_plan_input = {
+            "user_input": modification_request,
+            "previous_route_plan": previous_route_plan_context,
+            "budget_constraint": budget_constraint_text,
+            "revision_request": f"IMPORTANT: The user is providing feedback or requesting modifications to the existing route plan. Your task is to MODIFY ONLY the specific parts they mentioned:\n- If they mention a NEW destination (different city/country), create a completely NEW plan for that destination.\n- If they are providing feedback, suggestions, or complaints about specific parts (e.g., 'I don't like this hotel', 'change this attraction', 'modify day 2', 'this is not good'), ONLY modify those specific parts. Keep ALL other parts of the route plan EXACTLY as they were.\n- DO NOT recreate the entire route plan unless the user explicitly asks for a complete replan.\n- When you modify a part, clearly indicate which parts were changed and why.\n- Preserve the structure, format, and all unchanged content from the previous plan.\n\nUser's feedback/request: {modification_request}"
+        }
+        
+        for chunk in route_planner_chain.stream(route_plan_input):
+            if chunk:
+                route_plan += chunk
+                yield f"data: {json.dumps({'type': 'planner_chunk', 'planner': planner_name, 'content': chunk})}\n\n"
     yield f"data: {json.dumps({'type': 'planner_complete', 'planner': planner_name})}\n\n"
     
     # 预算检查
@@ -989,17 +2515,7 @@ def execute_route_modification(session_id, modification_request, route_plan, res
     yield f"data: {json.dumps({'type': 'planner_start', 'planner': budget_checker_name})}\n\n"
     
     budget_str = str(current_budget) if current_budget else ""
-    budget_check_response = ""
-    for chunk in budget_checker_chain.stream({
-        "user_budget": budget_str,
-        "user_input": modification_request,
-        "route_plan": route_plan,
-        "restaurant_plan": restaurant_plan
-    }):
-        if chunk:
-            budget_check_response += chunk
-    
-    budget_check_result = parse_budget_check_result(budget_check_response)
+    budget_check_result = check_budget(budget_str, modification_request, route_plan, restaurant_plan, session_id)
     budget_ok = budget_check_result["budget_ok"]
     is_feasible = budget_check_result.get("is_feasible", True)
     budget_reason = budget_check_result["reason"]
@@ -1078,17 +2594,7 @@ def execute_restaurant_modification(session_id, modification_request, route_plan
     if not current_budget:
         current_budget = previous_budget
     budget_str = str(current_budget) if current_budget else ""
-    budget_check_response = ""
-    for chunk in budget_checker_chain.stream({
-        "user_budget": budget_str,
-        "user_input": modification_request,
-        "route_plan": route_plan,
-        "restaurant_plan": restaurant_plan
-    }):
-        if chunk:
-            budget_check_response += chunk
-    
-    budget_check_result = parse_budget_check_result(budget_check_response)
+    budget_check_result = check_budget(budget_str, modification_request, route_plan, restaurant_plan, session_id)
     budget_ok = budget_check_result["budget_ok"]
     is_feasible = budget_check_result.get("is_feasible", True)
     budget_reason = budget_check_result["reason"]
@@ -1160,17 +2666,7 @@ def execute_budget_modification(session_id, modification_request, route_plan, re
     
     budget_str = str(new_budget) if new_budget else ""
     print(f"[DEBUG] Using budget_str for budget checker: {budget_str}")
-    budget_check_response = ""
-    for chunk in budget_checker_chain.stream({
-        "user_budget": budget_str,
-        "user_input": modification_request,
-        "route_plan": route_plan,
-        "restaurant_plan": restaurant_plan
-    }):
-        if chunk:
-            budget_check_response += chunk
-    
-    budget_check_result = parse_budget_check_result(budget_check_response)
+    budget_check_result = check_budget(budget_str, modification_request, route_plan, restaurant_plan, session_id)
     budget_ok = budget_check_result["budget_ok"]
     is_feasible = budget_check_result["is_feasible"]
     budget_reason = budget_check_result["reason"]
@@ -1228,43 +2724,153 @@ def execute_budget_modification(session_id, modification_request, route_plan, re
     travel_plan_storage[session_id]["mediation_modification_type"] = ""
 
 
-def broadcast_message(message_data):
-    """广播消息给所有连接的客户端"""
-    # 确保消息有id
-    if 'id' not in message_data:
-        message_data['id'] = str(uuid.uuid4())
+def broadcast_message(message_data):
+    """广播消息给所有连接的客户端（经由广播总线，所有 worker 上的连接都会收到）"""
+    # 确保消息有id
+    if 'id' not in message_data:
+        message_data['id'] = str(uuid.uuid4())
+    
+    broadcast_bus.publish(message_data)
+
+
+def broadcast_stream_message(message_data, delta=None):
+    """广播流式消息的一次更新
+
+    message_data 是流式消息的完整当前状态（content 为累计内容），每次调用序号 seq 加一。
+    delta 为 None 时发送完整快照；否则只发送 append 增量，每 BROADCAST_SNAPSHOT_INTERVAL
+    次更新额外用一次完整快照代替增量，让错过增量的客户端重新同步。
+    """
+    message_data['seq'] = message_data.get('seq', -1) + 1
+    if delta is None or message_data['seq'] % BROADCAST_SNAPSHOT_INTERVAL == 0:
+        broadcast_message(dict(message_data, op='snapshot'))
+    else:
+        update = {key: value for key, value in message_data.items() if key != 'content'}
+        update['op'] = 'append'
+        update['delta'] = delta
+        broadcast_message(update)
+
+
+class CoalesceScheduler:
+    """所有 StreamCoalescer 共用的一个定时线程：到期时调用回调，不再为每个合并窗口各起一个 threading.Timer
+
+    线程在第一次 schedule 时才启动（gunicorn fork 出的 worker 各自启动自己的线程）。
+    """
+
+    def __init__(self):
+        self._condition = threading.Condition()
+        self._heap = []  # [(到期时间, 序号, 回调, 参数)]
+        self._counter = count()
+        self._thread = None
+
+    def schedule(self, deadline, callback, *args):
+        """在 time.monotonic() 到达 deadline 后调用 callback(*args)"""
+        with self._condition:
+            heapq.heappush(self._heap, (deadline, next(self._counter), callback, args))
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, daemon=True, name='broadcast-coalesce')
+                self._thread.start()
+            self._condition.notify()
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while not self._heap or self._heap[0][0] > time.monotonic():
+                    self._condition.wait(self._heap[0][0] - time.monotonic() if self._heap else None)
+                _, _, callback, args = heapq.heappop(self._heap)
+            try:
+                callback(*args)
+            except Exception as e:
+                print(f"合并广播定时发送出错: {e}")
+
+
+coalesce_scheduler = CoalesceScheduler()
+
+
+class StreamCoalescer:
+    """合并同一条流式消息在短时间窗口内的增量，减少广播次数
+
+    append 的增量先缓存，距第一个未发送增量 window 秒后合并成一次 append 广播：窗口已过时由下一次
+    append 直接发送，生成停顿时由共用的 coalesce_scheduler 线程发送；缓存达到 max_bytes 字节时立即发送。
+    snapshot 会丢弃未发送的增量并直接发送完整快照。window 为 0 时不合并，每个增量立即广播。
+    """
+
+    def __init__(self, window=0.075, max_bytes=2048):
+        self.window = window
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._pending = {}  # {message_id: (消息, [未发送的增量], 字节数, 窗口结束时间)}
+
+    def append(self, message, delta):
+        """追加内容；增量攒够窗口或字节阈值后再广播"""
+        with self._lock:
+            message['content'] += delta
+            if self.window <= 0:
+                broadcast_stream_message(message, delta=delta)
+                return
+            now = time.monotonic()
+            entry = self._pending.get(message['id'])
+            if entry is None:
+                entry = (message, [], 0, now + self.window)
+                coalesce_scheduler.schedule(entry[3], self._flush_due, message['id'], entry[3])
+            deltas, size = entry[1], entry[2] + len(delta.encode('utf-8'))
+            deltas.append(delta)
+            self._pending[message['id']] = (message, deltas, size, entry[3])
+            if size >= self.max_bytes or now >= entry[3]:
+                self._flush_locked(message['id'])
+
+    def flush(self, message_id):
+        """立即广播某条消息未发送的增量"""
+        with self._lock:
+            self._flush_locked(message_id)
+
+    def _flush_due(self, message_id, deadline):
+        # 定时线程的回调：窗口内的增量已经提前发送（之后又开始了新窗口）时不做任何事
+        with self._lock:
+            entry = self._pending.get(message_id)
+            if entry is not None and entry[3] == deadline:
+                self._flush_locked(message_id)
+
+    def _flush_locked(self, message_id):
+        entry = self._pending.pop(message_id, None)
+        if entry is None:
+            return
+        message, deltas, _, _ = entry
+        broadcast_stream_message(message, delta=''.join(deltas))
+
+    def snapshot(self, message, **changes):
+        """更新字段并广播完整快照（快照已包含全部内容，未发送的增量直接丢弃）"""
+        with self._lock:
+            self._pending.pop(message['id'], None)
+            message.update(changes)
+            broadcast_stream_message(message)
+
+    def flush_all(self):
+        """广播所有未发送的增量（流结束时调用）"""
+        with self._lock:
+            for message_id in list(self._pending):
+                self._flush_locked(message_id)
+
+
+def deliver_broadcast(event_id, message_data):
+    """广播总线的投递回调：更新本 worker 的消息历史并推送给本地SSE连接
+
+    event_id 由广播总线分配，单调递增（sqlite 总线在所有 worker 间一致）。
+    """
+    # 只编码一次，消息历史和所有连接共享同一个帧
+    frame = encode_sse_frame(message_data, event_id)
     
-    with message_queue_lock:
-        # 如果是更新现有消息（相同id），更新队列中的消息而不是追加
-        message_id = message_data.get('id')
-        updated = False
-        for i, msg in enumerate(message_queue):
-            if msg.get('id') == message_id:
-                message_queue[i] = message_data
-                updated = True
-                break
-        
-        if not updated:
-            message_queue.append(message_data)
-            # 保持消息队列大小（最多保留最近1000条消息）
-            if len(message_queue) > 1000:
-                message_queue.pop(0)
+    # 如果是更新现有消息（相同id），原位更新而不是追加
+    message_history.upsert(message_data, event_id, frame)
     
-    # 发送给所有SSE连接
+    # 发送给所有SSE连接（队列满时由各连接的慢速客户端策略处理，连接只在事件流结束时注销）
     with sse_connections_lock:
-        disconnected_users = []
-        for user_id, msg_queue in sse_connections.items():
-            try:
-                msg_queue.put_nowait(message_data)
-            except queue.Full:
-                # 队列满了，可能客户端断开连接
-                disconnected_users.append(user_id)
-            except Exception as e:
-                disconnected_users.append(user_id)
-        
-        # 清理断开的连接
-        for user_id in disconnected_users:
-            sse_connections.pop(user_id, None)
+        subscribers = list(sse_connections.values())
+    for msg_queue in subscribers:
+        msg_queue.put(message_data['id'], frame)
+
+
+broadcast_bus = create_broadcast_bus(BROADCAST_BUS_BACKEND, BROADCAST_BUS_PATH)
+broadcast_bus.start(deliver_broadcast)
 
 
 def add_cors_headers(response):
@@ -1306,6 +2912,34 @@ def after_request(response):
     return response
 
 
+def start_new_plan_stages(user_message, travel_info_future, session_id=None):
+    """启动 new_plan 流水线（路线规划 → 饭店规划 → 预算检查），返回三个 PlannerStage"""
+    def route_inputs():
+        current_budget = travel_info_future.result().get("budget")
+        budget_constraint_text = ""
+        if current_budget:
+            budget_constraint_text = f"\nBudget constraint: ${current_budget:.2f}\n"
+        return {
+            "user_input": user_message,
+            "previous_route_plan": "\nNo previous route plan exists.\n",
+            "budget_constraint": budget_constraint_text,
+            "revision_request": ""
+        }
+    
+    route_stage = RoutePlanStage(
+        route_inputs, lambda: travel_info_future.result().get("days"), depends_on=[travel_info_future]
+    ).start()
+    restaurant_stage = start_restaurant_stage(route_stage, user_message)
+    budget_stage = BudgetCheckStage(budget_checker_chain, lambda: {
+        "user_budget": travel_info_future.result().get("budget"),
+        "session_id": session_id,
+        "user_input": user_message,
+        "route_plan": route_stage.result(),
+        "restaurant_plan": restaurant_stage.result()
+    }, depends_on=[route_stage, restaurant_stage]).start()
+    return route_stage, restaurant_stage, budget_stage
+
+
 def generate_stream(user_message, session_id=None, user_id=None, username=None):
     """生成流式响应"""
     if not llm:
@@ -1330,14 +2964,33 @@ def generate_stream(user_message, session_id=None, user_id=None, username=None):
         start_msg = {'type': 'start'}
         yield f"data: {json.dumps(start_msg)}\n\n"
         
-        # 第一步：调用总路由判断agent类型
-        router_response = ""
-        for chunk in router_chain.stream({"user_input": user_message}):
-            if chunk:
-                router_response += chunk
+        # 第一步：判断agent类型
+        # 正在等待投票且消息是明确的投票时直接交给旅行助手处理，不调用任何 LLM
+        agent = None
+        pending_state = travel_plan_storage.get(session_id)
+        if pending_state is not None and match_pending_vote(pending_state, user_message)[1] is not None:
+            agent = 'travel'
         
-        # 解析路由响应
-        agent = parse_router_response(router_response)
+        # 融合 intake：一次调用同时得到 agent、意图和旅行信息
+        intake = None
+        if agent is None and INTAKE_MODE == 'fused' and intake_chain:
+            intake = run_intake(user_message, travel_plan_storage.get(session_id) or {})
+            if intake is not None:
+                agent = intake.agent
+        
+        # 本地规则有把握时直接路由，其次使用缓存结果，最后才调用总路由
+        if agent is None:
+            agent = local_intent_router.route(user_message)
+        router_cache_key = router_cache.key(user_message) if agent is None else None
+        if agent is None:
+            agent = router_cache.get(router_cache_key)
+        if agent is None:
+            # agent 字段完整后立即停止生成（只缓存成功解析出的结果）
+            router_result, _ = stream_json_field(router_chain, {"user_input": user_message}, 'agent')
+            agent = parse_router_response(router_result)
+            if isinstance(router_result, dict) and router_result.get('agent') == agent:
+                router_cache.put(router_cache_key, agent)
+            local_intent_router.record_fallback(user_message, agent)
         
         # 发送agent类型
         yield f"data: {json.dumps({'type': 'agent', 'agent': agent})}\n\n"
@@ -1432,9 +3085,9 @@ def generate_stream(user_message, session_id=None, user_id=None, username=None):
             awaiting_mediation = previous_state.get("awaiting_mediation", False)
             if awaiting_mediation:
                 # 处理调解者投票
-                user_message_lower = user_message.lower()
-                is_agree = any(word in user_message_lower for word in ["agree", "yes", "ok", "同意", "好的", "确定", "confirm", "proceed"])
-                is_disagree = any(word in user_message_lower for word in ["disagree", "no", "不同意", "反对", "cancel"])
+                _, vote = match_pending_vote(previous_state, user_message)
+                is_agree = vote == "agree"
+                is_disagree = vote == "disagree"
                 
                 if is_disagree:
                     # 用户反对，保持原计划
@@ -1447,11 +3100,7 @@ def generate_stream(user_message, session_id=None, user_id=None, username=None):
                 
                 if is_agree:
                     # 记录用户同意调解
-                    if session_id not in vote_storage:
-                        vote_storage[session_id] = {}
-                    if "mediation_votes" not in vote_storage[session_id]:
-                        vote_storage[session_id]["mediation_votes"] = {}
-                    vote_storage[session_id]["mediation_votes"][user_id] = "agree"
+                    record_vote(session_id, "mediation", user_id, "agree")
                     
                     # 获取发起者ID（排除发起者）
                     requesting_user_id = travel_plan_storage[session_id].get("mediation_requesting_user_id", "")
@@ -1516,10 +3165,10 @@ def generate_stream(user_message, session_id=None, user_id=None, username=None):
             awaiting_confirmation = previous_state.get("awaiting_confirmation", False)
             if awaiting_confirmation:
                 # 处理计划确认投票（注意：这里不会与调解者冲突，因为调解者已经在前面处理了）
-                user_message_lower = user_message.lower()
                 # 计划确认使用更明确的关键词，避免与调解者混淆
-                is_agree = any(word in user_message_lower for word in ["agree", "yes", "ok", "同意", "好的", "确定", "confirm", "proceed", "finalize", "确认计划", "确定方案"])
-                is_disagree = any(word in user_message_lower for word in ["disagree", "no", "cancel", "replan", "modify"])
+                _, vote = match_pending_vote(previous_state, user_message)
+                is_agree = vote == "agree"
+                is_disagree = vote == "disagree"
                 
                 if is_disagree:
                     # 用户反对，需要重新规划
@@ -1530,11 +3179,7 @@ def generate_stream(user_message, session_id=None, user_id=None, username=None):
                     # 继续执行，让Supervisor判断为modify_route
                 elif is_agree:
                     # 记录用户同意
-                    if session_id not in vote_storage:
-                        vote_storage[session_id] = {}
-                    if "confirmation_votes" not in vote_storage[session_id]:
-                        vote_storage[session_id]["confirmation_votes"] = {}
-                    vote_storage[session_id]["confirmation_votes"][user_id] = "agree"
+                    record_vote(session_id, "confirmation", user_id, "agree")
                     
                     # 检查是否所有人都同意了
                     if check_all_users_agreed(session_id, "confirmation"):
@@ -1647,45 +3292,54 @@ def generate_stream(user_message, session_id=None, user_id=None, username=None):
             # 第一步：调用Travel Supervisor判断用户意图
             supervisor_response = ""
             
-            # 准备传递给supervisor的previous_route_plan
-            previous_route_plan = previous_state.get("route_plan", "")
-            previous_restaurant_plan = previous_state.get("restaurant_plan", "")
+            # 准备传递给supervisor的会话状态
             previous_budget = previous_state.get("budget")
             awaiting_replan_confirmation = previous_state.get("awaiting_replan_confirmation", False)
+            supervisor_inputs = supervisor_context(previous_state)
+            has_route_plan = supervisor_inputs["previous_route_plan"] != "None"
+            has_restaurant_plan = supervisor_inputs["previous_restaurant_plan"] != "None"
             
-            # 如果route_plan为空或很短，传递给supervisor时使用"None"
-            if not previous_route_plan or len(previous_route_plan.strip()) < 10:
-                previous_route_plan_for_supervisor = "None"
-            else:
-                previous_route_plan_for_supervisor = previous_route_plan[:500]  # 限制长度避免token过多
-            
-            if not previous_restaurant_plan or len(previous_restaurant_plan.strip()) < 10:
-                previous_restaurant_plan_for_supervisor = "None"
+            new_plan_stages = None
+            if intake is not None:
+                # intake 已经给出了意图和旅行信息
+                intent = intake.intent
+                travel_info_future = Future()
+                travel_info_future.set_result(intake.travel_info())
             else:
-                previous_restaurant_plan_for_supervisor = previous_restaurant_plan[:500]
-            
-            
-            for chunk in travel_supervisor_chain.stream({
-                "user_input": user_message,
-                "previous_route_plan": previous_route_plan_for_supervisor,
-                "previous_restaurant_plan": previous_restaurant_plan_for_supervisor,
-                "previous_budget": str(previous_budget) if previous_budget else "None",
-                "awaiting_replan_confirmation": "true" if awaiting_replan_confirmation else "false"
-            }):
-                if chunk:
-                    supervisor_response += chunk
+                # 提取旅行信息（目的地、预算、天数）：预算提取可能是一次 LLM 调用，与 Supervisor 并发执行
+                travel_info_future = planner_executor.submit(extract_travel_info, user_message)
+                
+                # 没有任何已有计划时 Supervisor 必然返回 new_plan（规则 2），
+                # 因此在等待 Supervisor 的同时提前启动规划流水线，意图不符时再取消
+                if not has_route_plan and not has_restaurant_plan and not awaiting_replan_confirmation:
+                    new_plan_stages = start_new_plan_stages(user_message, travel_info_future, session_id)
+                
+                # Supervisor 的判断取决于输入和会话状态（是否已有计划、是否在等待重新规划确认），缓存键包含这些状态
+                supervisor_cache_key = supervisor_cache.key(
+                    user_message,
+                    has_route_plan,
+                    has_restaurant_plan,
+                    bool(previous_budget),
+                    bool(awaiting_replan_confirmation)
+                )
+                intent = supervisor_cache.get(supervisor_cache_key)
+            if intent is None:
+                # intent 字段完整后立即停止生成，不等待 reason
+                supervisor_result, supervisor_response = stream_json_field(
+                    travel_supervisor_chain, dict(supervisor_inputs, user_input=user_message), 'intent'
+                )
+                intent = "new_plan"  # 默认值
+                if supervisor_result and isinstance(supervisor_result, dict):
+                    intent = supervisor_result.get('intent', 'new_plan')
+                    if 'intent' in supervisor_result:
+                        supervisor_cache.put(supervisor_cache_key, intent)
             
-            # 解析supervisor响应
-            supervisor_result = extract_json_from_text(supervisor_response)
-            intent = "new_plan"  # 默认值
-            if supervisor_result and isinstance(supervisor_result, dict):
-                intent = supervisor_result.get('intent', 'new_plan')
-                pass
-            else:
-                pass
+            if new_plan_stages and intent != "new_plan":
+                for stage in new_plan_stages:
+                    stage.cancel()
+                new_plan_stages = None
             
-            # 提取旅行信息（目的地、预算、天数）
-            travel_info = extract_travel_info(user_message)
+            travel_info = travel_info_future.result()
             
             # 根据intent执行不同的流程
             route_plan = previous_state.get("route_plan", "")
@@ -1723,24 +3377,34 @@ def generate_stream(user_message, session_id=None, user_id=None, username=None):
                     "revision_request": "Please replan the route to be more budget-friendly and fit within the specified budget."
                 }
                 
-                for chunk in route_planner_chain.stream(route_plan_input):
-                    if chunk:
-                        route_plan += chunk
-                        yield f"data: {json.dumps({'type': 'planner_chunk', 'planner': planner_name, 'content': chunk})}\n\n"
-                yield f"data: {json.dumps({'type': 'planner_complete', 'planner': planner_name})}\n\n"
+                # 天数沿用之前的计划（确认重新规划的消息里通常没有天数）
+                replan_days = travel_info.get("days") or len(route_day_sections(split_route_sections(old_route_plan)))
                 
-                # 2. 饭店规划师（重新规划）
-                restaurant_plan = ""
-                planner_name = "🍽️ Restaurant Planner"
-                yield f"data: {json.dumps({'type': 'planner_start', 'planner': planner_name})}\n\n"
-                for chunk in restaurant_planner_chain.stream({
-                    "user_input": f"{user_message} Please recommend budget-friendly restaurants that fit within the budget.",
-                    "route_plan": route_plan
-                }):
-                    if chunk:
-                        restaurant_plan += chunk
-                        yield f"data: {json.dumps({'type': 'planner_chunk', 'planner': planner_name, 'content': chunk})}\n\n"
-                yield f"data: {json.dumps({'type': 'planner_complete', 'planner': planner_name})}\n\n"
+                # 路线和饭店在后台阶段中执行，饭店规划随路线逐天开始
+                route_stage = RoutePlanStage(lambda: route_plan_input, lambda: replan_days).start()
+                restaurant_stage = start_restaurant_stage(
+                    route_stage, f"{user_message} Please recommend budget-friendly restaurants that fit within the budget."
+                )
+                replan_budget = travel_plan_storage[session_id].get("budget") or previous_budget
+                cost_tally = start_cost_tally(replan_budget, session_budget_currency(session_id, user_message, replan_budget))
+                try:
+                    within_budget = yield from forward_planner_chunks(planner_name, route_stage, cost_tally)
+                    yield f"data: {json.dumps({'type': 'planner_complete', 'planner': planner_name})}\n\n"
+                    
+                    # 2. 饭店规划师（重新规划）
+                    if within_budget:
+                        route_plan = route_stage.result()
+                        within_budget = yield from stream_planner_stage("🍽️ Restaurant Planner", restaurant_stage, cost_tally)
+                    if within_budget:
+                        restaurant_plan = restaurant_stage.result()
+                finally:
+                    route_stage.cancel()
+                    restaurant_stage.cancel()
+                
+                if not within_budget:
+                    yield from stream_over_budget_alert(session_id, cost_tally, route_stage.text, restaurant_stage.text)
+                    yield f"data: {json.dumps({'type': 'complete'})}\n\n"
+                    return
                 
                 # 3. 预算检查
                 budget_checker_name = "💰 Budget Checker"
@@ -1758,17 +3422,7 @@ def generate_stream(user_message, session_id=None, user_id=None, username=None):
                     current_budget = previous_budget
                 budget_str = str(current_budget) if current_budget else ""
                 
-                budget_check_response = ""
-                for chunk in budget_checker_chain.stream({
-                    "user_budget": budget_str,
-                    "user_input": user_message,
-                    "route_plan": route_plan,
-                    "restaurant_plan": restaurant_plan
-                }):
-                    if chunk:
-                        budget_check_response += chunk
-                
-                budget_check_result = parse_budget_check_result(budget_check_response)
+                budget_check_result = check_budget(budget_str, user_message, route_plan, restaurant_plan, session_id)
                 
                 budget_ok = budget_check_result["budget_ok"]
                 is_feasible = budget_check_result["is_feasible"]
@@ -1805,6 +3459,7 @@ def generate_stream(user_message, session_id=None, user_id=None, username=None):
                         "route_plan": route_plan,
                         "restaurant_plan": restaurant_plan,
                         "budget": previous_budget,
+                        "budget_currency": travel_plan_storage[session_id].get("budget_currency"),
                         "awaiting_replan_confirmation": False
                     }
                     
@@ -1816,63 +3471,45 @@ def generate_stream(user_message, session_id=None, user_id=None, username=None):
                     "route_plan": route_plan,
                     "restaurant_plan": restaurant_plan,
                     "budget": previous_budget,
+                    "budget_currency": travel_plan_storage[session_id].get("budget_currency"),
                     "awaiting_replan_confirmation": False,
                     "awaiting_confirmation": False
                 }
             
             elif intent == "new_plan":
-                # 新规划：路线规划 → 饭店规划 → 预算检查 → 预算规划
+                # 新规划：路线规划 → 饭店规划 → 预算检查
+                # 各阶段在后台线程中执行，输入就绪即开始；这里按顺序转发它们的输出
+                if new_plan_stages is None:
+                    new_plan_stages = start_new_plan_stages(user_message, travel_info_future, session_id)
+                route_stage, restaurant_stage, budget_stage = new_plan_stages
                 
-                # 1. 路线规划师
-                planner_name = "🗺️ Travel Route Planner"
-                yield f"data: {json.dumps({'type': 'planner_start', 'planner': planner_name})}\n\n"
-                
-                # 提取预算约束
-                current_budget = travel_info.get("budget")
-                budget_constraint_text = ""
-                if current_budget:
-                    budget_constraint_text = f"\nBudget constraint: ${current_budget:.2f}\n"
-                
-                route_plan = ""
-                route_plan_input = {
-                    "user_input": user_message,
-                    "previous_route_plan": "\nNo previous route plan exists.\n",
-                    "budget_constraint": budget_constraint_text,
-                    "revision_request": ""
-                }
-                
-                for chunk in route_planner_chain.stream(route_plan_input):
-                    if chunk:
-                        route_plan += chunk
-                        yield f"data: {json.dumps({'type': 'planner_chunk', 'planner': planner_name, 'content': chunk})}\n\n"
-                yield f"data: {json.dumps({'type': 'planner_complete', 'planner': planner_name})}\n\n"
-                
-                # 2. 饭店规划师
-                restaurant_plan = ""
-                planner_name = "🍽️ Restaurant Planner"
-                yield f"data: {json.dumps({'type': 'planner_start', 'planner': planner_name})}\n\n"
-                for chunk in restaurant_planner_chain.stream({
-                    "user_input": user_message,
-                    "route_plan": route_plan
-                }):
-                    if chunk:
-                        restaurant_plan += chunk
-                        yield f"data: {json.dumps({'type': 'planner_chunk', 'planner': planner_name, 'content': chunk})}\n\n"
-                yield f"data: {json.dumps({'type': 'planner_complete', 'planner': planner_name})}\n\n"
-                
-                # 3. 预算检查
-                budget_checker_name = "💰 Budget Checker"
-                yield f"data: {json.dumps({'type': 'planner_start', 'planner': budget_checker_name})}\n\n"
+                # 边生成边累计费用，已经明显超出预算时不再生成剩余部分
+                plan_budget = travel_info.get("budget") or travel_plan_storage[session_id].get("budget")
+                cost_tally = start_cost_tally(plan_budget, session_budget_currency(session_id, user_message, plan_budget))
+                try:
+                    # 1. 路线规划师
+                    within_budget = yield from stream_planner_stage("🗺️ Travel Route Planner", route_stage, cost_tally)
+                    
+                    # 2. 饭店规划师
+                    if within_budget:
+                        route_plan = route_stage.result()
+                        within_budget = yield from stream_planner_stage("🍽️ Restaurant Planner", restaurant_stage, cost_tally)
+                    
+                    # 3. 预算检查
+                    if within_budget:
+                        restaurant_plan = restaurant_stage.result()
+                        budget_checker_name = "💰 Budget Checker"
+                        yield f"data: {json.dumps({'type': 'planner_start', 'planner': budget_checker_name})}\n\n"
+                        budget_check_response = budget_stage.result()
+                finally:
+                    # 客户端断开、出错或超出预算时停止仍在运行的阶段
+                    for stage in new_plan_stages:
+                        stage.cancel()
                 
-                budget_check_response = ""
-                for chunk in budget_checker_chain.stream({
-                    "user_budget": "",
-                    "user_input": user_message,
-                    "route_plan": route_plan,
-                    "restaurant_plan": restaurant_plan
-                }):
-                    if chunk:
-                        budget_check_response += chunk
+                if not within_budget:
+                    yield from stream_over_budget_alert(session_id, cost_tally, route_stage.text, restaurant_stage.text)
+                    yield f"data: {json.dumps({'type': 'complete'})}\n\n"
+                    return
                 
                 budget_check_result = parse_budget_check_result(budget_check_response)
                 
@@ -1923,6 +3560,7 @@ def generate_stream(user_message, session_id=None, user_id=None, username=None):
                     "route_plan": route_plan,
                     "restaurant_plan": restaurant_plan,
                     "budget": travel_info.get("budget"),
+                    "budget_currency": travel_plan_storage[session_id].get("budget_currency"),
                     "awaiting_replan_confirmation": False,
                     "awaiting_confirmation": False
                 }
@@ -2007,18 +3645,22 @@ def generate_stream(user_message, session_id=None, user_id=None, username=None):
                 if current_budget:
                     budget_constraint_text = f"\nBudget constraint: ${current_budget:.2f}\n"
                 
-                route_plan = ""
-                route_plan_input = {
-                    "user_input": modification_request,
-                    "previous_route_plan": previous_route_plan_context,
-                    "budget_constraint": budget_constraint_text,
-                    "revision_request": f"IMPORTANT: The user is providing feedback or requesting modifications to the existing route plan. Your task is to MODIFY ONLY the specific parts they mentioned:\n- If they mention a NEW destination (different city/country), create a completely NEW plan for that destination.\n- If they are providing feedback, suggestions, or complaints about specific parts (e.g., 'I don't like this hotel', 'change this attraction', 'modify day 2', 'this is not good'), ONLY modify those specific parts. Keep ALL other parts of the route plan EXACTLY as they were.\n- DO NOT recreate the entire route plan unless the user explicitly asks for a complete replan.\n- When you modify a part, clearly indicate which parts were changed and why.\n- Preserve the structure, format, and all unchanged content from the previous plan.\n\nUser's feedback/request: {modification_request}"
-                }
-                
-                for chunk in route_planner_chain.stream(route_plan_input):
-                    if chunk:
-                        route_plan += chunk
-                        yield f"data: {json.dumps({'type': 'planner_chunk', 'planner': planner_name, 'content': chunk})}\n\n"
+                section_update = plan_route_section_update(modification_request, route_plan)
+                if section_update:
+                    route_plan = yield from stream_route_section_update(planner_name, *section_update, modification_request, budget_constraint_text)
+                else:
+                    route_plan = ""
+                    route_plan_input = {
+                        "user_input": modification_request,
+                        "previous_route_plan": previous_route_plan_context,
+                        "budget_constraint": budget_constraint_text,
+                        "revision_request": f"IMPORTANT: The user is providing feedback or requesting modifications to the existing route plan. Your task is to MODIFY ONLY the specific parts they mentioned:\n- If they mention a NEW destination (different city/country), create a completely NEW plan for that destination.\n- If they are providing feedback, suggestions, or complaints about specific parts (e.g., 'I don't like this hotel', 'change this attraction', 'modify day 2', 'this is not good'), ONLY modify those specific parts. Keep ALL other parts of the route plan EXACTLY as they were.\n- DO NOT recreate the entire route plan unless the user explicitly asks for a complete replan.\n- When you modify a part, clearly indicate which parts were changed and why.\n- Preserve the structure, format, and all unchanged content from the previous plan.\n\nUser's feedback/request: {modification_request}"
+                    }
+                    
+                    for chunk in route_planner_chain.stream(route_plan_input):
+                        if chunk:
+                            route_plan += chunk
+                            yield f"data: {json.dumps({'type': 'planner_chunk', 'planner': planner_name, 'content': chunk})}\n\n"
                 yield f"data: {json.dumps({'type': 'planner_complete', 'planner': planner_name})}\n\n"
                 
                 # 2. 预算检查（新路线 + 老饭店）
@@ -2028,17 +3670,7 @@ def generate_stream(user_message, session_id=None, user_id=None, username=None):
                 # 使用上面已经获取的 current_budget（优先从存储中获取最新预算）
                 budget_str = str(current_budget) if current_budget else ""
                 
-                budget_check_response = ""
-                for chunk in budget_checker_chain.stream({
-                    "user_budget": budget_str,
-                    "user_input": user_message,
-                    "route_plan": route_plan,
-                    "restaurant_plan": restaurant_plan
-                }):
-                    if chunk:
-                        budget_check_response += chunk
-                
-                budget_check_result = parse_budget_check_result(budget_check_response)
+                budget_check_result = check_budget(budget_str, user_message, route_plan, restaurant_plan, session_id)
                 
                 budget_ok = budget_check_result["budget_ok"]
                 is_feasible = budget_check_result["is_feasible"]
@@ -2159,17 +3791,7 @@ def generate_stream(user_message, session_id=None, user_id=None, username=None):
                     current_budget = previous_budget
                 budget_str = str(current_budget) if current_budget else ""
                 
-                budget_check_response = ""
-                for chunk in budget_checker_chain.stream({
-                    "user_budget": budget_str,
-                    "user_input": user_message,
-                    "route_plan": route_plan,
-                    "restaurant_plan": restaurant_plan
-                }):
-                    if chunk:
-                        budget_check_response += chunk
-                
-                budget_check_result = parse_budget_check_result(budget_check_response)
+                budget_check_result = check_budget(budget_str, user_message, route_plan, restaurant_plan, session_id)
                 
                 budget_ok = budget_check_result["budget_ok"]
                 is_feasible = budget_check_result["is_feasible"]
@@ -2327,26 +3949,8 @@ def generate_stream(user_message, session_id=None, user_id=None, username=None):
         yield f"data: {json.dumps({'type': 'error', 'content': f'Error processing message: {str(e)}'})}\n\n"
 
 
-@app.route('/api/chat', methods=['POST', 'OPTIONS'])
-def chat():
-    """处理聊天请求，返回流式响应"""
-    if request.method == 'OPTIONS':
-        response = jsonify({})
-        return add_cors_headers(response)
-    
-    data = request.get_json()
-    if not data:
-        response = jsonify({'error': '请求体不能为空'})
-        return add_cors_headers(response), 400
-    
-    user_message = data.get('message', '')
-    
-    if not user_message:
-        response = jsonify({'error': '消息不能为空'})
-        return add_cors_headers(response), 400
-    
-    # 获取user_id和session_id
-    user_id = request.headers.get('X-User-ID', None) or data.get('user_id', None)
+def start_chat_turn(user_message, user_id=None):
+    """登记发送者并广播用户消息，返回 (session_id, user_id, username)"""
     if not user_id:
         user_id = str(uuid.uuid4())
     
@@ -2369,137 +3973,182 @@ def chat():
         'content': user_message,
         'timestamp': datetime.utcnow().isoformat()
     })
+    return session_id, user_id, username
+
+
+def generate_with_broadcast(user_message, session_id, user_id, username):
+    """包装generate_stream：转发流式响应，同时把消息内容广播给聊天室"""
+    ai_message = {
+        'id': str(uuid.uuid4()),
+        'type': 'ai',
+        'user_id': user_id,
+        'username': username,
+        'agent': None,
+        'content': '',
+        'timestamp': None,
+        'isStreaming': True
+    }
+    current_agent = None
+    current_planner = None
+    planner_messages = {}  # {planner_name: 正在流式输出的planner消息}
+    ai_message_created = False
+    coalescer = StreamCoalescer(BROADCAST_COALESCE_MS / 1000, BROADCAST_COALESCE_BYTES)
     
-    
-    # 返回流式响应（包装generate_stream以支持消息广播）
-    def generate_with_broadcast():
-        ai_message_id = str(uuid.uuid4())
-        ai_content = ""
-        current_agent = None
-        current_planner = None
-        planner_messages = {}  # {planner_name: {"id": "...", "content": ""}}
-        ai_message_created = False
-        
-        try:
-            for chunk in generate_stream(user_message, session_id=session_id, user_id=user_id, username=username):
-                yield chunk
-                
-                # 解析chunk以收集消息内容用于广播
-                if chunk.startswith('data: '):
-                    try:
-                        data = json.loads(chunk[6:].strip())
-                        
-                        if data.get('type') == 'agent':
-                            current_agent = data.get('agent')
-                        elif data.get('type') == 'planner_start':
-                            planner_name = data.get('planner')
-                            planner_id = str(uuid.uuid4())
-                            planner_messages[planner_name] = {
-                                'id': planner_id,
-                                'content': ''
-                            }
-                            current_planner = planner_name
-                            # 立即广播planner开始消息（用于实时显示）
-                            broadcast_message({
-                                'id': planner_id,
-                                'type': 'planner',
-                                'user_id': user_id,
-                                'username': username,
-                                'planner': planner_name,
-                                'content': '',
-                                'timestamp': datetime.utcnow().isoformat(),
-                                'isStreaming': True
-                            })
-                        elif data.get('type') == 'planner_chunk':
-                            planner_name = data.get('planner')
-                            content = data.get('content', '')
-                            if planner_name in planner_messages:
-                                planner_messages[planner_name]['content'] += content
-                                # 实时广播planner内容更新
-                                broadcast_message({
-                                    'id': planner_messages[planner_name]['id'],
-                                    'type': 'planner',
-                                    'user_id': user_id,
-                                    'username': username,
-                                    'planner': planner_name,
-                                    'content': planner_messages[planner_name]['content'],
-                                    'timestamp': datetime.utcnow().isoformat(),
-                                    'isStreaming': True
-                                })
-                        elif data.get('type') == 'planner_complete':
-                            planner_name = data.get('planner')
-                            if planner_name in planner_messages:
-                                # 广播planner完成消息
-                                broadcast_message({
-                                    'id': planner_messages[planner_name]['id'],
-                                    'type': 'planner',
-                                    'user_id': user_id,
-                                    'username': username,
-                                    'planner': planner_name,
-                                    'content': planner_messages[planner_name]['content'],
-                                    'timestamp': datetime.utcnow().isoformat(),
-                                    'isStreaming': False
-                                })
-                                del planner_messages[planner_name]
-                        elif data.get('type') == 'chunk':
-                            ai_content += data.get('content', '')
-                            # 如果AI消息还没创建，先创建并广播
-                            if not ai_message_created and current_agent:
-                                ai_message_created = True
-                                broadcast_message({
-                                    'id': ai_message_id,
-                                    'type': 'ai',
-                                    'user_id': user_id,
-                                    'username': username,
-                                    'agent': current_agent,
-                                    'content': '',
-                                    'timestamp': datetime.utcnow().isoformat(),
-                                    'isStreaming': True
-                                })
-                            # 实时广播AI内容更新
-                            if ai_message_created:
-                                broadcast_message({
-                                    'id': ai_message_id,
-                                    'type': 'ai',
-                                    'user_id': user_id,
-                                    'username': username,
-                                    'agent': current_agent,
-                                    'content': ai_content,
-                                    'timestamp': datetime.utcnow().isoformat(),
-                                    'isStreaming': True
-                                })
-                    except Exception as parse_error:
-                        print(f'解析chunk时出错: {parse_error}')
-                        pass
+    try:
+        for chunk in generate_stream(user_message, session_id=session_id, user_id=user_id, username=username):
+            yield chunk
             
-            # 广播AI消息完成（如果有内容）
-            if ai_content:
-                broadcast_message({
-                    'id': ai_message_id,
-                    'type': 'ai',
-                    'user_id': user_id,
-                    'username': username,
-                    'agent': current_agent,
-                    'content': ai_content,
-                    'timestamp': datetime.utcnow().isoformat(),
-                    'isStreaming': False
-                })
-        except Exception as e:
-            print(f'生成流时出错: {e}')
-            import traceback
-            traceback.print_exc()
-            broadcast_message({
-                'id': str(uuid.uuid4()),
-                'type': 'error',
-                'user_id': user_id,
-                'username': username,
-                'content': f'Error: {str(e)}',
-                'timestamp': datetime.utcnow().isoformat()
-            })
+            # 解析chunk以收集消息内容用于广播
+            if chunk.startswith('data: '):
+                try:
+                    data = json.loads(chunk[6:].strip())
+                    
+                    if data.get('type') == 'agent':
+                        current_agent = data.get('agent')
+                    elif data.get('type') == 'planner_start':
+                        planner_name = data.get('planner')
+                        planner_messages[planner_name] = {
+                            'id': str(uuid.uuid4()),
+                            'type': 'planner',
+                            'user_id': user_id,
+                            'username': username,
+                            'planner': planner_name,
+                            'content': '',
+                            'timestamp': datetime.utcnow().isoformat(),
+                            'isStreaming': True
+                        }
+                        current_planner = planner_name
+                        # 立即广播planner开始消息（用于实时显示）
+                        coalescer.snapshot(planner_messages[planner_name])
+                    elif data.get('type') == 'planner_chunk':
+                        planner_name = data.get('planner')
+                        content = data.get('content', '')
+                        if planner_name in planner_messages:
+                            # 实时广播planner内容增量（按时间窗口合并）
+                            coalescer.append(planner_messages[planner_name], content)
+                    elif data.get('type') == 'planner_complete':
+                        planner_name = data.get('planner')
+                        if planner_name in planner_messages:
+                            # 广播planner完成消息（完整快照）
+                            coalescer.snapshot(planner_messages[planner_name], isStreaming=False)
+                            del planner_messages[planner_name]
+                    elif data.get('type') == 'chunk':
+                        content = data.get('content', '')
+                        if ai_message_created:
+                            # 实时广播AI内容增量（按时间窗口合并）
+                            coalescer.append(ai_message, content)
+                        else:
+                            ai_message['content'] += content
+                            if current_agent:
+                                # 如果AI消息还没创建，先创建并广播（包含目前为止的内容）
+                                ai_message_created = True
+                                coalescer.snapshot(ai_message, agent=current_agent, timestamp=datetime.utcnow().isoformat())
+                except Exception as parse_error:
+                    print(f'解析chunk时出错: {parse_error}')
+                    pass
+        
+        # 广播AI消息完成（如果有内容）
+        if ai_message['content']:
+            coalescer.snapshot(
+                ai_message,
+                agent=current_agent,
+                timestamp=ai_message['timestamp'] or datetime.utcnow().isoformat(),
+                isStreaming=False
+            )
+    except Exception as e:
+        print(f'生成流时出错: {e}')
+        import traceback
+        traceback.print_exc()
+        broadcast_message({
+            'id': str(uuid.uuid4()),
+            'type': 'error',
+            'user_id': user_id,
+            'username': username,
+            'content': f'Error: {str(e)}',
+            'timestamp': datetime.utcnow().isoformat()
+        })
+    finally:
+        # 流结束（包括出错或客户端断开）时发送所有尚未广播的增量
+        coalescer.flush_all()
+
+
+def _sse_connection_id(msg_queue):
+    """SSE连接在所有 worker 中唯一的标识"""
+    return f"{os.getpid()}:{id(msg_queue)}"
+
+
+def register_sse_connection(user_id, msg_queue, last_event_id=None):
+    """注册SSE订阅队列并标记用户在线，返回连接时需要补发的历史消息帧
+
+    客户端带有 Last-Event-ID 时只补发之后更新过的消息；否则（或历史已无法覆盖时）补发最近50条。
+    """
+    with sse_connections_lock:
+        sse_connections[user_id] = msg_queue
+    sse_presence[user_id] = {
+        "connection_id": _sse_connection_id(msg_queue),
+        "last_seen": time.time()
+    }
+    if last_event_id is not None:
+        missed_frames = message_history.frames_since(last_event_id)
+        if missed_frames is not None:
+            return missed_frames
+    return message_history.last_frames(50)
+
+
+def parse_last_event_id(value):
+    """解析 Last-Event-ID（请求头或 last_event_id 查询参数），无效时返回 None"""
+    try:
+        return int(value) if value else None
+    except ValueError:
+        return None
+
+
+def refresh_sse_presence(user_id, msg_queue):
+    """刷新在线状态（由SSE事件流定期调用，避免被视为离线）"""
+    connection_id = _sse_connection_id(msg_queue)
+    
+    def apply(presence):
+        if presence and presence.get("connection_id") == connection_id:
+            presence["last_seen"] = time.time()
+        return presence
+    state_store.update('presence', user_id, apply)
+
+
+def unregister_sse_connection(user_id, msg_queue):
+    """注销SSE订阅队列（同一用户已重新连接时保留新连接）"""
+    with sse_connections_lock:
+        if sse_connections.get(user_id) is msg_queue:
+            sse_connections.pop(user_id, None)
+    
+    connection_id = _sse_connection_id(msg_queue)
+    state_store.update('presence', user_id, lambda presence: None if presence and presence.get("connection_id") == connection_id else presence)
+
+
+@app.route('/api/chat', methods=['POST', 'OPTIONS'])
+def chat():
+    """处理聊天请求，返回流式响应"""
+    if request.method == 'OPTIONS':
+        response = jsonify({})
+        return add_cors_headers(response)
+    
+    data = request.get_json()
+    if not data:
+        response = jsonify({'error': '请求体不能为空'})
+        return add_cors_headers(response), 400
+    
+    user_message = data.get('message', '')
+    
+    if not user_message:
+        response = jsonify({'error': '消息不能为空'})
+        return add_cors_headers(response), 400
+    
+    # 获取user_id，登记用户并广播用户消息
+    user_id = request.headers.get('X-User-ID', None) or data.get('user_id', None)
+    session_id, user_id, username = start_chat_turn(user_message, user_id)
     
     # 返回流式响应
     response = Response(
-        generate_with_broadcast(),
+        generate_with_broadcast(user_message, session_id, user_id, username),
         mimetype='text/event-stream',
         headers={
             'Cache-Control': 'no-cache',
@@ -2526,42 +4175,37 @@ def events():
         response = jsonify({'error': 'user_id is required'})
         return add_cors_headers(response), 400
     
-    # 创建消息队列
-    msg_queue = queue.Queue(maxsize=100)
-    
-    # 注册连接
-    with sse_connections_lock:
-        sse_connections[user_id] = msg_queue
-    
-    # 发送历史消息（最近50条）
-    with message_queue_lock:
-        history_messages = message_queue[-50:] if len(message_queue) > 50 else message_queue
+    # 创建消息队列并注册连接（可以通过 policy 参数选择慢速客户端策略）
+    msg_queue = SubscriberQueue(SSE_QUEUE_SIZE, request.args.get('policy', SSE_SLOW_CONSUMER_POLICY))
+    last_event_id = parse_last_event_id(request.headers.get('Last-Event-ID') or request.args.get('last_event_id'))
+    history_frames = register_sse_connection(user_id, msg_queue, last_event_id)
     
     def generate():
-        # 发送历史消息
-        for msg in history_messages:
-            yield f"data: {json.dumps(msg)}\n\n"
-        
-        # 持续监听新消息
-        while True:
-            try:
-                # 等待新消息（超时1秒，用于心跳检测）
+        try:
+            # 发送历史消息
+            for frame in history_frames:
+                yield frame
+            
+            # 持续监听新消息
+            last_presence_refresh = time.time()
+            while not msg_queue.drained():
+                if time.time() - last_presence_refresh > SSE_PRESENCE_TTL / 3:
+                    refresh_sse_presence(user_id, msg_queue)
+                    last_presence_refresh = time.time()
+                
+                # 等待新消息（超时后发送心跳）
                 try:
-                    msg = msg_queue.get(timeout=1)
-                    yield f"data: {json.dumps(msg)}\n\n"
+                    yield msg_queue.get(timeout=SSE_HEARTBEAT_INTERVAL)
                 except queue.Empty:
                     # 发送心跳
-                    yield f": heartbeat\n\n"
-            except GeneratorExit:
-                break
-            except Exception as e:
-                print(f"SSE事件流错误: {e}")
-                break
-    
-    # 清理连接
-    def cleanup():
-        with sse_connections_lock:
-            sse_connections.pop(user_id, None)
+                    yield SSE_HEARTBEAT_FRAME
+        except GeneratorExit:
+            pass
+        except Exception as e:
+            print(f"SSE事件流错误: {e}")
+        finally:
+            # 客户端断开时清理连接
+            unregister_sse_connection(user_id, msg_queue)
     
     response = Response(
         generate(),
@@ -2576,10 +4220,6 @@ def events():
         }
     )
     
-    # 注册清理函数
-    import atexit
-    atexit.register(cleanup)
-    
     return add_cors_headers(response)
 
 
@@ -2630,6 +4270,49 @@ def health():
     return add_cors_headers(response)
 
 
+def get_sse_metrics():
+    """本 worker 的SSE队列统计：每个连接的队列深度、丢弃/合并的帧数"""
+    with sse_connections_lock:
+        connections = list(sse_connections.items())
+    with sse_metrics_lock:
+        metrics = dict(sse_metrics)
+    metrics['connections'] = [
+        {
+            'user_id': user_id,
+            'policy': msg_queue.policy,
+            'depth': msg_queue.depth(),
+            'max_depth': msg_queue.max_depth,
+            'dropped': msg_queue.dropped,
+            'coalesced': msg_queue.coalesced,
+        }
+        for user_id, msg_queue in connections
+    ]
+    return metrics
+
+
+@app.route('/api/metrics', methods=['GET', 'OPTIONS'])
+def metrics():
+    """运行指标（按 worker 统计）"""
+    if request.method == 'OPTIONS':
+        response = jsonify({})
+        return add_cors_headers(response)
+    
+    response = jsonify({
+        'pid': os.getpid(),
+        'sse': get_sse_metrics(),
+        'classifier_cache': {
+            'router': router_cache.stats(),
+            'travel_supervisor': supervisor_cache.stats(),
+        },
+        'local_router': local_intent_router.stats(),
+        'budget_extraction': dict(budget_extraction_stats),
+        'budget_check': dict(budget_check_stats),
+        'structured_output': dict(json_stream_stats),
+        'llm_client': llm_client_pool.stats()
+    })
+    return add_cors_headers(response)
+
+
 @app.route('/api/bills', methods=['POST', 'OPTIONS'])
 def save_bills():
     """保存账单数据到数据库"""
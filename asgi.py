@@ -0,0 +1,245 @@
+"""ASGI 入口：/api/chat 和 /api/events 由 asyncio 直接服务，其余接口交给 Flask（WSGI）处理
+
+运行方式：
+    uvicorn asgi:application --host 0.0.0.0 --port $PORT
+
+空闲的 /api/events 监听者只占用一个协程，不再占用 gunicorn 线程；
+/api/chat 的生成过程仍复用 app.generate_with_broadcast（规划流水线是同步代码），
+通过有界线程池逐块驱动，线程只在生成期间被占用。
+"""
+import asyncio
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import parse_qs
+
+from asgiref.wsgi import WsgiToAsgi
+
+from app import (
+    app,
+    SSE_HEARTBEAT_FRAME,
+    SSE_HEARTBEAT_INTERVAL,
+    SSE_PRESENCE_TTL,
+    SSE_QUEUE_SIZE,
+    SSE_SLOW_CONSUMER_POLICY,
+    SubscriberQueue,
+    generate_with_broadcast,
+    parse_last_event_id,
+    refresh_sse_presence,
+    register_sse_connection,
+    start_chat_turn,
+    unregister_sse_connection,
+)
+
+# 驱动同步生成器的线程池（只在 /api/chat 生成期间占用线程）
+chat_executor = ThreadPoolExecutor(
+    max_workers=int(os.getenv('ASGI_CHAT_THREADS', '32')),
+    thread_name_prefix='asgi-chat'
+)
+
+wsgi_application = WsgiToAsgi(app)
+
+CORS_HEADERS = [
+    (b'access-control-allow-origin', b'*'),
+    (b'access-control-allow-methods', b'GET, POST, PUT, DELETE, OPTIONS, HEAD'),
+    (b'access-control-allow-headers', b'Content-Type, Authorization, X-Requested-With, X-Session-ID, X-User-ID'),
+    (b'access-control-allow-credentials', b'false'),
+    (b'access-control-max-age', b'3600'),
+]
+
+SSE_HEADERS = [
+    (b'content-type', b'text/event-stream; charset=utf-8'),
+    (b'cache-control', b'no-cache'),
+    (b'x-accel-buffering', b'no'),
+] + CORS_HEADERS
+
+_STREAM_END = object()
+
+
+class AsyncSubscriberQueue(SubscriberQueue):
+    """供事件循环消费的SSE订阅队列
+
+    put 与同步模式相同（任意线程调用，队列满时按慢速客户端策略处理），
+    有新帧时通过 call_soon_threadsafe 唤醒事件循环中等待的 get。
+    """
+
+    def __init__(self, loop, maxsize=100, policy='coalesce'):
+        super().__init__(maxsize, policy)
+        self._loop = loop
+        self._event = asyncio.Event()
+
+    def _notify_locked(self):
+        # 事件循环已关闭（进程退出、连接结束后队列仍被引用）时不再唤醒，
+        # 不能让异常传回广播线程，影响投递给其他订阅者
+        if self._loop.is_closed():
+            return
+        try:
+            self._loop.call_soon_threadsafe(self._event.set)
+        except RuntimeError:
+            pass
+
+    async def get(self, timeout):
+        """取出下一个帧，超时抛出 asyncio.TimeoutError"""
+        self._event.clear()
+        with self._lock:
+            frame = self._pop_locked()
+        if frame is None:
+            await asyncio.wait_for(self._event.wait(), timeout)
+            with self._lock:
+                frame = self._pop_locked()
+            if frame is None:
+                raise asyncio.TimeoutError
+        return frame
+
+
+def _get_header(scope, name):
+    """读取请求头（name 为小写 bytes）"""
+    for key, value in scope.get('headers', []):
+        if key == name:
+            return value.decode('latin-1')
+    return None
+
+
+def _get_query_param(scope, name):
+    """读取查询参数"""
+    values = parse_qs(scope.get('query_string', b'').decode('latin-1')).get(name)
+    return values[0] if values else None
+
+
+async def _send_json(send, status, payload):
+    body = json.dumps(payload).encode('utf-8')
+    await send({
+        'type': 'http.response.start',
+        'status': status,
+        'headers': [(b'content-type', b'application/json'), (b'content-length', str(len(body)).encode())] + CORS_HEADERS,
+    })
+    await send({'type': 'http.response.body', 'body': body})
+
+
+async def _read_body(receive):
+    body = b''
+    while True:
+        message = await receive()
+        if message['type'] == 'http.disconnect':
+            return None
+        body += message.get('body', b'')
+        if not message.get('more_body', False):
+            return body
+
+
+async def _watch_disconnect(receive, disconnected):
+    """等待客户端断开（请求体已读完后 receive 只会返回 http.disconnect）"""
+    while True:
+        message = await receive()
+        if message['type'] == 'http.disconnect':
+            disconnected.set()
+            return
+
+
+async def chat(scope, receive, send):
+    """处理聊天请求，返回流式响应（与 app.chat 行为一致）"""
+    body = await _read_body(receive)
+    if body is None:
+        return
+    try:
+        data = json.loads(body) if body else None
+    except ValueError:
+        data = None
+    if not data:
+        await _send_json(send, 400, {'error': '请求体不能为空'})
+        return
+
+    user_message = data.get('message', '')
+    if not user_message:
+        await _send_json(send, 400, {'error': '消息不能为空'})
+        return
+
+    loop = asyncio.get_running_loop()
+    user_id = _get_header(scope, b'x-user-id') or data.get('user_id', None)
+    session_id, user_id, username = await loop.run_in_executor(chat_executor, start_chat_turn, user_message, user_id)
+
+    disconnected = asyncio.Event()
+    watcher = asyncio.create_task(_watch_disconnect(receive, disconnected))
+    generator = generate_with_broadcast(user_message, session_id, user_id, username)
+    try:
+        await send({'type': 'http.response.start', 'status': 200, 'headers': SSE_HEADERS})
+        while not disconnected.is_set():
+            chunk = await loop.run_in_executor(chat_executor, next, generator, _STREAM_END)
+            if chunk is _STREAM_END:
+                break
+            await send({'type': 'http.response.body', 'body': chunk.encode('utf-8'), 'more_body': True})
+        if not disconnected.is_set():
+            await send({'type': 'http.response.body', 'body': b''})
+    finally:
+        watcher.cancel()
+        # 关闭生成器（会停止仍在运行的规划阶段），必须在线程中执行以免阻塞事件循环
+        await loop.run_in_executor(chat_executor, generator.close)
+
+
+async def events(scope, receive, send):
+    """SSE事件流，用于接收广播消息（与 app.events 行为一致）"""
+    user_id = _get_header(scope, b'x-user-id') or _get_query_param(scope, 'user_id')
+    if not user_id:
+        await _send_json(send, 400, {'error': 'user_id is required'})
+        return
+
+    loop = asyncio.get_running_loop()
+    msg_queue = AsyncSubscriberQueue(loop, SSE_QUEUE_SIZE, _get_query_param(scope, 'policy') or SSE_SLOW_CONSUMER_POLICY)
+    last_event_id = parse_last_event_id(_get_header(scope, b'last-event-id') or _get_query_param(scope, 'last_event_id'))
+    history_frames = await loop.run_in_executor(chat_executor, register_sse_connection, user_id, msg_queue, last_event_id)
+
+    disconnected = asyncio.Event()
+    watcher = asyncio.create_task(_watch_disconnect(receive, disconnected))
+    try:
+        await send({'type': 'http.response.start', 'status': 200, 'headers': SSE_HEADERS})
+        for frame in history_frames:
+            await send({'type': 'http.response.body', 'body': frame, 'more_body': True})
+
+        last_presence_refresh = loop.time()
+        while not disconnected.is_set() and not msg_queue.drained():
+            if loop.time() - last_presence_refresh > SSE_PRESENCE_TTL / 3:
+                await loop.run_in_executor(chat_executor, refresh_sse_presence, user_id, msg_queue)
+                last_presence_refresh = loop.time()
+
+            try:
+                frame = await msg_queue.get(SSE_HEARTBEAT_INTERVAL)
+            except asyncio.TimeoutError:
+                frame = SSE_HEARTBEAT_FRAME
+            await send({'type': 'http.response.body', 'body': frame, 'more_body': True})
+        if not disconnected.is_set():
+            # 慢速客户端已发送 resync 标记，结束响应
+            await send({'type': 'http.response.body', 'body': b''})
+    except OSError:
+        # 客户端已断开
+        pass
+    finally:
+        watcher.cancel()
+        await loop.run_in_executor(chat_executor, unregister_sse_connection, user_id, msg_queue)
+
+
+ASYNC_ROUTES = {
+    ('POST', '/api/chat'): chat,
+    ('GET', '/api/events'): events,
+}
+
+
+async def application(scope, receive, send):
+    """ASGI 应用"""
+    if scope['type'] == 'lifespan':
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                chat_executor.shutdown(wait=False)
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    handler = None
+    if scope['type'] == 'http':
+        handler = ASYNC_ROUTES.get((scope['method'], scope['path']))
+    if handler is None:
+        # 其余接口（包括 OPTIONS 预检）交给 Flask
+        await wsgi_application(scope, receive, send)
+        return
+    await handler(scope, receive, send)
@@ -0,0 +1,133 @@
+"""跨进程广播总线
+
+broadcast_message 发布的消息需要送达所有 worker 上的SSE订阅者：
+- LocalBroadcastBus：单进程，直接投递（默认）
+- SQLiteBroadcastBus：SQLite 追加日志，不需要任何外部服务；
+  每个 worker 只有一个订阅线程，按日志 id 顺序读取新消息并投递给本 worker 的订阅者
+
+投递函数的签名为 handler(event_id, message)，event_id 单调递增，用作SSE事件id。
+"""
+import itertools
+import json
+import os
+import sqlite3
+import threading
+import time
+
+
+class LocalBroadcastBus:
+    """进程内广播：publish 时直接调用投递函数（事件id为进程内计数）"""
+
+    def __init__(self):
+        self._handler = None
+        self._event_ids = itertools.count(1)
+        self._lock = threading.Lock()
+
+    def start(self, handler):
+        self._handler = handler
+
+    def publish(self, message):
+        # 加锁保证事件id递增的顺序与投递顺序一致
+        with self._lock:
+            self._handler(next(self._event_ids), message)
+
+
+class SQLiteBroadcastBus:
+    """基于 SQLite 追加日志的广播总线
+
+    publish 只写入一行并唤醒本进程的订阅线程；其他 worker 的订阅线程每 poll_interval 秒
+    检查一次新行。所有消息（包括本进程发布的）都由订阅线程按 id 顺序投递，
+    因此每个 worker 看到的消息顺序一致；日志 id 即事件id，所有 worker 相同。
+    """
+
+    def __init__(self, path, poll_interval=0.05, retention=5000, warm_history=1000):
+        self.path = path
+        self.poll_interval = poll_interval
+        self.retention = retention
+        self.warm_history = warm_history
+        self._handler = None
+        self._wakeup = threading.Event()
+        self._local = threading.local()
+        self._thread = None
+        self._pid = None
+        self._start_lock = threading.Lock()
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._connection().execute(
+            "CREATE TABLE IF NOT EXISTS broadcast_log ("
+            " id INTEGER PRIMARY KEY AUTOINCREMENT,"
+            " payload TEXT NOT NULL,"
+            " created_at REAL NOT NULL)"
+        )
+
+    def _connection(self):
+        """每个线程一个连接（sqlite3 连接不能跨线程共享）"""
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.conn = conn
+        return conn
+
+    def start(self, handler):
+        self._handler = handler
+        self._ensure_running()
+
+    def _ensure_running(self):
+        """启动订阅线程（gunicorn fork 出的 worker 中会重新启动）"""
+        if self._pid == os.getpid() and self._thread and self._thread.is_alive():
+            return
+        with self._start_lock:
+            if self._pid == os.getpid() and self._thread and self._thread.is_alive():
+                return
+            self._pid = os.getpid()
+            self._local = threading.local()
+            self._thread = threading.Thread(target=self._run, name='broadcast-bus', daemon=True)
+            self._thread.start()
+
+    def publish(self, message):
+        self._ensure_running()
+        self._connection().execute(
+            "INSERT INTO broadcast_log (payload, created_at) VALUES (?, ?)",
+            (json.dumps(message, ensure_ascii=False), time.time())
+        )
+        self._wakeup.set()
+
+    def _run(self):
+        conn = self._connection()
+        # 先回放最近的日志，让新启动的 worker 拥有完整的消息历史
+        row = conn.execute("SELECT COALESCE(MAX(id), 0) FROM broadcast_log").fetchone()
+        last_id = max(row[0] - self.warm_history, 0)
+        last_prune = time.time()
+        while True:
+            try:
+                rows = conn.execute(
+                    "SELECT id, payload FROM broadcast_log WHERE id > ? ORDER BY id LIMIT 500", (last_id,)
+                ).fetchall()
+                for row_id, payload in rows:
+                    last_id = row_id
+                    try:
+                        self._handler(row_id, json.loads(payload))
+                    except Exception as e:
+                        print(f"广播总线投递消息出错: {e}")
+                if len(rows) == 500:
+                    continue
+
+                # 定期清理旧日志（保留最近 retention 条）
+                if time.time() - last_prune > 60:
+                    conn.execute("DELETE FROM broadcast_log WHERE id <= ?", (last_id - self.retention,))
+                    last_prune = time.time()
+            except sqlite3.Error as e:
+                print(f"广播总线读取日志出错: {e}")
+            self._wakeup.wait(self.poll_interval)
+            self._wakeup.clear()
+
+
+def create_broadcast_bus(backend, sqlite_path):
+    """根据配置创建广播总线：local（默认）或 sqlite"""
+    if backend == 'sqlite':
+        print(f"使用 SQLite 跨进程广播总线: {sqlite_path}")
+        return SQLiteBroadcastBus(sqlite_path)
+    if backend != 'local':
+        print(f"警告: 未知的 BROADCAST_BUS={backend}，使用进程内广播")
+    return LocalBroadcastBus()
@@ -0,0 +1,332 @@
+"""本地预算估算
+
+路线规划师和饭店规划师的提示词要求最后给出全程费用汇总行（"Total Estimated Trip Cost: $810"、
+"Total Estimated Food Cost: $300 for the whole group"）。这里直接从计划文本中解析价格，
+按预算检查 LLM 的规则（费用合计 + 10% 应急费用）算出总费用和剩余预算，结果与 parse_budget_check_result 的格式一致。
+
+只有每份计划都给出了全程（整个团队）的费用时才可靠：
+- 全程汇总行：取其中最大的金额
+- 逐天的小计：逐天相加。饭店计划逐天生成时每天给出当天餐饮费用
+  （"Estimated food cost for this day: $90 for the whole group"），长行程的路线计划并行逐天生成时
+  每天给出当天费用（"Estimated cost for this day: $210 for the whole group"），没有全程汇总行
+分类小计（"Total accommodation cost: $525"）、单项价格、人均价格（不知道人数）、多种货币或预算货币不明时
+置信度低于阈值，调用方应改用预算检查 LLM。
+"""
+import re
+
+CONTINGENCY_RATE = 0.1
+# 预算低于估算费用的这个比例时视为不可行（与预算检查提示词的 HARD_LIMIT 规则一致）
+HARD_LIMIT_RATIO = 0.3
+
+CONFIDENCE_TOTAL = 0.9
+CONFIDENCE_DAY_TOTALS = 0.75
+CONFIDENCE_SUBTOTALS = 0.5
+CONFIDENCE_ITEMS = 0.4
+CONFIDENCE_PER_PERSON = 0.3
+
+CURRENCY_SYMBOLS = {
+    'US$': 'USD', 'HK$': 'HKD', 'NT$': 'TWD', 'S$': 'SGD', 'A$': 'AUD', 'C$': 'CAD',
+    '$': 'USD', '€': 'EUR', '£': 'GBP', '¥': 'JPY', '￥': 'CNY', '₩': 'KRW', '₹': 'INR', '฿': 'THB',
+}
+CURRENCY_WORDS = {
+    'usd': 'USD', 'dollar': 'USD', 'dollars': 'USD', 'eur': 'EUR', 'euro': 'EUR', 'euros': 'EUR',
+    'gbp': 'GBP', 'pound': 'GBP', 'pounds': 'GBP', 'cny': 'CNY', 'rmb': 'CNY', 'yuan': 'CNY', '元': 'CNY',
+    'jpy': 'JPY', 'yen': 'JPY', '円': 'JPY', '日元': 'JPY', 'hkd': 'HKD', 'twd': 'TWD', 'sgd': 'SGD',
+    'aud': 'AUD', 'cad': 'CAD', 'krw': 'KRW', 'won': 'KRW', 'thb': 'THB', 'baht': 'THB', 'inr': 'INR',
+    'chf': 'CHF', '美元': 'USD', '欧元': 'EUR', '英镑': 'GBP',
+}
+DISPLAY_SYMBOLS = {'USD': '$', 'EUR': '€', 'GBP': '£', 'JPY': '¥', 'CNY': '¥'}
+
+_NUMBER = r'\d{1,3}(?:,\d{3})+(?:\.\d+)?|\d+(?:\.\d+)?'
+_SYMBOL = '|'.join(re.escape(symbol) for symbol in CURRENCY_SYMBOLS)
+_WORD = '|'.join(sorted(CURRENCY_WORDS, key=len, reverse=True))
+_RANGE_SEPARATOR = r'\s*(?:-|–|—|~|to)\s*'
+MONEY_PATTERN = re.compile(
+    # 货币符号在前："$80"、"€30-50"、"$80–$120"
+    rf'(?P<symbol>{_SYMBOL})\s?(?P<low>{_NUMBER})(?:{_RANGE_SEPARATOR}(?:{_SYMBOL})?\s?(?P<high>{_NUMBER}))?'
+    # 货币代码/单位在后："120 EUR"、"300-500 元"
+    rf'|(?P<low2>{_NUMBER})(?:{_RANGE_SEPARATOR}(?P<high2>{_NUMBER}))?\s?(?P<word>{_WORD})(?![a-z])'
+    # 货币代码在前："USD 120"
+    rf'|\b(?P<word3>usd|eur|gbp|cny|rmb|jpy|hkd|twd|sgd|aud|cad|krw|thb|inr|chf)\s?(?P<low3>{_NUMBER})(?:{_RANGE_SEPARATOR}(?P<high3>{_NUMBER}))?',
+    re.IGNORECASE
+)
+
+TOTAL_LINE_PATTERN = re.compile(r'\btotal\b|\boverall\b|\bin all\b|\bsum\b|总计|合计|总共|共计|总费用|总花费|总价', re.IGNORECASE)
+DAY_SCOPE_PATTERN = re.compile(
+    r'\bday\s*\d+\b|\bthis day\b|\bper day\b|\bdaily\b|/\s*day\b|\beach day\b|第\s*\d+\s*天|每天|当天|\bfor the day\b',
+    re.IGNORECASE
+)
+DAY_TOTAL_PATTERN = re.compile(r'\btotal\b|\bcost\b|\bsubtotal\b|小计|费用|花费|合计', re.IGNORECASE)
+# 每晚/每天的单价不是汇总
+PER_UNIT_PATTERN = re.compile(r'^\s*(?:per|/|a|each)\s*(?:night|day|nt)\b|^\s*(?:每晚|每天|/晚|/天)', re.IGNORECASE)
+# 预算和剩余金额的复述不是费用
+NOT_COST_PATTERN = re.compile(
+    r'\bremaining\b|\bleft\b|\bsav(?:e|es|ed|ing|ings)\b|\bunder budget\b|\bover budget\b|\bwithin\b|\bdeficit\b|\bexceed|剩余|节省|超出|余额',
+    re.IGNORECASE
+)
+# 分类小计（"Total accommodation cost"）不是全程汇总；饭店计划中餐饮本身就是全部内容，只按餐次区分
+ROUTE_CATEGORY_PATTERN = re.compile(
+    r'\b(?:accommodations?|hotels?|lodging|stays?|transport(?:ation)?|transit|trains?|flights?|taxis?|'
+    r'activit(?:y|ies)|attractions?|sightseeing|tickets?|entrance|admissions?|food|meals?|dining|restaurants?)\b|'
+    r'住宿|酒店|交通|门票|景点|餐饮',
+    re.IGNORECASE
+)
+RESTAURANT_CATEGORY_PATTERN = re.compile(r'\b(?:breakfasts?|lunch(?:es)?|dinners?|snacks?|drinks?|coffee)\b|早餐|午餐|晚餐', re.IGNORECASE)
+PER_PERSON_PATTERN = re.compile(r'\bper (?:person|head|pax)\b|/\s*person\b|\bpp\b|\beach person\b|人均|每人', re.IGNORECASE)
+BUDGET_WORD_PATTERN = re.compile(r'\bbudget\b|预算', re.IGNORECASE)
+COST_WORD_PATTERN = re.compile(r'\bcost\b|\bestimat|\bspend|\bexpense|\bprice\b|费用|花费', re.IGNORECASE)
+
+
+def _number(text):
+    return float(text.replace(',', ''))
+
+
+def find_money(line):
+    """解析一行中的金额，返回 [(金额, 货币, 结束位置)]；区间取中间值"""
+    amounts = []
+    for match in MONEY_PATTERN.finditer(line):
+        if match.group('symbol'):
+            currency = CURRENCY_SYMBOLS[match.group('symbol')]
+            low, high = match.group('low'), match.group('high')
+        elif match.group('word'):
+            currency = CURRENCY_WORDS[match.group('word').lower()]
+            low, high = match.group('low2'), match.group('high2')
+        else:
+            currency = CURRENCY_WORDS[match.group('word3').lower()]
+            low, high = match.group('low3'), match.group('high3')
+        value = _number(low)
+        if high:
+            high_value = _number(high)
+            if high_value >= value:
+                value = (value + high_value) / 2
+        amounts.append((value, currency, match.end()))
+    return amounts
+
+
+class PlanCostTally:
+    """逐行累计一份计划中的全程汇总、分类小计、每天小计和单项价格（kind 为 route 或 restaurant）
+
+    每个金额记为 (金额, 是否人均)。
+    """
+
+    def __init__(self, max_budget=None, kind='route'):
+        self.max_budget = max_budget
+        self.kind = kind
+        self.category_pattern = RESTAURANT_CATEGORY_PATTERN if kind == 'restaurant' else ROUTE_CATEGORY_PATTERN
+        self.totals = []
+        self.subtotals = []
+        self.day_totals = []
+        self.items = []
+        self.currencies = set()
+        self._partial = ''
+
+    def feed(self, chunk):
+        lines = (self._partial + chunk).split('\n')
+        self._partial = lines.pop()
+        for line in lines:
+            self._feed_line(line)
+        return self
+
+    def finish(self):
+        if self._partial:
+            self._feed_line(self._partial)
+            self._partial = ''
+        return self
+
+    def _feed_line(self, line):
+        amounts = find_money(line)
+        if not amounts:
+            return
+        if NOT_COST_PATTERN.search(line):
+            return
+        is_total = bool(TOTAL_LINE_PATTERN.search(line))
+        # 某一类的每天费用（"Daily transport cost: $15"）不是当天小计
+        is_day_total = bool(
+            DAY_SCOPE_PATTERN.search(line) and DAY_TOTAL_PATTERN.search(line) and not self.category_pattern.search(line)
+        )
+        is_subtotal = is_total and bool(self.category_pattern.search(line))
+        per_person = bool(PER_PERSON_PATTERN.search(line))
+        for value, currency, end in amounts:
+            # 复述用户预算的金额（"Budget constraint: $1500.00"）
+            if BUDGET_WORD_PATTERN.search(line) and (not COST_WORD_PATTERN.search(line) or value == self.max_budget):
+                continue
+            self.currencies.add(currency)
+            amount = (value, per_person)
+            if PER_UNIT_PATTERN.search(line[end:end + 12]) and not is_day_total:
+                self.items.append(amount)
+            elif is_day_total:
+                self.day_totals.append(amount)
+            elif is_subtotal:
+                self.subtotals.append(amount)
+            elif is_total:
+                self.totals.append(amount)
+            else:
+                self.items.append(amount)
+
+    def estimate(self):
+        """返回 (费用, 置信度)；没有任何价格时返回 (None, 0)"""
+        if self.totals:
+            value, per_person = max(self.totals)
+            return value, CONFIDENCE_PER_PERSON if per_person else CONFIDENCE_TOTAL
+        for amounts, confidence in (
+            (self.day_totals, CONFIDENCE_DAY_TOTALS),
+            (self.subtotals, CONFIDENCE_SUBTOTALS),
+            (self.items, CONFIDENCE_ITEMS),
+        ):
+            if amounts:
+                if any(per_person for _, per_person in amounts):
+                    confidence = min(confidence, CONFIDENCE_PER_PERSON)
+                return sum(value for value, _ in amounts), confidence
+        return None, 0.0
+
+    def running_total(self):
+        """流式生成过程中到目前为止（完整的行）明确写出的费用：全体人数的汇总行，或小计之和
+
+        单项价格（可能是备选项）和按人计价的金额不计入，避免把零散价格加总后误判超支。
+        """
+        return max(
+            max((value for value, per_person in self.totals if not per_person), default=0.0),
+            sum(value for value, per_person in self.subtotals if not per_person),
+            sum(value for value, per_person in self.day_totals if not per_person),
+        )
+
+
+def detect_budget_currency(text, budget):
+    """文本中写明了与预算金额相同的金额时返回其货币（"budget $1500" -> USD），否则返回 None"""
+    try:
+        budget = float(budget)
+    except (TypeError, ValueError):
+        return None
+    for line in (text or '').splitlines():
+        for value, currency, _ in find_money(line):
+            if value == budget:
+                return currency
+    return None
+
+
+class RunningCostTally:
+    """流式规划时累计已生成的各份计划的费用，超出预算一定比例即可提前判定超支"""
+
+    def __init__(self, max_budget, margin, budget_currency=None):
+        self.max_budget = float(max_budget)
+        self.margin = margin
+        self.budget_currency = budget_currency
+        self.tallies = {}
+
+    def feed(self, plan, chunk, kind='route'):
+        self.tallies.setdefault(plan, PlanCostTally(self.max_budget, kind)).feed(chunk)
+        return self
+
+    def estimate(self):
+        # 路线计划里也常写餐饮费用，各份计划取最大者而不是相加，避免重复计算
+        return max((tally.running_total() for tally in self.tallies.values()), default=0.0)
+
+    def currency(self):
+        currencies = set()
+        for tally in self.tallies.values():
+            currencies |= tally.currencies
+        return currencies.pop() if len(currencies) == 1 else None
+
+    def over_budget(self):
+        # 预算货币未知或与计划货币不一致时无法比较，留给生成完成后的预算检查
+        if self.budget_currency is None or self.currency() != self.budget_currency:
+            return False
+        return self.estimate() > self.max_budget * (1 + self.margin)
+
+
+def format_money(amount, currency):
+    symbol = DISPLAY_SYMBOLS.get(currency)
+    if symbol:
+        return f"{symbol}{amount:,.0f}"
+    return f"{amount:,.0f} {currency}"
+
+
+def estimate_plan_cost(route_plan, restaurant_plan, max_budget=None, budget_currency=None):
+    """根据路线计划和饭店计划中的价格估算总费用
+
+    返回 (result, confidence)，result 与 parse_budget_check_result 的格式一致；
+    无法估算（没有价格、多种货币、有预算但预算货币不明或不同）时 result 为 None、confidence 为 0。
+    """
+    try:
+        max_budget = float(max_budget) if max_budget not in (None, '') else None
+    except (TypeError, ValueError):
+        max_budget = None
+
+    route_tally = PlanCostTally(max_budget, 'route').feed(route_plan or '').finish()
+    route_cost, confidence = route_tally.estimate()
+    if route_cost is None:
+        return None, 0.0
+    currencies = set(route_tally.currencies)
+
+    restaurant_cost = 0.0
+    if restaurant_plan and restaurant_plan.strip():
+        restaurant_tally = PlanCostTally(max_budget, 'restaurant').feed(restaurant_plan).finish()
+        restaurant_cost, restaurant_confidence = restaurant_tally.estimate()
+        if restaurant_cost is None:
+            return None, 0.0
+        confidence = min(confidence, restaurant_confidence)
+        currencies |= restaurant_tally.currencies
+
+    # 多种货币需要换算，预算货币不明时也无法比较，交给 LLM
+    if len(currencies) != 1:
+        return None, 0.0
+    currency = currencies.pop()
+    if max_budget is not None and currency != budget_currency:
+        return None, 0.0
+
+    subtotal = route_cost + restaurant_cost
+    total = round(subtotal * (1 + CONTINGENCY_RATE), 2)
+    breakdown = (
+        f"route {format_money(route_cost, currency)} + restaurants {format_money(restaurant_cost, currency)} "
+        f"+ {CONTINGENCY_RATE:.0%} contingency"
+    )
+    result = {
+        "success": True,
+        "budget_ok": True,
+        "is_feasible": True,
+        "currency": currency,
+        "max_budget": max_budget,
+        "total_estimated_cost": total,
+        "remaining_budget": None,
+        "error_type": "NONE",
+        "reason": "",
+        "suggestion": ""
+    }
+    if max_budget is None:
+        result["reason"] = (
+            f"No budget was specified. The estimated total cost is {format_money(total, currency)} ({breakdown})."
+        )
+        return result, confidence
+
+    remaining = round(max_budget - total, 2)
+    result["remaining_budget"] = remaining
+    if remaining >= 0:
+        result["reason"] = (
+            f"The estimated total cost is {format_money(total, currency)} ({breakdown}), which fits within your "
+            f"{format_money(max_budget, currency)} budget with {format_money(remaining, currency)} remaining."
+        )
+        return result, confidence
+
+    result["budget_ok"] = False
+    if max_budget < total * HARD_LIMIT_RATIO:
+        result["is_feasible"] = False
+        result["error_type"] = "HARD_LIMIT"
+        result["reason"] = (
+            f"Your {format_money(max_budget, currency)} budget is far below the estimated cost of this trip "
+            f"({format_money(total, currency)}: {breakdown})."
+        )
+        result["suggestion"] = (
+            f"Please increase your budget to at least {format_money(total, currency)}, "
+            f"or choose a shorter trip or a closer, cheaper destination."
+        )
+    else:
+        result["error_type"] = "OVER_BUDGET"
+        result["reason"] = (
+            f"The estimated total cost is {format_money(total, currency)} ({breakdown}), which exceeds your "
+            f"{format_money(max_budget, currency)} budget by {format_money(-remaining, currency)}."
+        )
+        result["suggestion"] = (
+            f"Increase your budget by about {format_money(-remaining, currency)}, "
+            f"or choose cheaper hotels and restaurants."
+        )
+    return result, confidence
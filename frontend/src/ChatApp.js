@@ -16,6 +16,7 @@ function ChatApp() {
   const abortControllerRef = useRef(null);
   const messageIdCounter = useRef(0);
   const eventSourceRef = useRef(null);
+  const lastEventIdRef = useRef(null);
   
   // 获取或创建user_id和username
   useEffect(() => {
@@ -70,24 +71,62 @@ function ChatApp() {
         eventSourceRef.current.close();
       }
       
-      const eventSource = new EventSource(`${API_URL}/api/events?user_id=${userId}`);
+      // 带上最后收到的事件id，服务器只补发断线期间错过的消息
+      const lastEventIdParam = lastEventIdRef.current ? `&last_event_id=${lastEventIdRef.current}` : '';
+      const eventSource = new EventSource(`${API_URL}/api/events?user_id=${userId}${lastEventIdParam}`);
       eventSourceRef.current = eventSource;
       
       eventSource.onmessage = (event) => {
         if (event.data === 'heartbeat') return;
+        if (event.lastEventId) {
+          lastEventIdRef.current = event.lastEventId;
+        }
         
         try {
           const message = JSON.parse(event.data);
           
+          // 服务器因客户端处理过慢断开连接：重新连接以补发历史消息
+          if (message.type === 'resync') {
+            connectEvents();
+            return;
+          }
+
+          // 增量更新：把 delta 追加到已有消息（序号不连续时忽略，等待下一次完整快照重新同步）
+          if (message.op === 'append') {
+            setMessages(prev => {
+              const existingIndex = prev.findIndex(msg => msg.id === message.id);
+              if (existingIndex < 0) return prev;
+
+              const existing = prev[existingIndex];
+              if (existing.seq !== undefined && message.seq !== existing.seq + 1) return prev;
+
+              const updated = [...prev];
+              updated[existingIndex] = {
+                ...existing,
+                content: (existing.content || '') + message.delta,
+                seq: message.seq,
+                isStreaming: message.isStreaming !== undefined ? message.isStreaming : existing.isStreaming
+              };
+              return updated;
+            });
+            return;
+          }
+          
           // 检查消息是否已存在（用于实时更新）
           setMessages(prev => {
             const existingIndex = prev.findIndex(msg => msg.id === message.id);
             
             if (existingIndex >= 0) {
-              // 如果消息已存在，更新它（用于流式更新）
+              // 忽略比当前内容更旧的快照
+              if (message.seq !== undefined && prev[existingIndex].seq !== undefined && message.seq < prev[existingIndex].seq) {
+                return prev;
+              }
+
+              // 如果消息已存在，用完整快照更新它（用于流式更新）
               const updated = [...prev];
               updated[existingIndex] = {
                 ...updated[existingIndex],
+                seq: message.seq !== undefined ? message.seq : updated[existingIndex].seq,
                 content: message.content !== undefined ? message.content : updated[existingIndex].content,
                 agent: message.agent !== undefined ? message.agent : updated[existingIndex].agent,
                 planner: message.planner !== undefined ? message.planner : updated[existingIndex].planner,
@@ -103,6 +142,7 @@ function ChatApp() {
               user_id: message.user_id,
               username: message.username,
               content: message.content || '',
+              seq: message.seq,
               agent: message.agent,
               planner: message.planner,
               timestamp: message.timestamp,
@@ -0,0 +1,517 @@
+"""LLM 客户端层
+
+每个 worker 进程共用一个 LLMClientPool：
+- 一个有上限的 httpx 长连接池，所有链复用已建立的 TLS 连接
+- 一个全局并发信号量，超过上限的调用排队等待，等待超过 queue_timeout 时放弃
+- 统计并发、排队、拒绝、超时次数和连接池占用，供 /api/metrics 查看
+
+ManagedChatOpenAI 是经过连接池和信号量的 ChatOpenAI，每个链可以单独设置
+连接超时、首个 token 超时和整体超时，例如：
+    pool = LLMClientPool(max_connections=20, max_concurrency=16)
+    llm = ManagedChatOpenAI(model="gpt-4o", client_pool=pool, timeout=pool.timeout(5, 30), total_timeout=120)
+
+每个链还可以设置：
+- retries：尚未收到任何输出时遇到临时错误（连接失败、超时、429、5xx）的重试次数，退避时间带随机抖动
+- hedge：对冲请求，首个 token 超过该链历史 p95 延迟（样本不足时用 hedge_after）仍未到达时
+  再发一个相同请求，采用先返回的一个并取消另一个
+- single_flight：同一个链、渲染后提示词完全相同的并发调用只向上游发一次请求，
+  后来的调用共享同一次生成的流式输出，生成结束后条目即失效
+
+base_url 指向本地 OpenAI 兼容的桩服务即可在不访问外网的情况下测试。
+"""
+import hashlib
+import json
+import queue
+import random
+import socket
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from typing import Any, Optional
+
+import httpx
+import openai
+from langchain_openai import ChatOpenAI
+
+
+# 可以重试的临时错误（APITimeoutError 是 APIConnectionError 的子类）
+TRANSIENT_ERRORS = (
+    openai.APIConnectionError,
+    openai.RateLimitError,
+    openai.InternalServerError,
+    httpx.TransportError,
+)
+HEDGE_MIN_SAMPLES = 20  # 统计 p95 所需的最少样本数
+
+_STREAM_DONE = object()
+
+# 当前线程正在执行的对冲请求（_HedgeAttempt），连接池的请求钩子据此挂上 trace 回调
+_current_attempt = threading.local()
+
+
+class LLMCapacityError(RuntimeError):
+    """并发已满且排队超时"""
+
+
+class _Flight:
+    """一次正在进行的生成：后台线程写入输出，所有订阅者按顺序读取（包括先到的部分）"""
+
+    def __init__(self, registry_lock, forget):
+        self.items = []
+        self.done = False
+        self.error = None
+        self.subscribers = 0
+        self.cancelled = False
+        self.condition = threading.Condition()
+        # SingleFlight 的锁和移除条目的回调（调用时已持有该锁）
+        self.registry_lock = registry_lock
+        self.forget = forget
+
+    def run(self, start, on_finish):
+        stream = None
+        try:
+            stream = start()
+            for item in stream:
+                with self.condition:
+                    self.items.append(item)
+                    self.condition.notify_all()
+                    if self.cancelled:
+                        break
+        except Exception as e:
+            self.error = e
+        finally:
+            if hasattr(stream, 'close'):
+                stream.close()
+            on_finish(self)
+            with self.condition:
+                self.done = True
+                self.condition.notify_all()
+
+    def subscribe(self):
+        index = 0
+        try:
+            while True:
+                with self.condition:
+                    while index >= len(self.items) and not self.done:
+                        self.condition.wait()
+                    if index >= len(self.items):
+                        if self.error is not None:
+                            raise self.error
+                        return
+                    item = self.items[index]
+                index += 1
+                yield item
+        finally:
+            # 所有订阅者都离开时取消生成，并在同一步移除条目，之后相同的调用会开始新的生成而不是拿到截断的输出
+            with self.registry_lock, self.condition:
+                self.subscribers -= 1
+                if self.subscribers == 0 and not self.done:
+                    self.cancelled = True
+                    self.forget(self)
+
+
+class _HedgeAttempt:
+    """对冲中的一个请求：记录它正在使用的连接，落选时立即断开，而不是等到它的下一次输出"""
+
+    def __init__(self, http_client):
+        self.http_client = http_client
+        self.lock = threading.Lock()
+        self.sock = None
+        self.cancelled = False
+
+    def trace(self, event, info):
+        """httpcore 的 trace 回调：发送请求头时记下所用连接的 socket，响应关闭（连接回到连接池）前清除，
+        两者与 cancel 互斥，不会断开已经交给其他请求的连接"""
+        if event == 'http11.send_request_headers.started':
+            sock = _request_socket(self.http_client, info.get('request'))
+            with self.lock:
+                self.sock = sock
+                if self.cancelled:
+                    _shutdown(sock)
+        elif event == 'http11.response_closed.started':
+            with self.lock:
+                self.sock = None
+
+    def cancel(self):
+        with self.lock:
+            self.cancelled = True
+            _shutdown(self.sock)
+
+
+def _request_socket(http_client, request):
+    """正在发送 request 的连接的 socket（依赖 httpcore 内部结构，取不到时返回 None）"""
+    pool = getattr(getattr(http_client, '_transport', None), '_pool', None)
+    for pool_request in list(getattr(pool, '_requests', ())):
+        if pool_request.request is request:
+            connection = getattr(pool_request.connection, '_connection', None)
+            network_stream = getattr(connection, '_network_stream', None)
+            return network_stream.get_extra_info('socket') if network_stream is not None else None
+    return None
+
+
+def _shutdown(sock):
+    """关闭 socket 的读写：阻塞在读取上的线程会立即出错返回，随后由该线程自己关闭响应、释放并发名额"""
+    if sock is None:
+        return
+    try:
+        sock.shutdown(socket.SHUT_RDWR)
+    except OSError:
+        pass
+
+
+def _attempt_cancelled():
+    attempt = getattr(_current_attempt, 'attempt', None)
+    return attempt is not None and attempt.cancelled
+
+
+class SingleFlight:
+    """相同 key 的并发调用共享同一次生成"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._flights = {}
+        self.leaders = 0
+        self.followers = 0
+
+    def run(self, key, start):
+        """返回一个输出迭代器：key 没有进行中的生成时启动 start()，否则加入已有的生成"""
+        with self._lock:
+            flight = self._flights.get(key)
+            if flight is not None:
+                with flight.condition:
+                    # 已取消或已结束的生成不再加入
+                    if flight.cancelled or flight.done:
+                        flight = None
+                    else:
+                        flight.subscribers += 1
+            if flight is None:
+                flight = self._flights[key] = _Flight(self._lock, lambda f: self._forget(key, f))
+                flight.subscribers = 1
+                self.leaders += 1
+                leader = True
+            else:
+                self.followers += 1
+                leader = False
+        if leader:
+            threading.Thread(target=flight.run, args=(start, lambda f: self._finish(key, f)), daemon=True, name='llm-single-flight').start()
+        return flight.subscribe(), leader
+
+    def _finish(self, key, flight):
+        with self._lock:
+            self._forget(key, flight)
+
+    def _forget(self, key, flight):
+        # 调用方已持有 self._lock
+        if self._flights.get(key) is flight:
+            del self._flights[key]
+
+    def stats(self):
+        with self._lock:
+            return {'in_flight': len(self._flights), 'leaders': self.leaders, 'followers': self.followers}
+
+
+class LLMClientPool:
+    """共享的 httpx 连接池和全局并发限制"""
+
+    def __init__(self, max_connections=20, max_concurrency=16, queue_timeout=30, keepalive_expiry=60):
+        self.max_connections = max_connections
+        self.max_concurrency = max_concurrency
+        self.queue_timeout = queue_timeout
+        self.http_client = httpx.Client(
+            limits=httpx.Limits(
+                max_connections=max_connections,
+                max_keepalive_connections=max_connections,
+                keepalive_expiry=keepalive_expiry
+            ),
+            event_hooks={'request': [self._trace_hedge_attempt]}
+        )
+        self._semaphore = threading.BoundedSemaphore(max_concurrency)
+        self._lock = threading.Lock()
+        self.requests = 0
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.waiting = 0
+        self.max_waiting = 0
+        self.rejected = 0
+        self.deadline_exceeded = 0
+        self.total_wait = 0.0
+        self.single_flight = SingleFlight()
+        self.chain_stats = {}  # {chain名: {calls, shared, retries, hedges, hedge_wins}}
+        self.first_token_latencies = {}  # {chain名: deque(最近的首 token 延迟秒数)}
+
+    @staticmethod
+    def _trace_hedge_attempt(request):
+        # 对冲请求的线程中发出的请求挂上 trace 回调，落选时可以直接断开连接
+        attempt = getattr(_current_attempt, 'attempt', None)
+        if attempt is not None:
+            request.extensions['trace'] = attempt.trace
+
+    def timeout(self, connect, read):
+        """单次请求的 httpx 超时：read 同时限制首个 token 的等待时间和两次数据之间的间隔"""
+        return httpx.Timeout(connect=connect, read=read, write=connect, pool=self.queue_timeout)
+
+    @contextmanager
+    def slot(self):
+        """占用一个并发名额，排队超过 queue_timeout 时抛出 LLMCapacityError"""
+        started = time.time()
+        with self._lock:
+            self.waiting += 1
+            self.max_waiting = max(self.max_waiting, self.waiting)
+        acquired = self._semaphore.acquire(timeout=self.queue_timeout)
+        with self._lock:
+            self.waiting -= 1
+            if not acquired:
+                self.rejected += 1
+            else:
+                self.requests += 1
+                self.in_flight += 1
+                self.max_in_flight = max(self.max_in_flight, self.in_flight)
+                self.total_wait += time.time() - started
+        if not acquired:
+            raise LLMCapacityError(f"LLM 并发已满（{self.max_concurrency}），排队超过 {self.queue_timeout} 秒")
+        try:
+            yield
+        finally:
+            with self._lock:
+                self.in_flight -= 1
+            self._semaphore.release()
+
+    def record_deadline_exceeded(self):
+        with self._lock:
+            self.deadline_exceeded += 1
+
+    def record_chain(self, chain, field):
+        """链级计数：calls / shared / retries / hedges / hedge_wins"""
+        with self._lock:
+            stats = self.chain_stats.setdefault(chain, {'calls': 0, 'shared': 0, 'retries': 0, 'hedges': 0, 'hedge_wins': 0})
+            stats[field] += 1
+
+    def record_first_token(self, chain, latency):
+        with self._lock:
+            self.first_token_latencies.setdefault(chain, deque(maxlen=200)).append(latency)
+
+    def first_token_p95(self, chain):
+        """该链最近首 token 延迟的 p95，样本不足时返回 None"""
+        with self._lock:
+            latencies = sorted(self.first_token_latencies.get(chain, ()))
+        if len(latencies) < HEDGE_MIN_SAMPLES:
+            return None
+        return latencies[int(len(latencies) * 0.95) - 1]
+
+    def _chain_stats(self):
+        result = {}
+        for chain, stats in self.chain_stats.items():
+            calls = stats['calls']
+            p95 = self.first_token_p95(chain)
+            result[chain] = dict(
+                stats,
+                retry_rate=round(stats['retries'] / calls, 4) if calls else 0.0,
+                hedge_rate=round(stats['hedges'] / calls, 4) if calls else 0.0,
+                first_token_p95_ms=round(p95 * 1000, 1) if p95 is not None else None
+            )
+        return result
+
+    def _connection_stats(self):
+        """连接池中的连接数和空闲连接数（依赖 httpcore 内部结构，取不到时返回 None）"""
+        pool = getattr(getattr(self.http_client, '_transport', None), '_pool', None)
+        connections = getattr(pool, 'connections', None)
+        if connections is None:
+            return None, None
+        connections = list(connections)
+        return len(connections), sum(1 for connection in connections if connection.is_idle())
+
+    def stats(self):
+        connections, idle = self._connection_stats()
+        chains = self._chain_stats()
+        with self._lock:
+            return {
+                'max_concurrency': self.max_concurrency,
+                'max_connections': self.max_connections,
+                'requests': self.requests,
+                'in_flight': self.in_flight,
+                'max_in_flight': self.max_in_flight,
+                'saturation': round(self.in_flight / self.max_concurrency, 4),
+                'waiting': self.waiting,
+                'max_waiting': self.max_waiting,
+                'rejected': self.rejected,
+                'deadline_exceeded': self.deadline_exceeded,
+                'avg_wait_ms': round(self.total_wait / self.requests * 1000, 2) if self.requests else 0.0,
+                'connections': connections,
+                'idle_connections': idle,
+                'chains': chains,
+                'single_flight': self.single_flight.stats(),
+            }
+
+
+class ManagedChatOpenAI(ChatOpenAI):
+    """经过 LLMClientPool 的 ChatOpenAI：调用期间占用一个并发名额，流式输出超过 total_timeout 时中止，
+    按 retries / hedge / single_flight 设置重试、对冲和合并相同请求（SDK 自带的重试应设为 max_retries=0）"""
+
+    client_pool: Any = None
+    chain_name: str = 'default'
+    total_timeout: Optional[float] = None
+    retries: int = 0
+    retry_backoff: float = 0.5
+    hedge: bool = False
+    hedge_after: float = 2.0
+    single_flight: bool = True
+
+    def __init__(self, client_pool, **kwargs):
+        super().__init__(client_pool=client_pool, http_client=client_pool.http_client, **kwargs)
+
+    def _generate(self, messages, stop=None, run_manager=None, **kwargs):
+        def start():
+            if not self.hedge:
+                return iter([self._retrying_generate(messages, stop=stop, **kwargs)])
+            return self._hedged(lambda: iter([self._retrying_generate(messages, stop=stop, **kwargs)]))
+
+        for result in self._single_flight(messages, stop, kwargs, 'generate', start):
+            return result
+
+    def _stream(self, messages, stop=None, run_manager=None, **kwargs):
+        def start():
+            if not self.hedge:
+                return self._retrying_stream(messages, stop=stop, **kwargs)
+            return self._hedged(lambda: self._retrying_stream(messages, stop=stop, **kwargs))
+
+        for chunk in self._single_flight(messages, stop, kwargs, 'stream', start):
+            # 多个订阅者共享同一个 chunk，调用方会修改 chunk.message，因此各自复制一份
+            yield chunk.model_copy(update={'message': chunk.message.model_copy()})
+
+    def _single_flight(self, messages, stop, kwargs, mode, start):
+        """相同链、相同提示词的并发调用共享一次生成（single_flight 关闭时直接执行）"""
+        if not self.single_flight:
+            self.client_pool.record_chain(self.chain_name, 'calls')
+            return start()
+        rendered = json.dumps(
+            [mode, [(message.type, message.content) for message in messages], stop, sorted(kwargs.items())],
+            ensure_ascii=False, default=str
+        )
+        key = (self.chain_name, hashlib.sha256(rendered.encode('utf-8')).hexdigest())
+        items, leader = self.client_pool.single_flight.run(key, start)
+        self.client_pool.record_chain(self.chain_name, 'calls' if leader else 'shared')
+        return items
+
+    def _retry_delay(self, attempt):
+        """指数退避加随机抖动（full jitter），最长 8 秒"""
+        return random.uniform(0, min(8.0, self.retry_backoff * (2 ** attempt)))
+
+    def _retrying_generate(self, *args, **kwargs):
+        attempt = 0
+        while True:
+            try:
+                return self._attempt_generate(*args, **kwargs)
+            except TRANSIENT_ERRORS:
+                # 落选的对冲请求被断开后不再重试
+                if attempt >= self.retries or _attempt_cancelled():
+                    raise
+            self.client_pool.record_chain(self.chain_name, 'retries')
+            time.sleep(self._retry_delay(attempt))
+            attempt += 1
+
+    def _retrying_stream(self, *args, **kwargs):
+        """只在尚未输出任何内容时重试，已经输出的内容无法撤回"""
+        attempt = 0
+        while True:
+            started_output = False
+            try:
+                for chunk in self._attempt_stream(*args, **kwargs):
+                    started_output = True
+                    yield chunk
+                return
+            except TRANSIENT_ERRORS:
+                if started_output or attempt >= self.retries or _attempt_cancelled():
+                    raise
+            self.client_pool.record_chain(self.chain_name, 'retries')
+            time.sleep(self._retry_delay(attempt))
+            attempt += 1
+
+    def _attempt_generate(self, *args, **kwargs):
+        with self.client_pool.slot():
+            started = time.time()
+            try:
+                result = super()._generate(*args, **kwargs)
+            except (openai.APITimeoutError, httpx.TimeoutException):
+                self.client_pool.record_deadline_exceeded()
+                raise
+            self.client_pool.record_first_token(self.chain_name, time.time() - started)
+            return result
+
+    def _attempt_stream(self, *args, **kwargs):
+        with self.client_pool.slot():
+            started = time.time()
+            deadline = started + self.total_timeout if self.total_timeout else None
+            first = True
+            try:
+                for chunk in super()._stream(*args, **kwargs):
+                    if first:
+                        self.client_pool.record_first_token(self.chain_name, time.time() - started)
+                        first = False
+                    yield chunk
+                    if deadline and time.time() > deadline:
+                        raise TimeoutError(f"{self.model_name} 生成超过 {self.total_timeout} 秒")
+            except (TimeoutError, openai.APITimeoutError, httpx.TimeoutException):
+                self.client_pool.record_deadline_exceeded()
+                raise
+
+    def _hedged(self, start_attempt):
+        """对冲执行 start_attempt() 返回的输出迭代器：第一个请求超过首 token p95 仍无输出时
+        再启动一个，采用先输出的一个，另一个立即断开连接（释放并发名额和连接）"""
+        results = queue.Queue()
+        attempts = [_HedgeAttempt(self.client_pool.http_client), _HedgeAttempt(self.client_pool.http_client)]
+        winner = None
+
+        def run(index):
+            _current_attempt.attempt = attempts[index]
+            stream = None
+            try:
+                stream = start_attempt()
+                for item in stream:
+                    if attempts[index].cancelled:
+                        return
+                    results.put((index, item, None))
+            except Exception as e:
+                results.put((index, None, e))
+                return
+            finally:
+                if hasattr(stream, 'close'):
+                    stream.close()
+                _current_attempt.attempt = None
+            results.put((index, _STREAM_DONE, None))
+
+        threading.Thread(target=run, args=(0,), daemon=True, name=f'llm-{self.chain_name}').start()
+        launched = 1
+        hedge_after = self.client_pool.first_token_p95(self.chain_name) or self.hedge_after
+        try:
+            try:
+                index, item, error = results.get(timeout=hedge_after)
+            except queue.Empty:
+                self.client_pool.record_chain(self.chain_name, 'hedges')
+                threading.Thread(target=run, args=(1,), daemon=True, name=f'llm-{self.chain_name}-hedge').start()
+                launched = 2
+                index, item, error = results.get()
+
+            # 一个请求失败而另一个仍在进行时，等待另一个
+            failed = 0
+            while error is not None:
+                failed += 1
+                if failed == launched:
+                    raise error
+                index, item, error = results.get()
+
+            winner = index
+            attempts[1 - winner].cancel()
+            if index == 1:
+                self.client_pool.record_chain(self.chain_name, 'hedge_wins')
+            while item is not _STREAM_DONE:
+                yield item
+                index, item, error = results.get()
+                while index != winner:
+                    index, item, error = results.get()
+                if error is not None:
+                    raise error
+        finally:
+            # 调用方提前停止时两个请求都断开
+            for attempt in attempts:
+                attempt.cancel()
@@ -0,0 +1,206 @@
+"""路线计划分段
+
+路线规划师输出的是按天组织的 Markdown 文本。这里把它拆成可以按天寻址的分段：
+- overview：第一天之前的概述
+- day-N：第 N 天（以 "Day N" / "### Day N: ..." / "**Day N**" / "第N天" 开头的行为分界，每个天数只有一个分段）
+- summary：最后一天之后、与天标题同级或更高级的标题开始的部分（费用汇总、贴士等）；其中的 "Day 1: $150" 不再分段
+
+join_route_sections(split_route_sections(plan)) == plan，分段只是对原文的切分，
+因此可以只重新生成受影响的分段再拼接回去。
+"""
+import re
+
+ROUTE_DAY_HEADING_PATTERN = re.compile(
+    r'^[ \t]*(#{1,6}[ \t]*)?(?:\*\*|__)?[ \t]*(?:day[ \t]*(\d{1,2})\b|第[ \t]*(\d{1,2})[ \t]*天)',
+    re.IGNORECASE
+)
+ROUTE_HEADING_PATTERN = re.compile(r'^[ \t]*(#{1,6})[ \t]+\S')
+ROUTE_BOLD_HEADING_PATTERN = re.compile(r'^[ \t]*(?:\*\*|__)[^*_\n]+(?:\*\*|__)[ \t]*:?[ \t]*$')
+
+ORDINAL_DAYS = {
+    'first': 1, 'second': 2, 'third': 3, 'fourth': 4, 'fifth': 5,
+    'sixth': 6, 'seventh': 7, 'eighth': 8, 'ninth': 9, 'tenth': 10,
+}
+DAY_REFERENCE_PATTERN = re.compile(
+    r'\bdays?[ \t]*(\d{1,2})(?:[ \t]*(?:-|–|to|and|&|,)[ \t]*(?:day[ \t]*)?(\d{1,2}))?\b'
+    r'|\b(first|second|third|fourth|fifth|sixth|seventh|eighth|ninth|tenth|last|final)[ \t]+day\b'
+    r'|第[ \t]*(\d{1,2})[ \t]*天',
+    re.IGNORECASE
+)
+# 明确要求整体重做的请求不做分段修改
+WHOLE_PLAN_PATTERN = re.compile(
+    r'\b(whole|entire|all[ \t]+(?:the[ \t]+)?days|every[ \t]+day|complete(?:ly)?|start[ \t]+over|from[ \t]+scratch|'
+    r'new[ \t]+plan|replan|re-plan)\b|整个|全部|重新规划',
+    re.IGNORECASE
+)
+
+
+def _heading_level(line):
+    """标题级别：# 的个数；加粗或纯文本标题视为最低级（7）"""
+    match = ROUTE_HEADING_PATTERN.match(line)
+    return len(match.group(1)) if match else 7
+
+
+# 天标题之后紧跟金额的行是费用明细（"Day 1: $150"），不是天标题
+ROUTE_DAY_PRICE_PATTERN = re.compile(
+    r'^[\s*_:：\-–—~|]*(?:[$€£¥￥₩₹]|(?:us|hk|nt|s|a|c)\$|(?:usd|eur|gbp|cny|rmb|jpy|hkd|twd|sgd|aud|cad|krw|thb|inr|chf)\b|'
+    r'\d[\d,.]*\s*(?:[a-z]{3}|dollars?|euros?|pounds?|yuan|yen|元|円)?[\s*_.]*$)',
+    re.IGNORECASE
+)
+
+
+def route_day_number(line):
+    """行是天标题时返回天数，否则返回 None
+
+    天标题是以 "Day N" / "第N天" 开头（可带 # 或加粗）、后面没有内容或跟着标题文字的行；
+    后面紧跟金额的行（费用汇总里的 "Day 1: $150"）不算。
+    """
+    match = ROUTE_DAY_HEADING_PATTERN.match(line)
+    if not match:
+        return None
+    if ROUTE_DAY_PRICE_PATTERN.match(line[match.end():].rstrip('\n')):
+        return None
+    return int(match.group(2) or match.group(3))
+
+
+class RouteSectionSplitter:
+    """增量分段：逐块喂入流式输出，返回已经完整的分段（下一个分段开始即表示上一个完整）"""
+
+    def __init__(self):
+        self.sections = [{'key': 'overview', 'day': None, 'title': '', 'text': ''}]
+        self._day_level = None
+        self._partial = ''
+        self._emitted = 0
+
+    def feed(self, chunk):
+        lines = (self._partial + chunk).splitlines(keepends=True)
+        self._partial = lines.pop() if lines and not lines[-1].endswith('\n') else ''
+        for line in lines:
+            self._feed_line(line)
+        return self._take(len(self.sections) - 1)
+
+    def finish(self):
+        """输入结束：返回剩余的分段"""
+        if self._partial:
+            self._feed_line(self._partial)
+            self._partial = ''
+        return self._take(len(self.sections))
+
+    def _take(self, end):
+        completed = [
+            section for section in self.sections[self._emitted:end]
+            if section['day'] is not None or section['text']
+        ]
+        self._emitted = max(self._emitted, end)
+        return completed
+
+    def _feed_line(self, line):
+        current = self.sections[-1]
+        # 总结部分开始后不再识别天标题；重复出现的天数按正文处理
+        day = None if current['key'] == 'summary' else route_day_number(line)
+        if day is not None and any(section['day'] == day for section in self.sections):
+            day = None
+        if day is not None:
+            self.sections.append({'key': f'day-{day}', 'day': day, 'title': line.strip(), 'text': line})
+            if self._day_level is None:
+                self._day_level = _heading_level(line)
+            return
+        if current['day'] is not None and line.strip():
+            level = _heading_level(line)
+            is_heading = level < 7 or ROUTE_BOLD_HEADING_PATTERN.match(line)
+            # 与天标题同级或更高级的非天标题结束最后一天（加粗标题只在天标题也不是 # 标题时算作同级）
+            if is_heading and level <= self._day_level and (level < 7 or self._day_level == 7) and _is_summary_heading(line):
+                self.sections.append({'key': 'summary', 'day': None, 'title': line.strip(), 'text': line})
+                return
+        current['text'] += line
+
+
+def split_route_sections(plan):
+    """把路线计划拆成 [{'key', 'day', 'title', 'text'}]，text 依次拼接即为原文"""
+    splitter = RouteSectionSplitter()
+    splitter.feed(plan or '')
+    splitter.finish()
+    sections = splitter.sections
+    if not sections[0]['text'] and len(sections) > 1:
+        sections.pop(0)
+    return sections
+
+
+def _is_summary_heading(line):
+    """天之后的总结性标题（费用汇总、贴士、注意事项等）"""
+    return bool(re.search(
+        r'summary|total|budget|cost|breakdown|tips|notes|overview|estimate|总结|汇总|费用|预算|贴士|注意',
+        line, re.IGNORECASE
+    ))
+
+
+def join_route_sections(sections):
+    return ''.join(section['text'] for section in sections)
+
+
+def route_day_sections(sections):
+    return [section for section in sections if section['day'] is not None]
+
+
+def resolve_route_sections(request, sections, max_ratio=0.5):
+    """把修改请求对应到受影响的天分段，返回分段 key 列表
+
+    无法确定、涉及整体或受影响的天超过 max_ratio 时返回 None（调用方退回整体重新规划）。
+    """
+    days = route_day_sections(sections)
+    if len(days) < 2 or WHOLE_PLAN_PATTERN.search(request or ''):
+        return None
+    day_numbers = [section['day'] for section in days]
+
+    referenced = set()
+    for match in DAY_REFERENCE_PATTERN.finditer(request):
+        start, end, ordinal, chinese = match.groups()
+        if start:
+            start = int(start)
+            end = int(end) if end else start
+            if '-' in match.group(0) or '–' in match.group(0) or ' to ' in match.group(0).lower():
+                referenced.update(range(start, end + 1))
+            else:
+                referenced.update({start, end})
+        elif ordinal:
+            referenced.add(max(day_numbers) if ordinal.lower() in ('last', 'final') else ORDINAL_DAYS[ordinal.lower()])
+        elif chinese:
+            referenced.add(int(chinese))
+
+    if not referenced:
+        referenced = _days_mentioning(request, days)
+    keys = [section['key'] for section in days if section['day'] in referenced]
+    if not keys or len(keys) > max(1, int(len(days) * max_ratio)):
+        return None
+    return keys
+
+
+def _days_mentioning(request, days):
+    """请求中没有写明第几天时，用请求里的专有名词（大写开头的词）定位只在少数几天出现的内容"""
+    names = {word.lower() for word in re.findall(r'\b[A-Z][\w\'-]{3,}\b', request)}
+    names -= {'change', 'replace', 'please', 'could', 'would', 'instead', 'hotel', 'restaurant', 'maybe', 'swap'}
+    matched = set()
+    for name in names:
+        hits = [section['day'] for section in days if name in section['text'].lower()]
+        if 0 < len(hits) <= 2:
+            matched.update(hits)
+    return matched
+
+
+def with_day_heading(chunks, heading):
+    """逐块转发生成的天分段；首行不是天标题时先补上 heading（首行完整前先缓存）"""
+    text = ""
+    checked = False
+    for chunk in chunks:
+        if not chunk:
+            continue
+        if checked:
+            yield chunk
+            continue
+        text = (text + chunk).lstrip()
+        if '\n' not in text:
+            continue
+        checked = True
+        yield text if route_day_number(text) is not None else heading.rstrip('\n') + '\n' + text
+    if not checked and text:
+        yield text if route_day_number(text) is not None else heading.rstrip('\n') + '\n' + text
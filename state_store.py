@@ -0,0 +1,223 @@
+"""聊天室共享状态存储
+
+状态按 namespace/key 保存 JSON 可序列化的记录：
+- MemoryStateStore：进程内存储（单进程部署，默认）
+- SQLiteStateStore：SQLite WAL 文件存储，多个 gunicorn worker 共享同一份状态
+
+业务代码通过 StateNamespace 以字典方式访问，例如：
+    travel_plan_storage = StateNamespace(store, 'travel_plans')
+    travel_plan_storage[session_id]["budget"] = 1500   # 写入会立即持久化
+"""
+import copy
+import json
+import os
+import sqlite3
+import threading
+import time
+
+
+class StateStore:
+    """状态存储接口"""
+
+    def get(self, namespace, key, default=None):
+        raise NotImplementedError
+
+    def set(self, namespace, key, value):
+        raise NotImplementedError
+
+    def delete(self, namespace, key):
+        raise NotImplementedError
+
+    def items(self, namespace):
+        """返回 namespace 下所有 (key, value)"""
+        raise NotImplementedError
+
+    def update(self, namespace, key, fn):
+        """原子地读-改-写一条记录：fn(旧值或None) 返回新值，返回 None 表示删除该记录"""
+        raise NotImplementedError
+
+
+class MemoryStateStore(StateStore):
+    """进程内存储（返回副本，与共享存储的语义保持一致）"""
+
+    def __init__(self):
+        self._data = {}
+        self._lock = threading.RLock()
+
+    def get(self, namespace, key, default=None):
+        with self._lock:
+            if key not in self._data.get(namespace, {}):
+                return default
+            return copy.deepcopy(self._data[namespace][key])
+
+    def set(self, namespace, key, value):
+        with self._lock:
+            self._data.setdefault(namespace, {})[key] = copy.deepcopy(value)
+
+    def delete(self, namespace, key):
+        with self._lock:
+            self._data.get(namespace, {}).pop(key, None)
+
+    def items(self, namespace):
+        with self._lock:
+            return [(key, copy.deepcopy(value)) for key, value in self._data.get(namespace, {}).items()]
+
+    def update(self, namespace, key, fn):
+        with self._lock:
+            new_value = fn(self.get(namespace, key))
+            if new_value is None:
+                self.delete(namespace, key)
+            else:
+                self.set(namespace, key, new_value)
+            return copy.deepcopy(new_value)
+
+
+class SQLiteStateStore(StateStore):
+    """SQLite（WAL 模式）存储，同一台机器上的多个进程共享"""
+
+    def __init__(self, path):
+        self.path = path
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+        self._local = threading.local()
+        self._connection().execute(
+            "CREATE TABLE IF NOT EXISTS state ("
+            " namespace TEXT NOT NULL,"
+            " key TEXT NOT NULL,"
+            " value TEXT NOT NULL,"
+            " updated_at REAL NOT NULL,"
+            " PRIMARY KEY (namespace, key))"
+        )
+
+    def _connection(self):
+        """每个线程一个连接（sqlite3 连接不能跨线程共享）"""
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.conn = conn
+        return conn
+
+    def get(self, namespace, key, default=None):
+        row = self._connection().execute(
+            "SELECT value FROM state WHERE namespace = ? AND key = ?", (namespace, key)
+        ).fetchone()
+        return json.loads(row[0]) if row else default
+
+    def set(self, namespace, key, value):
+        self._connection().execute(
+            "INSERT INTO state (namespace, key, value, updated_at) VALUES (?, ?, ?, ?)"
+            " ON CONFLICT(namespace, key) DO UPDATE SET value = excluded.value, updated_at = excluded.updated_at",
+            (namespace, key, json.dumps(value, ensure_ascii=False), time.time())
+        )
+
+    def delete(self, namespace, key):
+        self._connection().execute("DELETE FROM state WHERE namespace = ? AND key = ?", (namespace, key))
+
+    def items(self, namespace):
+        rows = self._connection().execute(
+            "SELECT key, value FROM state WHERE namespace = ? ORDER BY rowid", (namespace,)
+        ).fetchall()
+        return [(key, json.loads(value)) for key, value in rows]
+
+    def update(self, namespace, key, fn):
+        conn = self._connection()
+        # BEGIN IMMEDIATE 立即获取写锁，避免并发的读-改-写互相覆盖
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            new_value = fn(self.get(namespace, key))
+            if new_value is None:
+                self.delete(namespace, key)
+            else:
+                self.set(namespace, key, new_value)
+            conn.execute('COMMIT')
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+        return new_value
+
+
+class StateRecord(dict):
+    """一条状态记录的字典视图，修改字段时立即写回存储"""
+
+    def __init__(self, namespace, key, value):
+        super().__init__(value)
+        self._namespace = namespace
+        self._key = key
+
+    def __setitem__(self, field, value):
+        super().__setitem__(field, value)
+        self._namespace.set_field(self._key, field, value)
+
+    def update(self, *args, **kwargs):
+        changes = dict(*args, **kwargs)
+        super().update(changes)
+        self._namespace.update_fields(self._key, changes)
+
+
+class StateNamespace:
+    """把存储中的一个 namespace 当作字典使用"""
+
+    def __init__(self, store, name):
+        self.store = store
+        self.name = name
+
+    def __contains__(self, key):
+        return self.store.get(self.name, key) is not None
+
+    def __getitem__(self, key):
+        value = self.store.get(self.name, key)
+        if value is None:
+            raise KeyError(key)
+        return StateRecord(self, key, value)
+
+    def __setitem__(self, key, value):
+        self.store.set(self.name, key, dict(value))
+
+    def __delitem__(self, key):
+        self.store.delete(self.name, key)
+
+    def get(self, key, default=None):
+        value = self.store.get(self.name, key)
+        if value is None:
+            return default
+        return StateRecord(self, key, value)
+
+    def pop(self, key, default=None):
+        value = self.get(key, default)
+        self.store.delete(self.name, key)
+        return value
+
+    def keys(self):
+        return [key for key, _ in self.store.items(self.name)]
+
+    def values(self):
+        return [StateRecord(self, key, value) for key, value in self.store.items(self.name)]
+
+    def items(self):
+        return [(key, StateRecord(self, key, value)) for key, value in self.store.items(self.name)]
+
+    def __len__(self):
+        return len(self.store.items(self.name))
+
+    def set_field(self, key, field, value):
+        """原子地修改记录中的一个字段（记录不存在时创建）"""
+        self.update_fields(key, {field: value})
+
+    def update_fields(self, key, changes):
+        def apply(record):
+            record = record or {}
+            record.update(changes)
+            return record
+        self.store.update(self.name, key, apply)
+
+
+def create_state_store(backend, sqlite_path):
+    """根据配置创建状态存储：memory（默认）或 sqlite"""
+    if backend == 'sqlite':
+        print(f"使用 SQLite 共享状态存储: {sqlite_path}")
+        return SQLiteStateStore(sqlite_path)
+    if backend != 'memory':
+        print(f"警告: 未知的 STATE_BACKEND={backend}，使用内存存储")
+    return MemoryStateStore()
@@ -0,0 +1,15 @@
+"""单元测试：python -m unittest discover tests
+
+app 模块在导入时会初始化数据库和 LLM 客户端，这里先设置测试用的环境变量（不会发起任何网络请求）。
+"""
+import os
+import sys
+import tempfile
+
+_test_dir = tempfile.mkdtemp(prefix='tripwise-tests-')
+os.environ.setdefault('OPENAI_API_KEY', 'sk-test')
+os.environ.setdefault('DATABASE_URL', 'sqlite:///' + os.path.join(_test_dir, 'bills.db'))
+os.environ.setdefault('STATE_DB_PATH', os.path.join(_test_dir, 'chat_state.db'))
+os.environ.setdefault('BROADCAST_BUS_PATH', os.path.join(_test_dir, 'chat_bus.db'))
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,187 @@
+import unittest
+
+from budget_estimator import (
+    CONFIDENCE_TOTAL,
+    PlanCostTally,
+    RunningCostTally,
+    detect_budget_currency,
+    estimate_plan_cost,
+    find_money,
+)
+
+MIN_CONFIDENCE = 0.6  # BUDGET_CHECK_MIN_CONFIDENCE 的默认值
+
+ROUTE = (
+    "# Paris, 3 days\nBudget constraint: $1500.00\n"
+    "### Day 1: Arrival\n- Hotel Le Marais: $150-200 per night\n- Louvre ticket: $22\n"
+    "### Day 2: Versailles\n- Train $8\n"
+    "## Summary\n- Total accommodation cost: $525\n- Remaining budget: $690\n"
+    "Total Estimated Trip Cost: $700\n"
+)
+RESTAURANT = (
+    "## Day 1 - Restaurants\n- Cafe $10-20 per person\nEstimated food cost for this day: $90 for the whole group\n"
+    "## Day 2 - Restaurants\nEstimated food cost for this day: $110 for the whole group\n"
+)
+
+# 并行模式（stream_parallel_route_plan）的路线计划：每天单独生成，没有全程汇总行
+PARALLEL_ROUTE = (
+    "# Rome, 4 days\n\nBudget constraint: $2000.00\n\n"
+    + "".join(
+        f"## Day {day}: Area {day}\n- Morning: Museum ticket $25\n- Hotel Roma: $120 per night\n"
+        f"- Daily transport cost: $15\nEstimated cost for this day: ${cost} for the whole group\n\n"
+        for day, cost in ((1, 300), (2, 250), (3, 280), (4, 170))
+    )
+)
+
+
+class FindMoneyTest(unittest.TestCase):
+
+    def test_symbols_codes_and_ranges(self):
+        self.assertEqual(
+            [(value, currency) for value, currency, _ in find_money("Hotel $120–$180, 300-500 元, USD 40, €1,200")],
+            [(150.0, 'USD'), (400.0, 'CNY'), (40.0, 'USD'), (1200.0, 'EUR')]
+        )
+
+
+class EstimatePlanCostTest(unittest.TestCase):
+
+    def test_trip_totals_are_trusted(self):
+        result, confidence = estimate_plan_cost(ROUTE, RESTAURANT, 1500, 'USD')
+        self.assertEqual(confidence, 0.75)
+        self.assertEqual(result['total_estimated_cost'], 990.0)  # (700 + 200) * 1.1
+        self.assertEqual(result['remaining_budget'], 510.0)
+        self.assertTrue(result['budget_ok'])
+        self.assertEqual(set(result), {
+            'success', 'budget_ok', 'is_feasible', 'currency', 'max_budget', 'total_estimated_cost',
+            'remaining_budget', 'error_type', 'reason', 'suggestion'
+        })
+
+    def test_parallel_route_day_totals_are_trusted(self):
+        tally = PlanCostTally(kind='route').feed(PARALLEL_ROUTE).finish()
+        cost, confidence = tally.estimate()
+        # 每类的每天费用（交通）不计入当天小计
+        self.assertEqual(cost, 1000.0)
+        self.assertGreaterEqual(confidence, MIN_CONFIDENCE)
+        result, confidence = estimate_plan_cost(PARALLEL_ROUTE, RESTAURANT, 2000, 'USD')
+        self.assertGreaterEqual(confidence, MIN_CONFIDENCE)
+        self.assertEqual(result['total_estimated_cost'], 1320.0)  # (1000 + 200) * 1.1
+
+    def test_category_subtotal_alone_is_not_trusted(self):
+        route = "### Day 1\n- Louvre $22\n- Metro $15\n## Summary\nTotal accommodation cost: $525\n"
+        tally = PlanCostTally(kind='route').feed(route).finish()
+        cost, confidence = tally.estimate()
+        self.assertEqual(cost, 525.0)
+        self.assertLess(confidence, MIN_CONFIDENCE)
+
+    def test_per_person_prices_are_not_trusted(self):
+        restaurant = "Estimated food cost for this day: $45 per person\nEstimated food cost for this day: $50 per person\n"
+        _, confidence = estimate_plan_cost(ROUTE, restaurant, 1500, 'USD')
+        self.assertLess(confidence, MIN_CONFIDENCE)
+        _, confidence = estimate_plan_cost("Total Estimated Trip Cost: $300 per person\n", "", 1500, 'USD')
+        self.assertLess(confidence, MIN_CONFIDENCE)
+
+    def test_items_only_are_not_trusted(self):
+        _, confidence = estimate_plan_cost("Day 1\n- Hotel $100/night\n- Museum $20\n", "", None)
+        self.assertLess(confidence, MIN_CONFIDENCE)
+
+    def test_unknown_or_different_budget_currency(self):
+        self.assertEqual(estimate_plan_cost(ROUTE, RESTAURANT, 1500, None), (None, 0.0))
+        self.assertEqual(estimate_plan_cost(ROUTE, RESTAURANT, 1500, 'CNY'), (None, 0.0))
+
+    def test_mixed_currencies(self):
+        self.assertEqual(estimate_plan_cost("Total Estimated Trip Cost: €700\n", RESTAURANT, None), (None, 0.0))
+
+    def test_no_budget(self):
+        result, confidence = estimate_plan_cost(ROUTE, RESTAURANT, None)
+        self.assertTrue(result['budget_ok'])
+        self.assertIsNone(result['remaining_budget'])
+
+    def test_over_budget_and_hard_limit(self):
+        result, _ = estimate_plan_cost(ROUTE, RESTAURANT, 800, 'USD')
+        self.assertFalse(result['budget_ok'])
+        self.assertTrue(result['is_feasible'])
+        self.assertEqual(result['error_type'], 'OVER_BUDGET')
+        result, _ = estimate_plan_cost(ROUTE, RESTAURANT, 100, 'USD')
+        self.assertFalse(result['is_feasible'])
+        self.assertEqual(result['error_type'], 'HARD_LIMIT')
+
+    def test_budget_restatements_are_not_costs(self):
+        tally = PlanCostTally(1500).feed("Budget constraint: $1500\nYou have $300 left\nTotal Estimated Trip Cost: $900\n").finish()
+        self.assertEqual(tally.estimate(), (900.0, CONFIDENCE_TOTAL))
+
+
+class DetectBudgetCurrencyTest(unittest.TestCase):
+
+    def test_detects_currency_of_budget_amount(self):
+        self.assertEqual(detect_budget_currency("Plan Paris, budget $1,500", 1500), 'USD')
+        self.assertEqual(detect_budget_currency("预算5000元", 5000.0), 'CNY')
+
+    def test_unknown(self):
+        self.assertIsNone(detect_budget_currency("budget 1500", 1500))
+        self.assertIsNone(detect_budget_currency("yes", 1500))
+        self.assertIsNone(detect_budget_currency("budget $1500", None))
+
+
+if __name__ == '__main__':
+    unittest.main()
+
+
+def stream(tally, plan, text, kind='route'):
+    """按小块喂入，模拟流式输出"""
+    for start in range(0, len(text), 7):
+        tally.feed(plan, text[start:start + 7], kind)
+    return tally
+
+
+class RunningCostTallyTest(unittest.TestCase):
+
+    def guard(self, budget_currency='USD'):
+        return RunningCostTally(500, 0.2, budget_currency)
+
+    def test_loose_items_and_alternatives_do_not_trip(self):
+        plan = "".join(f"- Option {n}: Hotel ${n}50 per night\n" for n in range(1, 9))
+        tally = stream(self.guard(), 'route', plan)
+        self.assertEqual(tally.estimate(), 0.0)
+        self.assertFalse(tally.over_budget())
+
+    def test_per_person_amounts_do_not_trip(self):
+        tally = stream(self.guard(), 'route', "Total Estimated Trip Cost: $800 per person\n")
+        self.assertFalse(tally.over_budget())
+
+    def test_route_and_restaurant_are_not_double_counted(self):
+        tally = self.guard()
+        stream(tally, 'route', "- Dinner $40\nTotal Estimated Trip Cost: $450\n")
+        stream(tally, 'food', "Total Estimated Food Cost: $300 for the whole group\n", 'restaurant')
+        self.assertEqual(tally.estimate(), 450.0)
+        self.assertFalse(tally.over_budget())
+
+    def test_trip_total_over_margin_trips(self):
+        tally = stream(self.guard(), 'route', "Total Estimated Trip Cost: $650\n")
+        self.assertTrue(tally.over_budget())
+        # 未超出余量时不停止
+        self.assertFalse(stream(self.guard(), 'route', "Total Estimated Trip Cost: $580\n").over_budget())
+
+    def test_running_subtotals_over_margin_trip(self):
+        tally = self.guard()
+        stream(tally, 'route', "Total accommodation cost: $400\n")
+        self.assertFalse(tally.over_budget())
+        stream(tally, 'route', "Total transport cost: $250\n")
+        self.assertTrue(tally.over_budget())
+
+    def test_parallel_route_day_totals_trip_during_route_stage(self):
+        tally = RunningCostTally(600, 0.2, 'USD')
+        fed = ''
+        for line in PARALLEL_ROUTE.splitlines(keepends=True):
+            stream(tally, 'route', line)
+            fed += line
+            if tally.over_budget():
+                break
+        self.assertTrue(tally.over_budget())
+        # 第 3 天的小计写出后（300 + 250 + 280 > 720）即停止，不必等路线计划生成完
+        self.assertIn("$280", fed)
+        self.assertNotIn("Day 4", fed)
+        self.assertEqual(tally.estimate(), 830.0)
+
+    def test_unknown_or_different_currency_never_trips(self):
+        self.assertFalse(stream(self.guard(None), 'route', "Total Estimated Trip Cost: $5000\n").over_budget())
+        self.assertFalse(stream(self.guard('EUR'), 'route', "Total Estimated Trip Cost: $5000\n").over_budget())
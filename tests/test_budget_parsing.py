@@ -0,0 +1,36 @@
+import unittest
+
+from app import parse_budget_locally
+
+
+class ParseBudgetLocallyTest(unittest.TestCase):
+
+    def test_no_numbers(self):
+        self.assertEqual(parse_budget_locally("Plan a trip to Paris"), ('no_numbers', None))
+
+    def test_currency_symbol_and_code(self):
+        self.assertEqual(parse_budget_locally("Plan a trip to Paris, budget $1500"), ('parsed', 1500.0))
+        self.assertEqual(parse_budget_locally("I can spend 3000 USD"), ('parsed', 3000.0))
+        self.assertEqual(parse_budget_locally("预算5000元"), ('parsed', 5000.0))
+
+    def test_thousands_and_suffixes(self):
+        self.assertEqual(parse_budget_locally("budget of $1,500"), ('parsed', 1500.0))
+        self.assertEqual(parse_budget_locally("change budget to 2k"), ('parsed', 2000.0))
+        self.assertEqual(parse_budget_locally("预算1万"), ('parsed', 10000.0))
+
+    def test_range_uses_upper_bound(self):
+        self.assertEqual(parse_budget_locally("between $1500-2000"), ('parsed', 2000.0))
+
+    def test_per_person_multiplied_by_group_size(self):
+        self.assertEqual(parse_budget_locally("4 people, $500 per person"), ('parsed', 2000.0))
+
+    def test_non_money_numbers(self):
+        self.assertEqual(parse_budget_locally("5 days in Tokyo for 2 people"), ('no_budget', None))
+
+    def test_ambiguous_goes_to_llm(self):
+        self.assertEqual(parse_budget_locally("I have 2000 for Paris")[0], 'ambiguous')
+        self.assertEqual(parse_budget_locally("$500 for hotels and $300 for food")[0], 'ambiguous')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,374 @@
+import json
+import threading
+import time
+import unittest
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import openai
+from langchain_core.messages import HumanMessage
+
+from llm_client import LLMCapacityError, LLMClientPool, ManagedChatOpenAI, SingleFlight
+
+
+class StubStream:
+    """按顺序输出 items；gate 给出时每输出一项前等待放行，记录是否被关闭"""
+
+    def __init__(self, items, gate=None):
+        self.items = items
+        self.gate = gate
+        self.started = 0
+        self.closed = False
+
+    def __call__(self):
+        self.started += 1
+        return self._iterate()
+
+    def _iterate(self):
+        try:
+            for item in self.items:
+                if self.gate is not None:
+                    self.gate.acquire(timeout=5)
+                yield item
+        finally:
+            self.closed = True
+
+
+class SingleFlightTest(unittest.TestCase):
+
+    def test_join_while_running(self):
+        flights = SingleFlight()
+        gate = threading.Semaphore(0)
+        stub = StubStream([0, 1, 2], gate)
+        leader_items, leader = flights.run('k', stub)
+        gate.release()
+        self.assertEqual(next(leader_items), 0)
+
+        follower_items, follower_leader = flights.run('k', stub)
+        self.assertTrue(leader)
+        self.assertFalse(follower_leader)
+        gate.release()
+        gate.release()
+        self.assertEqual(list(leader_items), [1, 2])
+        # 后加入的调用也从头拿到完整输出
+        self.assertEqual(list(follower_items), [0, 1, 2])
+        self.assertEqual(stub.started, 1)
+        self.assertEqual(flights.stats()['followers'], 1)
+
+    def test_join_after_all_subscribers_left(self):
+        flights = SingleFlight()
+        gate = threading.Semaphore(0)
+        first = StubStream([0, 1, 2], gate)
+        items, _ = flights.run('k', first)
+        gate.release()
+        self.assertEqual(next(items), 0)
+        items.close()
+        self.assertEqual(flights.stats()['in_flight'], 0)
+
+        # 被取消的生成仍在等待下一项时，新的调用开始新的生成，而不是拿到截断的输出
+        second = StubStream([0, 1, 2])
+        items, leader = flights.run('k', second)
+        self.assertTrue(leader)
+        self.assertEqual(list(items), [0, 1, 2])
+        self.assertEqual(second.started, 1)
+
+        gate.release()
+        for _ in range(50):
+            if first.closed:
+                break
+            threading.Event().wait(0.01)
+        self.assertTrue(first.closed)
+
+    def test_finished_flight_is_not_joined(self):
+        flights = SingleFlight()
+        stub = StubStream(['a'])
+        items, _ = flights.run('k', stub)
+        self.assertEqual(list(items), ['a'])
+        items, leader = flights.run('k', stub)
+        self.assertTrue(leader)
+        self.assertEqual(list(items), ['a'])
+        self.assertEqual(stub.started, 2)
+
+    def test_error_reaches_every_subscriber(self):
+        flights = SingleFlight()
+        gate = threading.Semaphore(0)
+
+        def failing():
+            gate.acquire(timeout=5)
+            raise ValueError('boom')
+            yield
+
+        first, _ = flights.run('k', failing)
+        second, leader = flights.run('k', failing)
+        self.assertFalse(leader)
+        gate.release()
+        with self.assertRaises(ValueError):
+            list(first)
+        with self.assertRaises(ValueError):
+            list(second)
+
+
+class QuietHTTPServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        # 客户端主动断开连接是测试的一部分
+        pass
+
+
+class StubOpenAIServer:
+    """本地 OpenAI 兼容的桩服务（/chat/completions，流式和非流式）
+
+    behaviours 按请求顺序取用，取完后一直用最后一个：
+    - 'ok'：立即返回 reply
+    - 'stall'：先发响应头，首个 token 前一直等待（直到 stop），期间发送 SSE 注释行
+    - 'silent'：先发响应头，之后什么都不发（直到 stop）
+    - 'slow'：每个词之间间隔 0.1 秒
+    - 'error'：返回 500
+    """
+
+    def __init__(self, behaviours=('ok',), reply='Hello there'):
+        self.behaviours = list(behaviours)
+        self.reply = reply
+        self.requests = 0
+        self.aborted = 0
+        self.lock = threading.Lock()
+        self.stopping = threading.Event()
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def do_POST(self):
+                body = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+                with stub.lock:
+                    behaviour = stub.behaviours[min(stub.requests, len(stub.behaviours) - 1)]
+                    stub.requests += 1
+                if behaviour == 'error':
+                    self._send(500, 'application/json', json.dumps({'error': {'message': 'stub error'}}).encode())
+                elif body.get('stream'):
+                    self._stream(behaviour)
+                else:
+                    if behaviour == 'stall':
+                        stub.stopping.wait(5)
+                    self._send(200, 'application/json', json.dumps({
+                        'id': 'stub', 'object': 'chat.completion', 'created': 0, 'model': body['model'],
+                        'choices': [{'index': 0, 'message': {'role': 'assistant', 'content': stub.reply}, 'finish_reason': 'stop'}],
+                    }).encode())
+
+            def _send(self, status, content_type, payload):
+                self.send_response(status)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+            def _stream(self, behaviour):
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/event-stream')
+                self.send_header('Transfer-Encoding', 'chunked')
+                self.end_headers()
+                self.wfile.flush()
+                try:
+                    if behaviour == 'stall':
+                        # 客户端断开连接时尽快发现（写入失败）
+                        while not stub.stopping.wait(0.05):
+                            self._chunk(b': keep-alive\n\n')
+                    elif behaviour == 'silent':
+                        stub.stopping.wait(5)
+                    for word in stub.reply.split(' '):
+                        if behaviour == 'slow':
+                            time.sleep(0.1)
+                        chunk = {
+                            'id': 'stub', 'object': 'chat.completion.chunk', 'created': 0, 'model': 'stub',
+                            'choices': [{'index': 0, 'delta': {'content': word + ' '}, 'finish_reason': None}],
+                        }
+                        self._chunk(f'data: {json.dumps(chunk)}\n\n'.encode())
+                    self._chunk(b'data: [DONE]\n\n')
+                    self._chunk(b'')
+                except OSError:
+                    with stub.lock:
+                        stub.aborted += 1
+
+            def _chunk(self, data):
+                self.wfile.write(f'{len(data):x}\r\n'.encode() + data + b'\r\n')
+                self.wfile.flush()
+
+            def log_message(self, *args):
+                pass
+
+        self.server = QuietHTTPServer(('127.0.0.1', 0), Handler)
+        self.base_url = f'http://127.0.0.1:{self.server.server_port}/v1'
+        threading.Thread(target=self.server.serve_forever, args=(0.05,), daemon=True).start()
+
+    def stop(self):
+        self.stopping.set()
+        self.server.shutdown()
+        self.server.server_close()
+
+
+def wait_until(condition, timeout=2.0):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if condition():
+            return True
+        time.sleep(0.01)
+    return condition()
+
+
+class ManagedChatOpenAITest(unittest.TestCase):
+
+    def start_server(self, behaviours, **kwargs):
+        server = StubOpenAIServer(behaviours, **kwargs)
+        self.addCleanup(server.stop)
+        return server
+
+    def make_llm(self, server, pool=None, **kwargs):
+        pool = pool or LLMClientPool(max_connections=4, max_concurrency=4, queue_timeout=1)
+        self.addCleanup(pool.http_client.close)
+        settings = dict(
+            client_pool=pool, chain_name='test', model='stub', api_key='test', base_url=server.base_url,
+            max_retries=0, timeout=pool.timeout(1, 5), single_flight=False, retry_backoff=0.01
+        )
+        settings.update(kwargs)
+        return ManagedChatOpenAI(**settings)
+
+    def text(self, llm):
+        return ''.join(chunk.content for chunk in llm.stream([HumanMessage(content='hi')])).strip()
+
+    def test_hedge_closes_loser_before_its_first_token(self):
+        server = self.start_server(['stall', 'ok'])
+        llm = self.make_llm(server, hedge=True, hedge_after=0.1)
+        self.assertEqual(self.text(llm), 'Hello there')
+        stats = llm.client_pool.stats()
+        self.assertEqual(stats['chains']['test']['hedges'], 1)
+        self.assertEqual(stats['chains']['test']['hedge_wins'], 1)
+        # 落选的请求在首个 token 之前就被断开，释放并发名额，不必等到读超时
+        self.assertTrue(wait_until(lambda: llm.client_pool.stats()['in_flight'] == 0))
+        self.assertTrue(wait_until(lambda: server.aborted == 1))
+
+    def test_hedge_closes_stalled_non_streaming_loser(self):
+        server = self.start_server(['stall', 'ok'])
+        llm = self.make_llm(server, hedge=True, hedge_after=0.1, streaming=False, disable_streaming=True)
+        self.assertEqual(llm.invoke('hi').content, 'Hello there')
+        self.assertTrue(wait_until(lambda: llm.client_pool.stats()['in_flight'] == 0))
+
+    def test_stream(self):
+        server = self.start_server(['ok'])
+        llm = self.make_llm(server)
+        self.assertEqual(self.text(llm), 'Hello there')
+        self.assertEqual(self.text(llm), 'Hello there')
+        stats = llm.client_pool.stats()
+        self.assertEqual(stats['requests'], 2)
+        self.assertEqual(stats['in_flight'], 0)
+        self.assertEqual(stats['chains']['test']['calls'], 2)
+
+    def test_connection_reuse(self):
+        server = self.start_server(['ok'])
+        llm = self.make_llm(server, streaming=False, disable_streaming=True)
+        self.assertEqual(llm.invoke('hi').content, 'Hello there')
+        self.assertEqual(llm.invoke('hi again').content, 'Hello there')
+        # 两次调用复用同一个长连接
+        self.assertEqual(llm.client_pool.stats()['connections'], 1)
+
+    def test_first_token_deadline(self):
+        server = self.start_server(['silent'])
+        pool = LLMClientPool(max_connections=2, max_concurrency=2, queue_timeout=1)
+        llm = self.make_llm(server, pool, timeout=pool.timeout(1, 0.2))
+        started = time.time()
+        with self.assertRaises(openai.APITimeoutError):
+            self.text(llm)
+        self.assertLess(time.time() - started, 2)
+        self.assertEqual(pool.stats()['deadline_exceeded'], 1)
+        self.assertEqual(pool.stats()['in_flight'], 0)
+
+    def test_total_timeout(self):
+        server = self.start_server(['slow'], reply='one two three four five')
+        llm = self.make_llm(server, total_timeout=0.15)
+        with self.assertRaises(TimeoutError):
+            self.text(llm)
+        self.assertEqual(llm.client_pool.stats()['deadline_exceeded'], 1)
+
+    def test_retries_transient_errors(self):
+        server = self.start_server(['error', 'ok'])
+        llm = self.make_llm(server, retries=1)
+        self.assertEqual(self.text(llm), 'Hello there')
+        self.assertEqual(server.requests, 2)
+        self.assertEqual(llm.client_pool.stats()['chains']['test']['retries'], 1)
+
+    def test_gives_up_after_retries(self):
+        server = self.start_server(['error'])
+        llm = self.make_llm(server, retries=2)
+        with self.assertRaises(openai.InternalServerError):
+            self.text(llm)
+        self.assertEqual(server.requests, 3)
+
+    def test_retry_delay_has_jitter_and_cap(self):
+        llm = self.make_llm(self.start_server(['ok']), retry_backoff=0.5)
+        delays = [llm._retry_delay(2) for _ in range(200)]
+        self.assertTrue(all(0 <= delay <= 2.0 for delay in delays))
+        self.assertGreater(len(set(delays)), 1)
+        self.assertTrue(all(llm._retry_delay(10) <= 8.0 for _ in range(50)))
+
+    def test_identical_concurrent_calls_share_one_request(self):
+        server = self.start_server(['slow'])
+        llm = self.make_llm(server, single_flight=True)
+        results = []
+        first = threading.Thread(target=lambda: results.append(self.text(llm)))
+        first.start()
+        self.assertTrue(wait_until(lambda: server.requests == 1))
+        results.append(self.text(llm))
+        first.join(5)
+        self.assertEqual(results, ['Hello there', 'Hello there'])
+        self.assertEqual(server.requests, 1)
+        self.assertEqual(llm.client_pool.stats()['chains']['test']['shared'], 1)
+
+
+class LLMClientPoolTest(unittest.TestCase):
+
+    def make_pool(self, **kwargs):
+        pool = LLMClientPool(**kwargs)
+        self.addCleanup(pool.http_client.close)
+        return pool
+
+    def test_concurrency_limit_rejects_after_queue_timeout(self):
+        pool = self.make_pool(max_concurrency=1, queue_timeout=0.05)
+        with pool.slot():
+            self.assertEqual(pool.stats()['saturation'], 1.0)
+            with self.assertRaises(LLMCapacityError):
+                with pool.slot():
+                    pass
+        with pool.slot():
+            pass
+        stats = pool.stats()
+        self.assertEqual(stats['rejected'], 1)
+        self.assertEqual(stats['requests'], 2)
+        self.assertEqual(stats['in_flight'], 0)
+
+    def test_waiting_call_gets_released_slot(self):
+        pool = self.make_pool(max_concurrency=1, queue_timeout=2)
+        release = threading.Event()
+
+        def hold():
+            with pool.slot():
+                release.wait(2)
+
+        holder = threading.Thread(target=hold)
+        holder.start()
+        self.assertTrue(wait_until(lambda: pool.stats()['in_flight'] == 1))
+        threading.Timer(0.05, release.set).start()
+        with pool.slot():
+            self.assertEqual(pool.stats()['max_waiting'], 1)
+        holder.join(2)
+        self.assertEqual(pool.stats()['rejected'], 0)
+
+    def test_first_token_p95_needs_enough_samples(self):
+        pool = self.make_pool()
+        for latency in range(19):
+            pool.record_first_token('chain', latency / 100)
+        self.assertIsNone(pool.first_token_p95('chain'))
+        pool.record_first_token('chain', 0.19)
+        self.assertEqual(pool.first_token_p95('chain'), 0.18)
+
+
+if __name__ == '__main__':
+    unittest.main()
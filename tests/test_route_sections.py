@@ -0,0 +1,108 @@
+import unittest
+
+from route_sections import (
+    RouteSectionSplitter,
+    join_route_sections,
+    resolve_route_sections,
+    route_day_number,
+    route_day_sections,
+    split_route_sections,
+    with_day_heading,
+)
+
+PLAN = (
+    "# Paris Getaway\nThree relaxed days.\n\n"
+    "### Day 1: Arrival\n- Hotel Le Marais $150/night\n\n"
+    "### Day 2: Louvre\n- Louvre ticket $22\n\n"
+    "### Day 3: Versailles\n- Train $8\n\n"
+    "## Cost Summary\nDay 1: $150\nDay 2: $200\nDay 3: $120\nTotal: $470\n"
+)
+
+
+class RouteDayNumberTest(unittest.TestCase):
+
+    def test_heading_styles(self):
+        self.assertEqual(route_day_number("Day 1"), 1)
+        self.assertEqual(route_day_number("### Day 2: Louvre"), 2)
+        self.assertEqual(route_day_number("**Day 3 - Versailles**"), 3)
+        self.assertEqual(route_day_number("第4天：抵达"), 4)
+        self.assertEqual(route_day_number("Day 5: Theme | Area | Paris"), 5)
+
+    def test_price_lines_are_not_headings(self):
+        self.assertIsNone(route_day_number("Day 1: $150"))
+        self.assertIsNone(route_day_number("Day 2 - 200 USD"))
+        self.assertIsNone(route_day_number("Day 3: ~€80"))
+        self.assertIsNone(route_day_number("Total: $470"))
+
+
+class SplitRouteSectionsTest(unittest.TestCase):
+
+    def test_split_is_lossless(self):
+        self.assertEqual(join_route_sections(split_route_sections(PLAN)), PLAN)
+
+    def test_cost_summary_does_not_open_day_sections(self):
+        sections = split_route_sections(PLAN)
+        self.assertEqual([section['key'] for section in sections], ['overview', 'day-1', 'day-2', 'day-3', 'summary'])
+        self.assertIn("Day 2: $200", sections[-1]['text'])
+
+    def test_repeated_day_number_stays_in_current_section(self):
+        plan = "Day 1: Paris\nx\nDay 2: Lyon\ny\nDay 2: Lyon (evening)\nz\n"
+        sections = split_route_sections(plan)
+        self.assertEqual([section['key'] for section in sections], ['day-1', 'day-2'])
+        self.assertEqual(join_route_sections(sections), plan)
+
+    def test_plan_without_days(self):
+        self.assertEqual(
+            split_route_sections("no days here"),
+            [{'key': 'overview', 'day': None, 'title': '', 'text': 'no days here'}]
+        )
+
+    def test_incremental_splitter_matches_split(self):
+        splitter = RouteSectionSplitter()
+        emitted = []
+        for i in range(0, len(PLAN), 5):
+            emitted += splitter.feed(PLAN[i:i + 5])
+        # 第一天在第二天的标题行完整时就已产出
+        self.assertIn('day-1', [section['key'] for section in emitted])
+        emitted += splitter.finish()
+        self.assertEqual(emitted, split_route_sections(PLAN))
+
+
+class ResolveRouteSectionsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.sections = split_route_sections(PLAN)
+
+    def test_explicit_day(self):
+        self.assertEqual(resolve_route_sections("change day 2 to a cheaper hotel", self.sections), ['day-2'])
+        self.assertEqual(resolve_route_sections("replace the last day", self.sections), ['day-3'])
+        self.assertEqual(resolve_route_sections("第1天换个酒店", self.sections), ['day-1'])
+
+    def test_named_place(self):
+        self.assertEqual(resolve_route_sections("skip Versailles please", self.sections), ['day-3'])
+
+    def test_whole_plan_or_too_many_days(self):
+        self.assertIsNone(resolve_route_sections("redo the whole plan", self.sections))
+        self.assertIsNone(resolve_route_sections("change days 1-3", self.sections))
+        self.assertIsNone(resolve_route_sections("make it nicer", self.sections))
+
+    def test_day_sections(self):
+        self.assertEqual([section['day'] for section in route_day_sections(self.sections)], [1, 2, 3])
+
+
+class WithDayHeadingTest(unittest.TestCase):
+
+    def test_adds_missing_heading(self):
+        self.assertEqual("".join(with_day_heading(["- Morning: ", "Louvre\n- Lunch"], "### Day 2: Louvre")),
+                         "### Day 2: Louvre\n- Morning: Louvre\n- Lunch")
+
+    def test_keeps_existing_heading(self):
+        self.assertEqual("".join(with_day_heading(["### Day 2: Mus", "ée\nx"], "### Day 2: Louvre")),
+                         "### Day 2: Musée\nx")
+
+    def test_short_output_without_newline(self):
+        self.assertEqual("".join(with_day_heading(["rest day"], "Day 3")), "Day 3\nrest day")
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,75 @@
+import threading
+import time
+import unittest
+from unittest import mock
+
+from app import StreamCoalescer
+
+
+def wait_until(condition, timeout=2.0):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if condition():
+            return True
+        time.sleep(0.005)
+    return condition()
+
+
+class StreamCoalescerTest(unittest.TestCase):
+
+    def setUp(self):
+        patcher = mock.patch('app.broadcast_stream_message')
+        self.broadcast = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def deltas(self):
+        return [call.kwargs.get('delta') for call in self.broadcast.call_args_list]
+
+    def message(self):
+        return {'id': f'm{time.monotonic_ns()}', 'content': ''}
+
+    def test_deltas_within_window_are_sent_once_by_the_scheduler(self):
+        coalescer = StreamCoalescer(window=0.05)
+        message = self.message()
+        coalescer.append(message, 'Hel')
+        coalescer.append(message, 'lo')
+        self.assertEqual(self.broadcast.call_count, 0)
+        self.assertTrue(wait_until(lambda: self.broadcast.call_count == 1))
+        self.assertEqual(self.deltas(), ['Hello'])
+        self.assertEqual(message['content'], 'Hello')
+
+    def test_append_after_window_flushes_without_waiting_for_the_scheduler(self):
+        coalescer = StreamCoalescer(window=0.05)
+        message = self.message()
+        with mock.patch('app.time.monotonic', return_value=100.0):
+            coalescer.append(message, 'a')
+        with mock.patch('app.time.monotonic', return_value=100.06):
+            coalescer.append(message, 'b')
+        self.assertEqual(self.deltas(), ['ab'])
+
+    def test_byte_threshold_and_snapshot(self):
+        coalescer = StreamCoalescer(window=10, max_bytes=4)
+        message = self.message()
+        coalescer.append(message, 'abcd')
+        self.assertEqual(self.deltas(), ['abcd'])
+        coalescer.append(message, 'e')
+        coalescer.snapshot(message, isStreaming=False)
+        # 快照已包含全部内容，未发送的增量不再单独发送
+        self.assertEqual(self.deltas(), ['abcd', None])
+        coalescer.flush_all()
+        self.assertEqual(self.broadcast.call_count, 2)
+
+    def test_many_windows_share_one_thread(self):
+        coalescer = StreamCoalescer(window=0.01)
+        messages = [self.message() for _ in range(20)]
+        with mock.patch('threading.Timer', side_effect=AssertionError('no per-window timers')):
+            for _ in range(3):
+                for message in messages:
+                    coalescer.append(message, 'x')
+                self.assertTrue(wait_until(lambda: not coalescer._pending))
+        self.assertEqual(sum(1 for thread in threading.enumerate() if thread.name == 'broadcast-coalesce'), 1)
+        self.assertEqual(self.broadcast.call_count, 60)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,90 @@
+import unittest
+
+from app import IncrementalJSONParser, extract_json_from_text, parse_router_response, stream_json_field
+
+
+class FakeChain:
+    """按给定的块流式输出，记录消费了多少块、流是否被关闭"""
+
+    def __init__(self, chunks):
+        self.chunks = chunks
+        self.consumed = 0
+        self.closed = False
+
+    def stream(self, inputs):
+        try:
+            for chunk in self.chunks:
+                self.consumed += 1
+                yield chunk
+        finally:
+            self.closed = True
+
+
+def feed_all(parser, text, size=3):
+    for i in range(0, len(text), size):
+        parser.feed(text[i:i + size])
+    return parser
+
+
+class IncrementalJSONParserTest(unittest.TestCase):
+
+    def test_fields_complete_before_object_ends(self):
+        parser = IncrementalJSONParser()
+        feed_all(parser, '{"agent": "travel", "reason": "the user wants')
+        self.assertEqual(parser.fields, {"agent": "travel"})
+        self.assertFalse(parser.done)
+
+    def test_complete_object(self):
+        parser = feed_all(IncrementalJSONParser(), 'Sure! {"intent": "new_plan", "reason": "x"} done')
+        self.assertTrue(parser.done)
+        self.assertEqual(parser.fields, {"intent": "new_plan", "reason": "x"})
+
+    def test_commas_and_braces_inside_strings(self):
+        parser = feed_all(IncrementalJSONParser(), '{"reason": "a, b {c}", "escaped": "q\\", r"')
+        self.assertEqual(parser.fields, {"reason": "a, b {c}"})
+
+    def test_nested_values(self):
+        parser = feed_all(IncrementalJSONParser(), '{"a": {"b": 1, "c": [1, 2]}, "d": 2}')
+        self.assertEqual(parser.fields, {"a": {"b": 1, "c": [1, 2]}, "d": 2})
+
+    def test_skips_braces_that_are_not_json(self):
+        parser = feed_all(IncrementalJSONParser(), 'Use {placeholders} like this: {"agent": "bill"}')
+        self.assertTrue(parser.done)
+        self.assertEqual(parser.fields, {"agent": "bill"})
+
+
+class StreamJsonFieldTest(unittest.TestCase):
+
+    def test_stops_once_key_is_complete(self):
+        chain = FakeChain(['{"agent": ', '"travel"', ', "reason"', ': "long', ' text"}'])
+        result, text = stream_json_field(chain, {}, 'agent')
+        self.assertEqual(result, {"agent": "travel"})
+        self.assertTrue(chain.closed)
+        self.assertLess(chain.consumed, len(chain.chunks))
+
+    def test_missing_key_falls_back_to_full_text(self):
+        chain = FakeChain(['{"other": 1}'])
+        result, text = stream_json_field(chain, {}, 'agent')
+        self.assertEqual(result, {"other": 1})
+        self.assertEqual(text, '{"other": 1}')
+
+    def test_unparseable_output(self):
+        result, text = stream_json_field(FakeChain(['oops']), {}, 'agent')
+        self.assertIsNone(result)
+        self.assertEqual(text, 'oops')
+
+
+class ExtractJsonTest(unittest.TestCase):
+
+    def test_first_complete_object_or_array(self):
+        self.assertEqual(extract_json_from_text('x {"a": [1, {"b": 2}]} y {"c": 3}'), {"a": [1, {"b": 2}]})
+        self.assertEqual(extract_json_from_text('list: [1, 2]'), [1, 2])
+        self.assertIsNone(extract_json_from_text('no json {here'))
+
+    def test_router_response(self):
+        self.assertEqual(parse_router_response({"agent": "bill"}), "bill")
+        self.assertEqual(parse_router_response('{"agent": "travel"}'), "travel")
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,50 @@
+import unittest
+
+from app import CONFIRMATION_AGREE_PHRASES, CONFIRMATION_AGREE_WORDS, CONFIRMATION_DISAGREE_WORDS, match_vote
+
+
+class MatchVoteTest(unittest.TestCase):
+
+    def test_plain_votes(self):
+        self.assertEqual(match_vote("yes"), "agree")
+        self.assertEqual(match_vote("OK, go for it"), "agree")
+        self.assertEqual(match_vote("no"), "disagree")
+        self.assertEqual(match_vote("I disagree"), "disagree")
+        self.assertEqual(match_vote("同意"), "agree")
+        self.assertEqual(match_vote("可以"), "agree")
+
+    def test_words_are_matched_whole(self):
+        self.assertIsNone(match_vote("I know the book"))
+        self.assertIsNone(match_vote("let me think"))
+
+    def test_negated_agree_is_disagree(self):
+        self.assertEqual(match_vote("I don't agree"), "disagree")
+        self.assertEqual(match_vote("not ok"), "disagree")
+        self.assertEqual(match_vote("不同意"), "disagree")
+        self.assertEqual(match_vote("不可以"), "disagree")
+        self.assertEqual(match_vote("不好"), "disagree")
+
+    def test_unsure_is_not_a_vote(self):
+        self.assertIsNone(match_vote("不确定"))
+        self.assertIsNone(match_vote("我不确定可以"))
+        self.assertIsNone(match_vote("not sure, maybe ok"))
+
+    def test_incidental_no_does_not_override_agree(self):
+        self.assertEqual(match_vote("agreed, no changes please"), "agree")
+        self.assertEqual(match_vote("no problem"), "agree")
+        self.assertEqual(match_vote("yes, no objections"), "agree")
+
+    def test_conflicting_votes_are_ambiguous(self):
+        self.assertIsNone(match_vote("yes, cancel it"))
+        self.assertIsNone(match_vote("同意，但是取消第二天"))
+
+    def test_confirmation_words(self):
+        def confirmation(text):
+            return match_vote(text, CONFIRMATION_AGREE_WORDS, CONFIRMATION_DISAGREE_WORDS, CONFIRMATION_AGREE_PHRASES)
+        self.assertEqual(confirmation("finalize it"), "agree")
+        self.assertEqual(confirmation("please replan"), "disagree")
+        self.assertEqual(confirmation("确认计划"), "agree")
+
+
+if __name__ == '__main__':
+    unittest.main()